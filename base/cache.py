@@ -1,23 +1,240 @@
+import inspect
+import sys
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Callable, Dict, Optional, Hashable, Iterable
+
+import gevent
 import requests
+from gevent.event import AsyncResult
+
+from base.style import Assert, json_str
+
+
+def _sizeof(value) -> int:
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class _Entry:
+    __slots__ = ("value", "error", "expire", "stale", "size")
+
+    def __init__(self, value, error: Optional[Exception], expire: float, stale: float, size: int):
+        self.value = value
+        self.error = error
+        self.expire = expire
+        self.stale = stale
+        self.size = size
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class TTLCache:
+    """
+    有上限(数量/字节)的LRU, 每条带TTL(秒)
+    并发的miss只有一个去加载(single-flight), 其他的等待结果
+    过期后stale秒内先返回旧值同时后台刷新(stale-while-revalidate)
+    加载异常或者返回None会缓存negative_ttl秒(negative cache)
+    """
+
+    def __init__(self, ttl: float = 60, maxsize: int = 1024, *, maxbytes: int = 0, stale: float = 0,
+                 negative_ttl: float = 0, sizeof: Callable[[Any], int] = _sizeof, name: str = ""):
+        Assert(maxsize > 0 or maxbytes > 0, "cache必须有上限")
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.stale = stale
+        self.negative_ttl = negative_ttl
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.waits = 0
+        self.errors = 0
+        self.evictions = 0
+        self.__data: 'OrderedDict[Hashable, _Entry]' = OrderedDict()
+        self.__pending: Dict[Hashable, AsyncResult] = {}
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __contains__(self, key: Hashable):
+        entry = self.__data.get(key)
+        return entry is not None and entry.expire > time.monotonic()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self.__data),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "negative_hits": self.negative_hits,
+            "waits": self.waits,
+            "errors": self.errors,
+            "evictions": self.evictions,
+        }
+
+    def set(self, key: Hashable, value, *, ttl: Optional[float] = None, error: Optional[Exception] = None):
+        if ttl is None:
+            ttl = self.negative_ttl if value is None or error is not None else self.ttl
+        if ttl <= 0:
+            self.delete(key)
+            return
+        size = self.sizeof(value) if self.maxbytes else 0
+        expire = time.monotonic() + ttl
+        self.delete(key)
+        # 失败的结果不用stale
+        self.__data[key] = _Entry(value, error, expire, expire + (0 if error is not None else self.stale), size)
+        self.bytes += size
+        while self.__data and (len(self.__data) > self.maxsize > 0 or self.bytes > self.maxbytes > 0):
+            _, entry = self.__data.popitem(last=False)
+            self.bytes -= entry.size
+            self.evictions += 1
+
+    def peek(self, key: Hashable, default=None):
+        """
+        不影响统计以及LRU顺序(过期的也返回)
+        """
+        entry = self.__data.get(key)
+        return default if entry is None or entry.error is not None else entry.value
+
+    def delete(self, key: Hashable):
+        if (entry := self.__data.pop(key, None)) is not None:
+            self.bytes -= entry.size
+
+    def clear(self):
+        self.__data.clear()
+        self.bytes = 0
 
-from base.style import now
+    def get(self, key: Hashable, loader: Optional[Callable[[], Any]] = None, default=None, *,
+            ttl: Optional[float] = None):
+        """
+        没有loader时只是查询, 找不到返回default
+        """
+        entry = self.__data.get(key)
+        if entry is not None:
+            cur = time.monotonic()
+            if entry.expire > cur:
+                self.__data.move_to_end(key)
+                if entry.error is not None or entry.value is None:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                return entry.result()
+            if entry.stale > cur and loader is not None:
+                self.stale_hits += 1
+                self.__data.move_to_end(key)
+                if key not in self.__pending:
+                    gevent.spawn(self.__revalidate, key, loader, ttl)
+                return entry.result()
+            self.delete(key)
+        if loader is None:
+            self.misses += 1
+            return default
+        return self.__load(key, loader, ttl)
 
-__pool = {
+    def __revalidate(self, key: Hashable, loader: Callable[[], Any], ttl: Optional[float]):
+        try:
+            self.__load(key, loader, ttl, negative=False)
+        except Exception:
+            # 刷新失败继续用旧值直到stale也过期
+            pass
+
+    def __load(self, key: Hashable, loader: Callable[[], Any], ttl: Optional[float], negative=True):
+        if (pending := self.__pending.get(key)) is not None:
+            self.waits += 1
+            return pending.get()
+        pending = self.__pending[key] = AsyncResult()
+        self.misses += 1
+        try:
+            value = loader()
+        except Exception as e:
+            self.errors += 1
+            if negative:
+                self.set(key, None, error=e)
+            pending.set_exception(e)
+            raise
+        else:
+            if value is not None or negative:
+                self.set(key, value, ttl=ttl if value is not None else None)
+            pending.set(value)
+            return value
+        finally:
+            del self.__pending[key]
+
+
+_pool: Dict[str, TTLCache] = {
 
 }
 
 
+def stats() -> Dict[str, Dict[str, int]]:
+    return {k: v.stats() for k, v in _pool.items()}
+
+
+def _make_key(sig: inspect.Signature, args, kwargs, ignore: Iterable[str]) -> Hashable:
+    bound = sig.bind(*args, **kwargs)
+    bound.apply_defaults()
+    ret = tuple((k, v) for k, v in bound.arguments.items() if k not in ignore)
+    try:
+        hash(ret)
+        return ret
+    except TypeError:
+        return json_str(ret)
+
+
+def cached(ttl: float = 60, maxsize: int = 1024, *, maxbytes: int = 0, stale: float = 0, negative_ttl: float = 0,
+           key: Optional[Callable[..., Hashable]] = None, ignore: Iterable[str] = ()):
+    """
+    函数结果的缓存
+    保留原函数的签名, 可以直接用在Action上(放在@Action的下面), 框架注入的参数用ignore排除
+        @Action
+        @cached(ttl=10, ignore=["__request"])
+        def some_action(__request, uid: str):
+    """
+    ignore = set(ignore)
+
+    def decorator(func):
+        sig = inspect.signature(func)
+        name = f"{func.__module__}.{func.__qualname__}"
+        cache = _pool[name] = TTLCache(ttl, maxsize, maxbytes=maxbytes, stale=stale, negative_ttl=negative_ttl,
+                                       name=name)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            _key = key(*args, **kwargs) if key else _make_key(sig, args, kwargs, ignore)
+            return cache.get(_key, lambda: func(*args, **kwargs))
+
+        wrapper.cache = cache
+        # getfullargspec不会顺着__wrapped__找, 需要显式的签名
+        wrapper.__signature__ = sig
+        return wrapper
+
+    return decorator
+
+
+__http_cache = _pool["cache_http_get"] = TTLCache(24 * 3600, 1024, maxbytes=64 * 1024 * 1024, negative_ttl=60,
+                                                   name="cache_http_get")
+
+
 def cache_http_get(url: str, expire=24 * 3600 * 1000) -> bytes:
     """
     支持cache的get操作
+    非200的会抛异常并且短暂缓存失败
     """
-    key = f"cache_http_get#{url}"
-    if key not in __pool:
+
+    def loader():
         rsp = requests.get(url)
-        if rsp.status_code == 200:
-            content = rsp.content
-            __pool[key] = {
-                "content": content,
-                "expire": now() + expire
-            }
-    return __pool[key]["content"]
+        Assert(rsp.status_code == 200, f"请求失败[{url}][{rsp.status_code}]")
+        return rsp.content
+
+    return __http_cache.get(f"cache_http_get#{url}", loader, ttl=expire / 1000)
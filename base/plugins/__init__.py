@@ -1,2 +1,45 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
+"""
+插件的注册表
+插件在第一次访问时才import并创建实例, 不用的进程不需要承担加载的开销
+    from base import plugins
+    plugins.keyword_filter.filter("...")
+"""
+import importlib
+from typing import Dict, Tuple, Any
+
+# 名字 => (模块, 工厂方法)
+# 名字不要和子模块重名, 子模块import之后会覆盖掉同名的属性
+_registry: Dict[str, Tuple[str, str]] = {
+    "keyword_filter": ("base.plugins.filter_keywords", "instance"),
+    "ip_locator": ("base.plugins.ip_detail.main", "instance"),
+    "city_picker": ("base.plugins.china_city_picker.main", "instance"),
+    "name_pool": ("base.plugins.random_name.main", "instance"),
+    "user_pool": ("base.plugins.random_user.main", "instance"),
+}
+_loaded: Dict[str, Any] = {
+
+}
+
+
+def register(name: str, module: str, factory: str = "instance"):
+    assert name not in _loaded, f"插件[{name}]已经加载了"
+    _registry[name] = (module, factory)
+
+
+def plugin(name: str) -> Any:
+    if (ret := _loaded.get(name)) is None:
+        module, factory = _registry[name]
+        ret = _loaded[name] = getattr(importlib.import_module(module), factory)()
+    return ret
+
+
+def loaded() -> Dict[str, Any]:
+    return dict(_loaded)
+
+
+def __getattr__(name: str):
+    if name in _registry:
+        return plugin(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,77 +1,228 @@
-from typing import Tuple, List, Optional
+import bisect
+import os
+import struct
+import sys
+import zlib
+from array import array
+from typing import Tuple, List, Optional, Dict, Sequence
 
 
 class ChinaCityPicker:
-    def __init__(self):
-        try:
-            exec("from . import data")
-        except:
-            exec("import data")
-        orig = eval("data.ChineseDistricts")
-        self.__title = {}
-        self.__city = {}
-        self.__prov = {}
-        self.__code = {}
+    """
+    省市区的紧凑表
+    按code排序的int数组 + 共用的名字表(intern过的), 第一次使用时才加载
+    编译结果缓存在`data.py.bin`里(以data.py的crc32校验)
+    """
+    MAGIC = b"CCPK"
+    VERSION = 1
+    __HEADER = struct.Struct("<4sHBIIII")
+
+    def __init__(self, path: Optional[str] = None, cache_path: Optional[str] = None):
+        self.__path = path or os.path.join(os.path.dirname(__file__), "data.py")
+        self.__cache_path = cache_path or f"{self.__path}.bin"
+        self.__loaded = False
+        self.names: List[str] = []
+        # 按code排序, 省/市/区的名字都是names里的下标(-1表示没有)
+        self.codes = array("i")
+        self.prov = array("i")
+        self.city = array("i")
+        self.title = array("i")
+        # by_area用的 名字 => code
+        self.__code: Dict[str, Tuple[int, ...]] = {}
+        # 前缀索引(按名字排序)
+        self.__prefix_names: List[str] = []
+        self.__prefix_rows = array("i")
+
+    @staticmethod
+    def __orig_data(path: str):
+        scope = {}
+        with open(path, encoding="utf8") as fin:
+            exec(compile(fin.read(), path, "exec"), scope)
+        return scope["ChineseDistricts"]
+
+    def compile(self, orig: Dict) -> 'ChinaCityPicker':
+        """
+        从data.py的原始结构构建紧凑表
+        """
+        title = {}
+        city = {}
+        prov = {}
+        code_index = {}
         for detail in [y for x in orig[86].values() for y in x]:
-            self.__prov[int(detail["code"])] = detail["address"]
-            self.__title[int(detail["code"])] = detail["address"]
+            prov[int(detail["code"])] = detail["address"]
+            title[int(detail["code"])] = detail["address"]
 
         for _id, each in orig.items():
             if _id % 10000 != 0:
                 continue
-            for code, title in each.items():
-                self.__title[code] = title
-                self.__prov[code] = self.__prov[_id]
+            for code, name in each.items():
+                title[code] = name
+                prov[code] = prov[_id]
 
         for _id, each in orig.items():
             if len(str(_id)) != 6:
                 continue
             if _id % 10000 == 0:
-                for code, title in each.items():
-                    if int(code) in self.__title and self.__title[code] != title:
-                        assert False, ("重名了[%s][%s]=>[%s]" % (code, self.__title[code], title))
-                    self.__title[code] = title
-                    self.__prov[code] = self.__prov[_id]
-                    self.__code[title] = code
+                for code, name in each.items():
+                    if int(code) in title and title[code] != name:
+                        assert False, ("重名了[%s][%s]=>[%s]" % (code, title[code], name))
+                    title[code] = name
+                    prov[code] = prov[_id]
+                    code_index[name] = code
             else:
-                for code, title in each.items():
-                    if int(code) in self.__title and self.__title[code] != title:
-                        assert False, ("重名了[%s][%s]=>[%s]" % (code, self.__title[code], title))
-                    self.__title[code] = title
-                    self.__city[code] = self.__title[_id]
-                    self.__prov[code] = self.__prov[_id]
-                    try:
-                        if title in self.__code:
-                            self.__code[title].append(code)
-                        else:
-                            self.__code[title] = [code]
-                    except:
-                        print("歧义区域[%s][%s]" % (title, self.__code[title]))
+                for code, name in each.items():
+                    if int(code) in title and title[code] != name:
+                        assert False, ("重名了[%s][%s]=>[%s]" % (code, title[code], name))
+                    title[code] = name
+                    city[code] = title[_id]
+                    prov[code] = prov[_id]
+                    if name not in code_index:
+                        code_index[name] = [code]
+                    elif isinstance(code_index[name], list):
+                        code_index[name].append(code)
+                    else:
+                        print("歧义区域[%s][%s]" % (name, code_index[name]))
+
+        names: Dict[str, int] = {}
+
+        def name_id(name: Optional[str]) -> int:
+            return -1 if name is None else names.setdefault(name, len(names))
+
+        self.codes = array("i", sorted(title))
+        self.prov = array("i", [name_id(prov.get(code)) for code in self.codes])
+        self.city = array("i", [name_id(city.get(code)) for code in self.codes])
+        self.title = array("i", [name_id(title[code]) for code in self.codes])
+        self.names = list(map(sys.intern, names))
+        self.__code = {sys.intern(k): tuple(v) if isinstance(v, list) else (v,) for k, v in code_index.items()}
+        self.__build_prefix()
+        self.__loaded = True
+        return self
+
+    def __build_prefix(self):
+        tmp = sorted((self.names[self.title[row]], row) for row in range(len(self.codes)))
+        self.__prefix_names = [x[0] for x in tmp]
+        self.__prefix_rows = array("i", [x[1] for x in tmp])
+
+    def dump_cache(self, path: str, checksum: int):
+        names = "\n".join(self.names).encode("utf8")
+        keys = list(self.__code)
+        key_names = "\n".join(keys).encode("utf8")
+        starts = array("i", [0])
+        flat = array("i")
+        for key in keys:
+            flat.extend(self.__code[key])
+            starts.append(len(flat))
+        with open(path, "wb") as fout:
+            fout.write(ChinaCityPicker.__HEADER.pack(
+                ChinaCityPicker.MAGIC, ChinaCityPicker.VERSION, sys.byteorder == "little", checksum,
+                len(self.codes), len(names), len(key_names),
+            ))
+            fout.write(names)
+            fout.write(key_names)
+            for each in [self.codes, self.prov, self.city, self.title, starts]:
+                each.tofile(fout)
+            array("i", [len(flat)]).tofile(fout)
+            flat.tofile(fout)
+
+    def load_cache(self, path: str, checksum: int) -> bool:
+        with open(path, "rb") as fin:
+            content = fin.read()
+        size = ChinaCityPicker.__HEADER.size
+        if len(content) < size:
+            return False
+        magic, version, little, _checksum, rows, names_len, keys_len = \
+            ChinaCityPicker.__HEADER.unpack_from(content, 0)
+        if (magic, version, bool(little), _checksum) != (ChinaCityPicker.MAGIC, ChinaCityPicker.VERSION,
+                                                          sys.byteorder == "little", checksum):
+            return False
+        offset = size
+        names = list(map(sys.intern, content[offset:offset + names_len].decode("utf8").split("\n")))
+        offset += names_len
+        keys = list(map(sys.intern, content[offset:offset + keys_len].decode("utf8").split("\n")))
+        offset += keys_len
+
+        def read(length: int) -> array:
+            nonlocal offset
+            tmp = array("i")
+            tmp.frombytes(content[offset:offset + length * tmp.itemsize])
+            offset += length * tmp.itemsize
+            if len(tmp) != length:
+                raise ValueError("缓存不完整")
+            return tmp
+
+        codes, prov, city, title = read(rows), read(rows), read(rows), read(rows)
+        starts = read(len(keys) + 1)
+        flat = read(read(1)[0])
+        self.names, self.codes, self.prov, self.city, self.title = names, codes, prov, city, title
+        self.__code = {key: tuple(flat[starts[i]:starts[i + 1]]) for i, key in enumerate(keys)}
+        self.__build_prefix()
+        self.__loaded = True
+        return True
+
+    def load(self) -> 'ChinaCityPicker':
+        """
+        优先读取缓存, 不可用时重新编译并尝试写入
+        """
+        if self.__loaded:
+            return self
+        with open(self.__path, "rb") as fin:
+            checksum = zlib.crc32(fin.read())
+        if os.path.exists(self.__cache_path):
+            try:
+                if self.load_cache(self.__cache_path, checksum):
+                    return self
+            except (OSError, ValueError, struct.error):
+                pass
+        self.compile(ChinaCityPicker.__orig_data(self.__path))
+        try:
+            self.dump_cache(self.__cache_path, checksum)
+        except OSError:
+            # 只读的环境就算了
+            pass
+        return self
+
+    def __row(self, code: int) -> int:
+        if not self.__loaded:
+            self.load()
+        row = bisect.bisect_left(self.codes, code)
+        if row < len(self.codes) and self.codes[row] == code:
+            return row
+        return -1
+
+    def __name(self, name_id: int, default: Optional[str] = None) -> Optional[str]:
+        return default if name_id < 0 else self.names[name_id]
 
     def dump(self):
-        return self.__title
+        if not self.__loaded:
+            self.load()
+        return {code: self.names[name_id] for code, name_id in zip(self.codes, self.title)}
 
     def by_code(self, code: int, allow_not_found=False,
                 default_prov="未知省",
                 default_city="未知市",
                 default_area="未知区",
                 ) -> Tuple[str, str, str]:
-        if allow_not_found:
-            return self.__prov.get(code, default_prov), \
-                   self.__city.get(code, default_city), \
-                   self.__title.get(code, default_area)
-        else:
-            return self.__prov.get(code), self.__city.get(code), self.__title.get(code)
+        row = self.__row(code)
+        if not allow_not_found:
+            default_prov = default_city = default_area = None
+        if row < 0:
+            return default_prov, default_city, default_area
+        return self.__name(self.prov[row], default_prov), \
+               self.__name(self.city[row], default_city), \
+               self.__name(self.title[row], default_area)
+
+    def by_code_many(self, code_list: Sequence[int], allow_not_found=False, **kwargs) -> List[Tuple[str, str, str]]:
+        return [self.by_code(code, allow_not_found=allow_not_found, **kwargs) for code in code_list]
 
     def by_area(self, area_name: str, fail=True, output_all: List = None) -> Optional[Tuple[int, int, int]]:
-        code = self.__code.get(area_name, None)
-        if code is not None:
-            if isinstance(code, int):
-                ret = [(self.__prov[code], self.__city[code], code)]
-            else:
-                ret = []
-                for each in code:
-                    ret.append((self.__prov[each], self.__city[each], each))
+        if not self.__loaded:
+            self.load()
+        code_list = self.__code.get(area_name, None)
+        if code_list is not None:
+            ret = []
+            for each in code_list:
+                row = self.__row(each)
+                ret.append((self.__name(self.prov[row]), self.__name(self.city[row]), each))
             if len(ret) > 1:
                 if output_all is not None:
                     output_all.extend(ret)
@@ -92,23 +243,53 @@ class ChinaCityPicker:
             else:
                 raise Exception("找不到指定区域[%s]的相关信息" % area_name)
 
+    def by_area_many(self, area_list: Sequence[str], fail=False) -> List[Optional[Tuple[int, int, int]]]:
+        """
+        批量查询, 默认找不到或者有歧义的不抛异常(有歧义的返回第一个)
+        """
+        return [self.by_area(each, fail=fail) for each in area_list]
+
+    def suggest(self, prefix: str, limit=10) -> List[Tuple[str, str, str, int]]:
+        """
+        按名字前缀补全省/市/区, 返回(省, 市, 名字, code)
+        """
+        if not self.__loaded:
+            self.load()
+        ret = []
+        i = bisect.bisect_left(self.__prefix_names, prefix)
+        while i < len(self.__prefix_names) and len(ret) < limit and self.__prefix_names[i].startswith(prefix):
+            row = self.__prefix_rows[i]
+            ret.append((self.__name(self.prov[row]), self.__name(self.city[row]), self.__prefix_names[i],
+                        self.codes[row]))
+            i += 1
+        return ret
+
 
 __global_instance = None
 
 
 def instance() -> ChinaCityPicker:
+    """
+    只创建不加载, 第一次查询时才读取数据
+    """
     global __global_instance
     if __global_instance is None:
         __global_instance = ChinaCityPicker()
     return __global_instance
 
 
-picker = instance()
+def __getattr__(name):
+    # 兼容原来模块级别的`picker`
+    if name == "picker":
+        return instance()
+    raise AttributeError(name)
+
 
 if __name__ == "__main__":
     print(instance().by_area("闽清县"))
     print(instance().by_code(510630))
     print(instance().by_area("中山市"))
-    print(instance().by_area("朝阳区"))
-    print(instance().by_area("解放路"))
+    print(instance().by_area("朝阳区", fail=False))
+    print(instance().by_area("解放路", fail=False))
+    print(instance().suggest("朝阳"))
     # print(json.dumps(instance().dump(), ensure_ascii=False, indent=0))
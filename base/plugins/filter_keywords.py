@@ -1,181 +1,653 @@
-#!/usr/bin/env python
-# -*- coding:utf-8 -*-
-
-import os
-import re
-from collections import defaultdict
-
-__all__ = ['NaiveFilter', 'BSFilter', 'DFAFilter', 'InvalidStringError']
-__author__ = 'observer'
-__date__ = '2012.01.05'
-
-
-class InvalidStringError(Exception):
-    def __init__(self, msg):
-        Exception.__init__(self, msg)
-        self.msg = msg
-
-
-class NaiveFilter:
-    """
-    Filter Messages from keywords
-    very simple filter implementation
-    hello **** baby
-    """
-
-    def __init__(self):
-        self.keywords = set([])
-
-    def parse(self, path):
-        for keyword in open(path):
-            self.keywords.add(keyword.strip().decode('utf-8').lower())
-
-    def filter(self, message, repl="*"):
-        message = message.lower()
-        for kw in self.keywords:
-            message = message.replace(kw, repl)
-        return message
-
-
-class BSFilter:
-    """
-    Filter Messages from keywords
-    Use Back Sorted Mapping to reduce replacement times
-    hello **** baby
-    """
-
-    def __init__(self):
-        self.keywords = []
-        self.kwsets = set([])
-        self.bsdict = defaultdict(set)
-        self.pat_en = re.compile(r'^[0-9a-zA-Z]+$')  # english phrase or not
-
-    def add(self, keyword):
-        keyword = keyword.lower()
-        if keyword not in self.kwsets:
-            self.keywords.append(keyword)
-            self.kwsets.add(keyword)
-            index = len(self.keywords) - 1
-            for word in keyword.split():
-                if self.pat_en.search(word):
-                    self.bsdict[word].add(index)
-                else:
-                    for char in word:
-                        self.bsdict[char].add(index)
-
-    def parse(self, path):
-        with open(path, "r") as f:
-            for keyword in f:
-                self.add(keyword.strip())
-
-    def filter(self, message, repl="*"):
-        message = message.lower()
-        for word in message.split():
-            if self.pat_en.search(word):
-                for index in self.bsdict[word]:
-                    message = message.replace(self.keywords[index], repl)
-            else:
-                for char in word:
-                    for index in self.bsdict[char]:
-                        message = message.replace(self.keywords[index], repl)
-        return message
-
-
-class DFAFilter:
-    """
-    Filter Messages from keywords
-    Use DFA to keep algorithm perform constantly
-    hello **** baby
-    """
-
-    def __init__(self):
-        self.keyword_chains = {}
-        self.delimit = '\x00'
-
-    # noinspection PyUnboundLocalVariable
-    def add(self, keyword):
-        keyword = keyword.lower()
-        chars = keyword.strip()
-        if not chars:
-            return
-        level = self.keyword_chains
-        for i in range(len(chars)):
-            if chars[i] in level:
-                level = level[chars[i]]
-            else:
-                if not isinstance(level, dict):
-                    break
-                for j in range(i, len(chars)):
-                    level[chars[j]] = {}
-                    last_level, last_char = level, chars[j]
-                    level = level[chars[j]]
-                last_level[last_char] = {self.delimit: 0}
-                break
-        if i == len(chars) - 1:
-            level[self.delimit] = 0
-
-    def parse(self, path):
-        with open(path) as f:
-            for keyword in f:
-                self.add(keyword.strip())
-
-    def filter(self, message, repl="*", must_no_keywords=False):
-        message = message.lower()
-        ret = []
-        start = 0
-        while start < len(message):
-            level = self.keyword_chains
-            step_ins = 0
-            for char in message[start:]:
-                if char in level:
-                    step_ins += 1
-                    if self.delimit not in level[char]:
-                        level = level[char]
-                    else:
-                        if must_no_keywords:
-                            raise InvalidStringError("有敏感字[%s]" % message[start:start + step_ins])
-                        else:
-                            ret.append(repl * step_ins)
-                            start += step_ins - 1
-                            break
-                else:
-                    ret.append(message[start])
-                    break
-            else:
-                ret.append(message[start])
-            start += 1
-
-        return ''.join(ret)
-
-
-__global_instance = DFAFilter()
-__global_instance.parse(os.path.join(os.path.dirname(__file__), "words.dat"))
-
-
-def instance():
-    """
-    :rtype :DFAFilter
-    """
-    return __global_instance
-
-
-def test_first_character():
-    tmp = DFAFilter()
-    tmp.add("1989年")
-    assert tmp.filter("1989", "*") == "1989"
-
-
-if __name__ == "__main__":
-    # gfw = NaiveFilter()
-    # gfw = BSFilter()
-    gfw = instance()
-    import time
-
-    t = time.time()
-    print(gfw.filter("法轮功 我操操操", "*"))
-    print(gfw.filter("针孔摄像机 我操操操", "*"))
-    print(gfw.filter("售假人民币 我操操操", "*"))
-    print(gfw.filter("传世私服 我操操操", "*"))
-    print(time.time() - t)
-
-    test_first_character()
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import os
+import pickle
+import random
+import re
+import struct
+import sys
+import time
+import zlib
+from array import array
+from collections import defaultdict, deque
+from typing import Dict, List, Tuple, Optional, Sequence, TypedDict
+
+__all__ = ['NaiveFilter', 'BSFilter', 'DFAFilter', 'ACFilter', 'InvalidStringError', 'ScreenResult', 'filter_many']
+__author__ = 'observer'
+__date__ = '2012.01.05'
+
+
+class InvalidStringError(Exception):
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
+        self.msg = msg
+
+
+class NaiveFilter:
+    """
+    Filter Messages from keywords
+    very simple filter implementation
+    hello **** baby
+    """
+
+    def __init__(self):
+        self.keywords = set([])
+
+    def parse(self, path):
+        for keyword in open(path):
+            self.keywords.add(keyword.strip().decode('utf-8').lower())
+
+    def filter(self, message, repl="*"):
+        message = message.lower()
+        for kw in self.keywords:
+            message = message.replace(kw, repl)
+        return message
+
+
+class BSFilter:
+    """
+    Filter Messages from keywords
+    Use Back Sorted Mapping to reduce replacement times
+    hello **** baby
+    """
+
+    def __init__(self):
+        self.keywords = []
+        self.kwsets = set([])
+        self.bsdict = defaultdict(set)
+        self.pat_en = re.compile(r'^[0-9a-zA-Z]+$')  # english phrase or not
+
+    def add(self, keyword):
+        keyword = keyword.lower()
+        if keyword not in self.kwsets:
+            self.keywords.append(keyword)
+            self.kwsets.add(keyword)
+            index = len(self.keywords) - 1
+            for word in keyword.split():
+                if self.pat_en.search(word):
+                    self.bsdict[word].add(index)
+                else:
+                    for char in word:
+                        self.bsdict[char].add(index)
+
+    def parse(self, path):
+        with open(path, "r") as f:
+            for keyword in f:
+                self.add(keyword.strip())
+
+    def filter(self, message, repl="*"):
+        message = message.lower()
+        for word in message.split():
+            if self.pat_en.search(word):
+                for index in self.bsdict[word]:
+                    message = message.replace(self.keywords[index], repl)
+            else:
+                for char in word:
+                    for index in self.bsdict[char]:
+                        message = message.replace(self.keywords[index], repl)
+        return message
+
+
+class DFAFilter:
+    """
+    Filter Messages from keywords
+    Use DFA to keep algorithm perform constantly
+    hello **** baby
+    """
+
+    def __init__(self):
+        self.keyword_chains = {}
+        self.delimit = '\x00'
+
+    # noinspection PyUnboundLocalVariable
+    def add(self, keyword):
+        keyword = keyword.lower()
+        chars = keyword.strip()
+        if not chars:
+            return
+        level = self.keyword_chains
+        for i in range(len(chars)):
+            if chars[i] in level:
+                level = level[chars[i]]
+            else:
+                if not isinstance(level, dict):
+                    break
+                for j in range(i, len(chars)):
+                    level[chars[j]] = {}
+                    last_level, last_char = level, chars[j]
+                    level = level[chars[j]]
+                last_level[last_char] = {self.delimit: 0}
+                break
+        if i == len(chars) - 1:
+            level[self.delimit] = 0
+
+    def parse(self, path):
+        with open(path) as f:
+            for keyword in f:
+                self.add(keyword.strip())
+
+    def filter(self, message, repl="*", must_no_keywords=False):
+        message = message.lower()
+        ret = []
+        start = 0
+        while start < len(message):
+            level = self.keyword_chains
+            step_ins = 0
+            for char in message[start:]:
+                if char in level:
+                    step_ins += 1
+                    if self.delimit not in level[char]:
+                        level = level[char]
+                    else:
+                        if must_no_keywords:
+                            raise InvalidStringError("有敏感字[%s]" % message[start:start + step_ins])
+                        else:
+                            ret.append(repl * step_ins)
+                            start += step_ins - 1
+                            break
+                else:
+                    ret.append(message[start])
+                    break
+            else:
+                ret.append(message[start])
+            start += 1
+
+        return ''.join(ret)
+
+
+# 全角转半角(一一对应保证下标不变)
+_FOLD_TABLE = dict([(0x3000, 0x20)] + [(i, i - 0xFEE0) for i in range(0xFF01, 0xFF5F)])
+
+
+def _mask(message: str, spans: List[Tuple[int, int]], repl: str) -> str:
+    if not spans:
+        return message
+    ret = []
+    cur = 0
+    for start, end in spans:
+        ret.append(message[cur:start])
+        ret.append(repl * (end - start))
+        cur = end
+    ret.append(message[cur:])
+    return "".join(ret)
+
+
+def _fold(message: str) -> str:
+    """
+    大小写以及全角半角归一
+    """
+    message = message.translate(_FOLD_TABLE)
+    lower = message.lower()
+    if len(lower) == len(message):
+        return lower
+    # 少数字符lower后长度会变
+    return "".join(map(lambda x: x if len(x.lower()) != 1 else x.lower(), message))
+
+
+class ScreenResult(TypedDict):
+    hits: List[str]
+    text: str
+
+
+def _read_all(fd: int) -> bytes:
+    """
+    gevent的monkey patch下用非阻塞的读, 等待子进程的时候不卡住hub
+    """
+    reader = os.read
+    if (monkey := sys.modules.get("gevent.monkey")) is not None and monkey.is_module_patched("os"):
+        from gevent.os import make_nonblocking, nb_read
+        make_nonblocking(fd)
+        reader = nb_read
+    ret = []
+    while tmp := reader(fd, 1 << 20):
+        ret.append(tmp)
+    return b"".join(ret)
+
+
+def _fork_map(func, chunks: List, workers: int) -> List:
+    """
+    fork出workers个子进程, 第i个处理chunks[i::workers], 结果pickle之后从pipe写回
+    不用multiprocessing.Pool, 它内部的线程在gevent的monkey patch下会卡死
+    子进程直接继承fork前的内存(写时复制)
+    """
+    procs = []
+    for i in range(workers):
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                os.close(rfd)
+                data = pickle.dumps([func(each) for each in chunks[i::workers]], pickle.HIGHEST_PROTOCOL)
+                with os.fdopen(wfd, "wb") as fout:
+                    fout.write(data)
+                code = 0
+            finally:
+                os._exit(code)
+        os.close(wfd)
+        procs.append((pid, rfd))
+    results = []
+    failed = False
+    for pid, rfd in procs:
+        try:
+            data = _read_all(rfd)
+        finally:
+            os.close(rfd)
+        _, status = os.waitpid(pid, 0)
+        if status != 0 or not data:
+            failed = True
+            continue
+        results.append(pickle.loads(data))
+    if failed:
+        raise RuntimeError("filter_many的子进程异常退出")
+    return [results[i % workers][i // workers] for i in range(len(chunks))]
+
+
+class ACFilter:
+    """
+    Filter Messages from keywords
+    Use Aho-Corasick automaton stored in flat arrays
+    state的转移以CSR的形式存放(按字符编号排序), 运行时的索引(goto_key/hit_*)也是平铺的数组
+    全部直接落盘作为预编译缓存, 读取后只需要把goto_key和edge_target zip成dict
+    hello **** baby
+    """
+    MAGIC = b"KWAC"
+    VERSION = 2
+    __HEADER = struct.Struct("<4sHBIIIIII")
+
+    def __init__(self):
+        self.keywords: List[str] = []
+        self.alphabet: Dict[str, int] = {}
+        # state[i]的转移为 edge_label/edge_target[edge_start[i]:edge_start[i+1]]
+        self.edge_start = array("i", [0, 0])
+        self.edge_label = array("i")
+        self.edge_target = array("i")
+        self.fail = array("i", [0])
+        # 以当前state结尾的关键字长度(0表示没有)
+        self.out_len = array("i", [0])
+        # 沿着fail链最近的一个有输出的state
+        self.out_link = array("i", [0])
+        # 每条边`state*字符数+字符编号`的key, 和edge_target一一对应
+        self.goto_key = array("q")
+        # state[i]沿着fail链的全部输出长度为 hit_len[hit_start[i]:hit_start[i+1]]
+        self.hit_start = array("i", [0, 0])
+        self.hit_len = array("i")
+        # 运行时的索引(按需构建)
+        self.__goto: Optional[Tuple[Dict[int, int], Dict[str, int]]] = None
+        self.__dirty = False
+
+    def add(self, keyword):
+        keyword = _fold(keyword.strip())
+        if not keyword:
+            return
+        self.keywords.append(keyword)
+        self.__dirty = True
+
+    def parse(self, path):
+        with open(path) as f:
+            for keyword in f:
+                self.add(keyword.strip())
+        self.compile()
+
+    def compile(self):
+        """
+        构造自动机
+        """
+        alphabet: Dict[str, int] = {}
+        children: List[Dict[int, int]] = [{}]
+        out_len = [0]
+        for keyword in self.keywords:
+            state = 0
+            for char in keyword:
+                code = alphabet.setdefault(char, len(alphabet))
+                if (nxt := children[state].get(code)) is None:
+                    nxt = children[state][code] = len(children)
+                    children.append({})
+                    out_len.append(0)
+                state = nxt
+            out_len[state] = len(keyword)
+        total = len(children)
+        fail = [0] * total
+        out_link = [0] * total
+        queue = deque(children[0].values())
+        while queue:
+            state = queue.popleft()
+            for code, child in children[state].items():
+                f = fail[state]
+                while f and code not in children[f]:
+                    f = fail[f]
+                fail[child] = children[f].get(code, 0) if state else 0
+                out_link[child] = fail[child] if out_len[fail[child]] else out_link[fail[child]]
+                queue.append(child)
+        edge_start = array("i", [0])
+        edge_label = array("i")
+        edge_target = array("i")
+        for each in children:
+            for code in sorted(each):
+                edge_label.append(code)
+                edge_target.append(each[code])
+            edge_start.append(len(edge_label))
+        self.alphabet = alphabet
+        self.edge_start, self.edge_label, self.edge_target = edge_start, edge_label, edge_target
+        self.fail, self.out_len, self.out_link = array("i", fail), array("i", out_len), array("i", out_link)
+        self.__index()
+        self.__goto = None
+        self.__dirty = False
+        return self
+
+    def __index(self):
+        """
+        把CSR展开成`state*字符数+字符编号`为key的单层索引
+        以及每个state沿着fail链的全部输出
+        """
+        width = len(self.alphabet)
+        edge_start, edge_label = self.edge_start, self.edge_label
+        keys = array("q", [0] * len(edge_label))
+        for state in range(len(edge_start) - 1):
+            for j in range(edge_start[state], edge_start[state + 1]):
+                keys[j] = state * width + edge_label[j]
+        hit_start = array("i", [0])
+        hit_len = array("i")
+        out_len, out_link = self.out_len, self.out_link
+        for state in range(len(out_len)):
+            if out_len[state]:
+                hit_len.append(out_len[state])
+            hit = out_link[state]
+            while hit:
+                hit_len.append(out_len[hit])
+                hit = out_link[hit]
+            hit_start.append(len(hit_len))
+        self.goto_key, self.hit_start, self.hit_len = keys, hit_start, hit_len
+
+    def __runtime(self):
+        # 归一前的字符也直接映射到同一个编号, 匹配时就不需要再归一整个消息了
+        lookup = {}
+        for char, code in self.alphabet.items():
+            # 少数字符upper后不止一个字符(ß => SS), 只有本身
+            for each in {char, char.upper()} if len(char.upper()) == 1 else {char}:
+                for variant in [each, chr(ord(each) + 0xFEE0) if 0x21 <= ord(each) <= 0x7E else each]:
+                    if len(variant) == 1 and _fold(variant) == char:
+                        lookup.setdefault(variant, code)
+        if " " in self.alphabet:
+            lookup["\u3000"] = self.alphabet[" "]
+        self.__goto = dict(zip(self.goto_key, self.edge_target)), lookup
+
+    def find_all(self, message: str) -> List[Tuple[int, int]]:
+        """
+        按结尾位置依次返回所有命中的(start, end)(包括重叠的)
+        """
+        if self.__dirty:
+            self.compile()
+        if self.__goto is None:
+            self.__runtime()
+        goto, lookup = self.__goto
+        width, fail, hit_start, hit_len = len(self.alphabet), self.fail, self.hit_start, self.hit_len
+        ret = []
+        state = 0
+        i = 0
+        for char in message:
+            i += 1
+            code = lookup.get(char)
+            if code is None:
+                # 关键字里没有的字符直接回到起点
+                state = 0
+                continue
+            while (nxt := goto.get(state * width + code)) is None and state:
+                state = fail[state]
+            state = nxt or 0
+            for j in range(hit_start[state], hit_start[state + 1]):
+                length = hit_len[j]
+                ret.append((i - length, i))
+        return ret
+
+    def spans(self, message, must_no_keywords=False) -> List[Tuple[int, int]]:
+        """
+        最左最短且不重叠的命中
+        """
+        ret = []
+        last = 0
+        for start, end in sorted(self.find_all(message)):
+            if start < last:
+                continue
+            if must_no_keywords:
+                raise InvalidStringError("有敏感字[%s]" % message[start:end])
+            ret.append((start, end))
+            last = end
+        return ret
+
+    def filter(self, message, repl="*", must_no_keywords=False):
+        """
+        最左最短且不重叠的替换
+        """
+        return _mask(message, self.spans(message, must_no_keywords=must_no_keywords), repl)
+
+    def screen(self, message: str, repl="*") -> ScreenResult:
+        """
+        同时返回命中的关键字(归一后的)以及替换后的消息
+        """
+        spans = self.spans(message)
+        return {
+            "hits": [_fold(message[start:end]) for start, end in spans],
+            "text": _mask(message, spans, repl),
+        }
+
+    def filter_many(self, texts: Sequence[str], *, workers=1, repl="*", chunk_size=1000) -> List[ScreenResult]:
+        """
+        批量筛查
+        workers>1时fork出子进程, 直接继承已经编译好的自动机(写时复制)不需要再序列化
+        gevent的monkey patch下也可以用(等待结果时不阻塞hub), 只适合在任务进程里跑大批量
+        """
+        if self.__dirty:
+            self.compile()
+        if self.__goto is None:
+            # fork之前就准备好, 子进程共享
+            self.__runtime()
+        if workers <= 1 or len(texts) <= chunk_size:
+            return [self.screen(each, repl) for each in texts]
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        ret = []
+        for each in _fork_map(lambda x: [self.screen(text, repl) for text in x], chunks, min(workers, len(chunks))):
+            ret.extend(each)
+        return ret
+
+    def dump(self, path: str, checksum: int):
+        """
+        写入二进制缓存
+        """
+        if self.__dirty:
+            self.compile()
+        words = "\n".join(self.keywords).encode("utf8")
+        alphabet = "".join(sorted(self.alphabet, key=self.alphabet.get)).encode("utf8")
+        with open(path, "wb") as fout:
+            fout.write(ACFilter.__HEADER.pack(
+                ACFilter.MAGIC, ACFilter.VERSION, sys.byteorder == "little", checksum,
+                len(self.fail), len(self.edge_label), len(alphabet), len(words), len(self.hit_len),
+            ))
+            fout.write(alphabet)
+            fout.write(words)
+            for each in [self.edge_start, self.edge_label, self.edge_target, self.fail, self.out_len,
+                         self.out_link, self.goto_key, self.hit_start, self.hit_len]:
+                each.tofile(fout)
+
+    @classmethod
+    def load(cls, path: str, checksum: int) -> Optional['ACFilter']:
+        """
+        读取二进制缓存(校验不过返回None)
+        """
+        with open(path, "rb") as fin:
+            content = fin.read()
+        size = ACFilter.__HEADER.size
+        if len(content) < size:
+            return None
+        magic, version, little, _checksum, states, edges, alphabet_len, words_len, hits = \
+            ACFilter.__HEADER.unpack_from(content, 0)
+        if (magic, version, bool(little), _checksum) != (ACFilter.MAGIC, ACFilter.VERSION,
+                                                          sys.byteorder == "little", checksum):
+            return None
+        ret = cls()
+        offset = size
+        ret.alphabet = dict(map(lambda x: (x[1], x[0]),
+                                enumerate(content[offset:offset + alphabet_len].decode("utf8"))))
+        offset += alphabet_len
+        words = content[offset:offset + words_len].decode("utf8")
+        ret.keywords = words.split("\n") if words else []
+        offset += words_len
+        for prop, code, length in [("edge_start", "i", states + 1), ("edge_label", "i", edges),
+                                   ("edge_target", "i", edges), ("fail", "i", states), ("out_len", "i", states),
+                                   ("out_link", "i", states), ("goto_key", "q", edges),
+                                   ("hit_start", "i", states + 1), ("hit_len", "i", hits)]:
+            tmp = array(code)
+            tmp.frombytes(content[offset:offset + length * tmp.itemsize])
+            offset += length * tmp.itemsize
+            if len(tmp) != length:
+                return None
+            setattr(ret, prop, tmp)
+        return ret
+
+
+def load_filter(path: str, cache_path: Optional[str] = None) -> ACFilter:
+    """
+    优先读取预编译的缓存(以源文件的crc32校验)
+    缓存不可用时重新构建并尝试写入
+    """
+    cache_path = cache_path or f"{path}.ac"
+    with open(path, "rb") as fin:
+        checksum = zlib.crc32(fin.read())
+    if os.path.exists(cache_path):
+        try:
+            if ret := ACFilter.load(cache_path, checksum):
+                return ret
+        except (OSError, ValueError, struct.error):
+            pass
+    ret = ACFilter()
+    ret.parse(path)
+    try:
+        ret.dump(cache_path, checksum)
+    except OSError:
+        # 只读的环境就算了
+        pass
+    return ret
+
+
+__global_instance = None
+
+
+def instance():
+    """
+    :rtype :ACFilter
+    """
+    global __global_instance
+    if __global_instance is None:
+        __global_instance = load_filter(os.path.join(os.path.dirname(__file__), "words.dat"))
+    return __global_instance
+
+
+def filter_many(texts: Sequence[str], *, workers=1, repl="*", chunk_size=1000) -> List[ScreenResult]:
+    return instance().filter_many(texts, workers=workers, repl=repl, chunk_size=chunk_size)
+
+
+def benchmark(sizes=(10, 1000, 10000), messages=20000, length=64, workers=1, seed=0):
+    """
+    随机生成关键字和消息测试吞吐(msgs/sec)
+    """
+    rand = random.Random(seed)
+    charset = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处队南给色光门即保治北造百规热领七海口东导器压志世金增争济阶油思术极交受联什认六共权收证改清己美再采转更单风切打白教速花带安场身车例真务具万每目至达走积示议声报斗完类八离华名确才科张信马节话米整空元况今集温传土许步群广石记需段研界拉林律叫且究观越织装影算低持音众书布复容儿须际商非验连断深难近矿千周委素技备半办青省列习响约支般史感劳便团往酸历市克何除消构府称太准精值号率族维划选标写存候毛亲快效斯院查江型眼王按格养易置派层片始却专状育厂京识适属圆包火住调满县局照参红细引听该铁价严"
+    words = ["".join(rand.choice(charset) for _ in range(rand.randint(2, 6))) for _ in range(max(sizes))]
+    texts = ["".join(rand.choice(charset) for _ in range(length)) for _ in range(messages)]
+    ret = {}
+    for size in sizes:
+        tmp = ACFilter()
+        for each in words[:size]:
+            tmp.add(each)
+        tmp.compile()
+        tmp.filter_many(texts[:10])
+        start = time.time()
+        tmp.filter_many(texts, workers=workers)
+        ret[size] = messages / max(time.time() - start, 1e-6)
+        print(f"keywords={size} workers={workers} {ret[size]:.0f} msgs/sec")
+    return ret
+
+
+def test_first_character():
+    tmp = DFAFilter()
+    tmp.add("1989年")
+    assert tmp.filter("1989", "*") == "1989"
+    tmp = ACFilter()
+    tmp.add("1989年")
+    assert tmp.filter("1989", "*") == "1989"
+
+
+def test_ac_filter():
+    tmp = ACFilter()
+    for each in ["he", "she", "his", "hers", "ABC"]:
+        tmp.add(each)
+    assert tmp.find_all("ushers") == [(1, 4), (2, 4), (2, 6)]
+    assert tmp.filter("ushers") == "u***rs"
+    assert tmp.filter("Ｓhe ａｂｃ") == "*** ***"
+    texts = ["ushers", "hello", "Ｓhe ａｂｃ"] * 1000
+    ret = tmp.filter_many(texts, workers=2, chunk_size=100)
+    assert ret == tmp.filter_many(texts)
+    assert ret[0] == {"hits": ["she"], "text": "u***rs"}
+    assert ret[2] == {"hits": ["she", "abc"], "text": "*** ***"}
+    tmp = ACFilter()
+    tmp.add("straße")
+    assert tmp.filter("STRAßE straße") == "****** ******"
+
+
+def test_filter_many_patched():
+    """
+    app里总是monkey.patch_all(), 在子进程里验证不会卡死
+    """
+    import subprocess
+    code = """
+from gevent import monkey
+monkey.patch_all()
+import gevent
+from filter_keywords import ACFilter
+tmp = ACFilter()
+for each in ["he", "she", "abc"]:
+    tmp.add(each)
+texts = ["ushers", "hello", "Ｓhe ａｂｃ"] * 1000
+ticks = []
+tick = gevent.spawn(lambda: [ticks.append(gevent.sleep(0.001)) for _ in range(10)])
+assert tmp.filter_many(texts, workers=3, chunk_size=100) == tmp.filter_many(texts)
+tick.join()
+print("ok")
+"""
+    ret = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                         capture_output=True, text=True, timeout=60)
+    assert ret.stdout.strip() == "ok", ret.stderr
+
+
+def test_ac_cache():
+    import tempfile
+    tmp = ACFilter()
+    for each in ["he", "she", "his", "hers"]:
+        tmp.add(each)
+    with tempfile.TemporaryDirectory() as path:
+        tmp.dump(os.path.join(path, "words.ac"), 1)
+        cached = ACFilter.load(os.path.join(path, "words.ac"), 1)
+    assert cached.goto_key == tmp.goto_key and cached.hit_len == tmp.hit_len
+    assert cached.find_all("ushers") == tmp.find_all("ushers")
+
+
+if __name__ == "__main__":
+    # gfw = NaiveFilter()
+    # gfw = BSFilter()
+    gfw = instance()
+
+    t = time.time()
+    print(gfw.filter("法轮功 我操操操", "*"))
+    print(gfw.filter("针孔摄像机 我操操操", "*"))
+    print(gfw.filter("售假人民币 我操操操", "*"))
+    print(gfw.filter("传世私服 我操操操", "*"))
+    print(time.time() - t)
+
+    test_first_character()
+    test_ac_filter()
+    test_ac_cache()
+    test_filter_many_patched()
+    if "bench" in sys.argv:
+        benchmark()
+        benchmark(workers=os.cpu_count() or 1)
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 import random
-from collections import defaultdict
-from typing import List, Tuple, Union
+from array import array
+from bisect import bisect_right
+from collections import deque
+from typing import List, Tuple, Union, Dict, Deque, Iterator, Optional, Iterable
 
 
 class RandomConfig:
@@ -15,45 +17,279 @@ class RandomConfig:
         self.key_item_set = []  # type: List[Tuple[int,Union[int,Tuple[int,int]]]]
 
 
+def _counts(values) -> List[List[int]]:
+    """
+    按出现的顺序统计数量
+    """
+    ret: Dict[int, int] = {}
+    for each in values:
+        ret[each] = ret.get(each, 0) + 1
+    return [[k, v] for k, v in ret.items()]
+
+
+def _typecode(values: List[int]) -> str:
+    if not values:
+        return "H"
+    low, high = min(values), max(values)
+    if low >= 0 and high <= 0xFFFF:
+        return "H"
+    if -0x80000000 <= low and high <= 0x7FFFFFFF:
+        return "i"
+    return "q"
+
+
+def _generate(segment: Dict) -> List[int]:
+    """
+    展开旧格式的`all`分段, 新的分段用_Segment按位置直接计算
+    """
+    ret = list(segment["all"])
+    take = segment.get("take", -1)
+    return ret if take < 0 else ret[:take]
+
+
+def _length(segment: Dict) -> int:
+    total = len(segment["all"]) if "all" in segment else sum(map(lambda x: x[1], segment["items"]))
+    take = segment.get("take", -1)
+    return total if take < 0 else min(take, total)
+
+
+_MASK64 = (1 << 64) - 1
+
+
+class _Shuffle:
+    """
+    以种子确定的[0, n)上的伪随机排列(4轮Feistel + cycle-walking)
+    不需要展开也不需要洗牌, 每次O(1)(平均不超过4次walking)
+    """
+
+    def __init__(self, total: int, seed):
+        self.total = total
+        bits = max(2, (total - 1).bit_length())
+        bits += bits & 1
+        self.half = bits // 2
+        self.mask = (1 << self.half) - 1
+        rand = random.Random(seed)
+        self.keys = [rand.getrandbits(64) for _ in range(4)]
+
+    def __round(self, x: int, key: int) -> int:
+        x = (x * 0x9E3779B97F4A7C15 + key) & _MASK64
+        x ^= x >> 31
+        x = (x * 0xBF58476D1CE4E5B9) & _MASK64
+        x ^= x >> 29
+        return x & self.mask
+
+    def __getitem__(self, i: int) -> int:
+        half, mask = self.half, self.mask
+        while True:
+            left, right = i >> half, i & mask
+            for key in self.keys:
+                left, right = right, left ^ self.__round(right, key)
+            i = (left << half) | right
+            if i < self.total:
+                return i
+
+
+class _Segment:
+    """
+    一段序列的按位置访问
+    - 没有种子的按数量依次排列, 二分累计数量
+    - 有种子的用_Shuffle把位置映射到顺序排列上
+    - 有间隔(step)的只记录非0的块的起点(每个非0后面跟step个0), 块的值同样用_Shuffle决定
+    """
+
+    def __init__(self, segment: Dict):
+        self.length = _length(segment)
+        self.buffer: Optional[array] = None
+        if "all" in segment:
+            tmp = _generate(segment)
+            self.buffer = array(_typecode(tmp), tmp)
+            return
+        items = [(i, n) for i, n in segment["items"] if n > 0]
+        seed = segment.get("seed")
+        step = segment.get("step", 0) if seed is not None else 0
+        self.starts: Optional[array] = None
+        if step > 0:
+            # 块的值只在非0的里面排列
+            items = [(i, n) for i, n in items if i > 0]
+            blocks = sum(map(lambda x: x[1], items))
+            units = sum(map(lambda x: x[1], segment["items"])) - blocks * step
+            assert units >= blocks, "间隔太大了"
+            rand = random.Random(seed)
+            self.starts = array("q", sorted(rand.sample(range(units), blocks)))
+            for k in range(blocks):
+                self.starts[k] += k * step
+        self.values = [i for i, _ in items]
+        self.cumulative = []
+        total = 0
+        for _, n in items:
+            total += n
+            self.cumulative.append(total)
+        self.shuffle = _Shuffle(total, seed) if seed is not None and total > 1 else None
+
+    def __value(self, i: int) -> int:
+        if self.shuffle is not None:
+            i = self.shuffle[i]
+        return self.values[bisect_right(self.cumulative, i)]
+
+    def __getitem__(self, i: int) -> int:
+        if self.buffer is not None:
+            return self.buffer[i]
+        if self.starts is None:
+            return self.__value(i)
+        k = bisect_right(self.starts, i) - 1
+        if k >= 0 and self.starts[k] == i:
+            return self.__value(k)
+        return 0
+
+
+class Overdraft:
+    """
+    透支的记录 from => [to...]
+    兼容原来的`overdraft.append([f, t])`
+    """
+
+    def __init__(self, pairs: Optional[List[List[int]]] = None):
+        self.__map: Dict[int, Deque[int]] = {}
+        self.__len = 0
+        for each in pairs or []:
+            self.append(each)
+
+    def append(self, pair: List[int]):
+        f, t = pair
+        if (tmp := self.__map.get(f)) is None:
+            tmp = self.__map[f] = deque()
+        tmp.append(t)
+        self.__len += 1
+
+    def pop(self, f: int, default=None):
+        if (tmp := self.__map.get(f)) is None:
+            return default
+        ret = tmp.popleft()
+        if not tmp:
+            del self.__map[f]
+        self.__len -= 1
+        return ret
+
+    def __len__(self):
+        return self.__len
+
+    def __iter__(self) -> Iterator[List[int]]:
+        for f, tmp in self.__map.items():
+            for t in tmp:
+                yield [f, t]
+
+    def to_json(self) -> List[List[int]]:
+        return list(self)
+
+
 class RandomList:
     """
     严控的随机序列
     支持数量控制
     *支持区域控制
+    序列以(数量, 种子, 间隔)分段保存, next()按位置直接算出值(不展开整个序列)
     """
 
     def __init__(self):
-        self.__all = []
+        self.__segments: List[Dict] = []
+        self.__views: Optional[List[_Segment]] = None
+        # 每一段的起点
+        self.__offsets: List[int] = []
+        self.__len = 0
         self.__cur = 0
         # 透支的记录
-        self.__overdraft = []  # type:List[List[int]]
+        self.__overdraft = Overdraft()
 
     def to_json(self):
         return {
-            "all": self.__all,
+            "segments": self.__segments,
             "cur": self.__cur,
-            "overdraft": self.__overdraft,
+            "overdraft": self.__overdraft.to_json(),
         }
 
     def from_json(self, _json):
-        self.__all = _json.get("all", [])
+        if "segments" in _json:
+            self.__reset_segments(_json["segments"])
+        elif _all := _json.get("all", []):
+            # 旧格式
+            self.__reset_segments([{"all": _all}])
+        else:
+            self.__reset_segments([])
         self.__cur = _json["cur"]
-        self.__overdraft = _json.get("overdraft", [])
+        self.__overdraft = Overdraft(_json.get("overdraft", []))
+
+    def __reset_segments(self, segments: List[Dict]):
+        self.__segments = segments
+        self.__views = None
+        self.__offsets = []
+        self.__len = 0
+        for each in segments:
+            self.__offsets.append(self.__len)
+            self.__len += _length(each)
+
+    def __view(self, index: int) -> _Segment:
+        if self.__views is None:
+            self.__views = [None] * len(self.__segments)
+        if (ret := self.__views[index]) is None:
+            ret = self.__views[index] = _Segment(self.__segments[index])
+        return ret
+
+    def __get(self, i: int) -> int:
+        index = bisect_right(self.__offsets, i) - 1 if len(self.__offsets) > 1 else 0
+        return self.__view(index)[i - self.__offsets[index]]
+
+    def __range(self, start: int, end: int) -> Iterable[int]:
+        for i in range(start, end):
+            yield self.__get(i)
+
+    def __counts(self, start: int, end: int) -> List[List[int]]:
+        """
+        [start, end)里各个值的数量, 完整的没有截断的分段直接用items
+        """
+        ret: Dict[int, int] = {}
+        for index, segment in enumerate(self.__segments):
+            offset = self.__offsets[index]
+            length = _length(segment)
+            lo, hi = max(start, offset), min(end, offset + length)
+            if lo >= hi:
+                continue
+            if "items" in segment and segment.get("take", -1) < 0 and (lo, hi) == (offset, offset + length):
+                for i, n in segment["items"]:
+                    ret[i] = ret.get(i, 0) + n
+            else:
+                for each in self.__range(lo, hi):
+                    ret[each] = ret.get(each, 0) + 1
+        return [[k, v] for k, v in ret.items()]
+
+    def __prefix(self, cur: int) -> List[Dict]:
+        """
+        截取已经用掉的部分
+        """
+        ret = []
+        for each in self.__segments:
+            if cur <= 0:
+                break
+            length = _length(each)
+            if "all" in each:
+                # 旧格式只保留用掉的部分, 不再带着整个展开的序列
+                ret.append({"all": _generate(each)[:cur]})
+            elif length <= cur:
+                ret.append(each)
+            else:
+                ret.append(dict(each, take=cur))
+            cur -= length
+        return ret
 
     def reset(self):
         self.__cur = 0
 
     def next(self):
         cur = self.__cur
-        all_len = len(self.__all)
-        ret = self.__all[cur % all_len]
+        all_len = self.__len
+        ret = self.__get(cur % all_len)
         if len(self.__overdraft):
             # 映射透支
-            for i, (f, t) in enumerate(self.__overdraft):
-                if ret == f:
-                    ret = t
-                    del self.__overdraft[i]
-                    break
+            ret = self.__overdraft.pop(ret, ret)
 
         self.__cur = cur + 1
         if self.__cur > all_len:
@@ -68,60 +304,40 @@ class RandomList:
         else:
             config.cycle = sum(map(lambda x: x[1], config.items))
 
-        def flatten(src):
-            return [y for x in src for y in x]
-
         if force or self.__cur == 0:
-            self.__all = flatten(map(lambda x_y: [x_y[0] for _ in range(x_y[1])], config.items))
+            self.__reset_segments([{"items": list(map(list, config.items))}])
         else:
             # 需要剔除一部分再生成
-            old = defaultdict(lambda: 0)
-            for each in self.__all[:self.__cur]:
-                old[each] += 1
+            old = dict(map(tuple, self.__counts(0, self.__cur)))
             new_items = []
             for i, n in config.items:
-                assert i == 0 or old[i] <= n, "当前的环境不允许新配置了"
-                new_items.append((i, n - old[i]))
-            self.__all = self.__all[:self.__cur] + flatten(map(lambda x_y: [x_y[0] for _ in range(x_y[1])], new_items))
+                assert i == 0 or old.get(i, 0) <= n, "当前的环境不允许新配置了"
+                new_items.append([i, n - old.get(i, 0)])
+            self.__reset_segments(self.__prefix(self.__cur) + [{"items": new_items}])
 
         if shuffle:
             self.shuffle()
 
     def shuffle(self, min_step=0):
+        seed = random.getrandbits(32)
         if self.__cur == 0:
-            if min_step == 0:
-                random.shuffle(self.__all)
-            else:
-                true_list = list(filter(lambda x: x > 0, self.__all))
-                total = len(self.__all)
-                assert total >= len(true_list) * (min_step + 1)
-                true_list = list(map(lambda x: [x, 0], true_list))
-                # noinspection PyTypeChecker
-                new_list = true_list + [0 for _ in range(total - len(true_list) * (min_step + 1))]
-                random.shuffle(new_list)
-                tmp = []
-                for each in new_list:
-                    if isinstance(each, list):
-                        tmp.extend(each)
-                    else:
-                        tmp.append(each)
-                self.__all = tmp
+            self.__reset_segments([{"items": self.__counts(0, self.__len), "seed": seed, "step": min_step}])
         else:
-            rest = self.__all[self.__cur:]
-            random.shuffle(rest)
-            self.__all = self.__all[:self.__cur] + rest
+            self.__reset_segments(self.__prefix(self.__cur) + [
+                {"items": self.__counts(self.__cur, self.__len), "seed": seed}
+            ])
 
     def empty(self):
-        return len(self.__all) == 0
+        return self.__len == 0
 
     def rest(self):
-        return self.__all[self.__cur:]
+        return list(self.__range(self.__cur, self.__len))
 
     def all(self) -> List[int]:
-        return self.__all
+        return list(self.__range(0, self.__len))
 
     @property
-    def overdraft(self) -> List[List[int]]:
+    def overdraft(self) -> Overdraft:
         return self.__overdraft
 
     @property
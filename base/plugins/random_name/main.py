@@ -1,46 +1,40 @@
 import os
-import random
+from typing import Any
+
+from base.plugins.string_table import TablePool, string_table
 
 name_file = os.path.join(os.path.dirname(__file__), "name.txt")
 
 
-class RandomName:
-    def __init__(self):
-        self.__names = []
-        with open(name_file) as fin:
-            self.__names = list(map(lambda x: x.strip(), fin.readlines()))
-        random.shuffle(self.__names)
-        self.__cur = 0
-        self.__total = len(self.__names)
-
-    def one(self):
-        self.__cur = (self.__cur + 1) % self.__total
-        return self.__names[self.__cur]
-
-    def some(self, length=1):
-        start = self.__cur
-        self.__cur = (self.__cur + length) % self.__total
-        if length == 1:
-            return [self.__names[self.__cur]]
-        else:
-            if start + length < self.__total:
-                return self.__names[start:start + length]
-            else:
-                ret = []
-                for i in range(start, start + length):
-                    ret.append(self.__names[i % self.__total])
-                return ret
+class RandomName(TablePool):
+    """
+    名字表是mmap共享的, 每个实例只有自己的排列(种子)以及游标
+    """
+
+    def __init__(self, seed: Any = None):
+        TablePool.__init__(self, string_table(name_file), seed=seed)
 
     def dodge(self, nickname: str, scope=100):
         # todo: 通过避让避免假数据与真玩家碰面
         pass
 
 
-def instance():
-    return RandomName()
+def instance(seed: Any = None):
+    return RandomName(seed)
+
+
+__global_instance = None
+
 
+def __getattr__(name):
+    # 兼容原来模块级别的`name`, 第一次访问时才读取文件
+    global __global_instance
+    if name == "name":
+        if __global_instance is None:
+            __global_instance = instance()
+        return __global_instance
+    raise AttributeError(name)
 
-name = instance()
 
 if __name__ == "__main__":
-    print(name.some(10))
+    print(instance().some(10))
@@ -1,53 +1,48 @@
 import os
-import random
+from typing import Any, Dict
+
+from base.plugins.string_table import TablePool, string_table
 
 head_file = os.path.join(os.path.dirname(__file__), "user.txt")
 
 
-class RandomUser:
-    def __init__(self):
-        self.__users = []
-        with open(head_file) as fin:
-            def to_dict(x: str):
-                nickname, _, head = x.strip().rpartition(",")
-                return {
-                    "nickname": nickname,
-                    "head": head,
-                }
-
-            self.__users = list(map(to_dict, fin.readlines()))
-        random.shuffle(self.__users)
-        self.__cur = 0
-        self.__total = len(self.__users)
-
-    def one(self):
-        self.__cur = (self.__cur + 1) % self.__total
-        return self.__users[self.__cur]
-
-    def some(self, length=1):
-        start = self.__cur
-        self.__cur = (self.__cur + length) % self.__total
-        if length == 1:
-            return [self.__users[self.__cur]]
-        else:
-            if start + length < self.__total:
-                return self.__users[start:start + length]
-            else:
-                ret = []
-                for i in range(start, start + length):
-                    ret.append(self.__users[i % self.__total])
-                return ret
+def to_dict(x: str) -> Dict[str, str]:
+    nickname, _, head = x.strip().rpartition(",")
+    return {
+        "nickname": nickname,
+        "head": head,
+    }
+
+
+class RandomUser(TablePool):
+    """
+    用户表是mmap共享的, 每个实例只有自己的排列(种子)以及游标
+    """
+
+    def __init__(self, seed: Any = None):
+        TablePool.__init__(self, string_table(head_file), seed=seed, convert=to_dict)
 
     def dodge(self, nickname: str, scope=100):
         # todo: 通过避让避免假数据与真玩家碰面
         pass
 
 
-def instance():
-    return RandomUser()
+def instance(seed: Any = None):
+    return RandomUser(seed)
+
+
+__global_instance = None
+
 
+def __getattr__(name):
+    # 兼容原来模块级别的`user`, 第一次访问时才读取文件
+    global __global_instance
+    if name == "user":
+        if __global_instance is None:
+            __global_instance = instance()
+        return __global_instance
+    raise AttributeError(name)
 
-user = instance()
 
 if __name__ == "__main__":
-    print(user.some(10))
+    print(instance().some(10))
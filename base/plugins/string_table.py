@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+按行mmap的只读字符串表
+偏移量写在旁边的`.idx`文件里同样mmap, 多个进程共用同一份page cache
+"""
+import math
+import mmap
+import os
+import random
+import struct
+import sys
+import tempfile
+import zlib
+from array import array
+from typing import Dict, Sequence, Callable, Optional, Iterator, Union, Any
+
+
+class StringTable(Sequence):
+    MAGIC = b"STIX"
+    VERSION = 1
+    __HEADER = struct.Struct("<4sHBxII")
+
+    def __init__(self, path: str, index_path: Optional[str] = None):
+        self.path = path
+        with open(path, "rb") as fin:
+            self.data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(fin.fileno()).st_size else b""
+        self.__index_mm = None
+        index_path = index_path or f"{path}.idx"
+        checksum = zlib.crc32(self.data)
+        if not (os.path.exists(index_path) and self.__load_index(index_path, checksum)):
+            self.offsets = self.__build_index()
+            try:
+                self.__dump_index(index_path, checksum)
+                self.__load_index(index_path, checksum)
+            except OSError:
+                # 只读的环境就用进程内的
+                pass
+
+    def __build_index(self) -> array:
+        offsets = array("I", [0])
+        data = self.data
+        pos = data.find(b"\n")
+        while pos >= 0:
+            offsets.append(pos + 1)
+            pos = data.find(b"\n", pos + 1)
+        if offsets[-1] != len(data):
+            offsets.append(len(data))
+        return offsets
+
+    def __dump_index(self, path: str, checksum: int):
+        """
+        别的进程可能正mmap着旧的文件(截断会SIGBUS), 写到同目录的临时文件再原子的替换
+        """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.")
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                fout.write(StringTable.__HEADER.pack(StringTable.MAGIC, StringTable.VERSION,
+                                                     sys.byteorder == "little", checksum, len(self.offsets)))
+                self.offsets.tofile(fout)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def __load_index(self, path: str, checksum: int) -> bool:
+        with open(path, "rb") as fin:
+            if (size := os.fstat(fin.fileno()).st_size) < StringTable.__HEADER.size:
+                return False
+            mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        header = StringTable.__HEADER.unpack_from(mm, 0)
+        if header[:4] != (StringTable.MAGIC, StringTable.VERSION, sys.byteorder == "little", checksum) or \
+                size != StringTable.__HEADER.size + header[4] * 4:
+            mm.close()
+            return False
+        self.__index_mm = mm
+        self.offsets = memoryview(mm)[StringTable.__HEADER.size:].cast("I")
+        return True
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def raw(self, i: int) -> bytes:
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode("utf8").strip()
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self[i]
+
+
+class Permutation(Sequence):
+    """
+    以种子确定的排列 p(i) = (a * i + b) % n
+    a与n互质, 不需要额外的内存也不需要洗牌
+    """
+
+    def __init__(self, total: int, seed: Any = None):
+        rand = random.Random(seed)
+        self.total = total
+        self.a = 1
+        self.b = 0
+        if total > 1:
+            while True:
+                self.a = rand.randrange(1, total)
+                if math.gcd(self.a, total) == 1:
+                    break
+            self.b = rand.randrange(total)
+
+    def __len__(self) -> int:
+        return self.total
+
+    def __getitem__(self, i: int) -> int:
+        return (self.a * (i % self.total) + self.b) % self.total
+
+
+class TableView(Sequence):
+    """
+    表上的一段只读视图, 访问时才解码
+    """
+
+    def __init__(self, table: StringTable, indexes: Sequence[int], convert: Optional[Callable[[str], Any]] = None):
+        self.table = table
+        self.indexes = indexes
+        self.convert = convert
+
+    def __len__(self) -> int:
+        return len(self.indexes)
+
+    def __getitem__(self, i: Union[int, slice]):
+        if isinstance(i, slice):
+            return TableView(self.table, self.indexes[i], self.convert)
+        ret = self.table[self.indexes[i]]
+        return ret if self.convert is None else self.convert(ret)
+
+    def __iter__(self):
+        for i in range(len(self.indexes)):
+            yield self[i]
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class _Indexes(Sequence):
+    """
+    排列上从start开始的连续length个(会绕回)
+    """
+
+    def __init__(self, perm: Permutation, start: int, length: int):
+        self.perm = perm
+        self.start = start
+        self.length = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.length))]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return self.perm[self.start + i]
+
+
+class TablePool:
+    """
+    在共享的表上按各自的排列依次取
+    """
+
+    def __init__(self, table: StringTable, seed: Any = None, convert: Optional[Callable[[str], Any]] = None):
+        self.table = table
+        self.perm = Permutation(len(table), seed)
+        self.convert = convert
+        self.__cur = 0
+        self.__total = len(table)
+
+    def get(self, i: int):
+        ret = self.table[i]
+        return ret if self.convert is None else self.convert(ret)
+
+    def one(self):
+        self.__cur = (self.__cur + 1) % self.__total
+        return self.get(self.perm[self.__cur])
+
+    def some(self, length=1) -> TableView:
+        start = self.__cur
+        self.__cur = (self.__cur + length) % self.__total
+        if length == 1:
+            return TableView(self.table, [self.perm[self.__cur]], self.convert)
+        return TableView(self.table, _Indexes(self.perm, start, length), self.convert)
+
+    def sample(self, k: int, rand: random.Random = random) -> TableView:
+        """
+        不重复的随机抽取(不影响顺序取的游标)
+        """
+        return TableView(self.table, rand.sample(range(self.__total), k), self.convert)
+
+
+_pool: Dict[str, StringTable] = {
+
+}
+
+
+def string_table(path: str) -> StringTable:
+    path = os.path.realpath(path)
+    if (ret := _pool.get(path)) is None:
+        ret = _pool[path] = StringTable(path)
+    return ret
@@ -108,6 +108,80 @@ def load_class(full_name: str):
         return load_module(package_name).__dict__[class_name]
 
 
+class ImportProfiler:
+    """
+    类似`-X importtime`的统计, 只统计生效期间新加载的模块
+    包括自身耗时以及包含子模块的累计耗时
+    """
+
+    class _Loader:
+        def __init__(self, profiler: 'ImportProfiler', loader):
+            self.profiler = profiler
+            self.loader = loader
+
+        def __getattr__(self, item):
+            return getattr(self.loader, item)
+
+        def create_module(self, spec):
+            return self.loader.create_module(spec)
+
+        def exec_module(self, module):
+            # 恢复原本的loader, 避免影响之后的资源读取
+            module.__loader__ = self.loader
+            if module.__spec__ is not None:
+                module.__spec__.loader = self.loader
+            self.profiler.enter()
+            start = time.perf_counter()
+            try:
+                self.loader.exec_module(module)
+            finally:
+                self.profiler.leave(module.__name__, time.perf_counter() - start)
+
+    def __init__(self):
+        # 模块 => (自身, 累计)
+        self.cost: Dict[str, List[float]] = {}
+        self.total = 0
+        self.__children: List[float] = []
+        self.__start = 0
+
+    def enter(self):
+        self.__children.append(0)
+
+    def leave(self, name: str, cost: float):
+        children = self.__children.pop()
+        self.cost[name] = [cost - children, cost]
+        if self.__children:
+            self.__children[-1] += cost
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            if spec := finder.find_spec(fullname, path, target):
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = ImportProfiler._Loader(self, spec.loader)
+                return spec
+        return None
+
+    def __enter__(self):
+        sys.meta_path.insert(0, self)
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.total = time.perf_counter() - self.__start
+        sys.meta_path.remove(self)
+
+    def report(self, top=20) -> List[str]:
+        ret = [f"启动耗时[{self.total * 1000:.1f}ms]加载模块[{len(self.cost)}]",
+               f"{'self(ms)':>10} | {'cumulative(ms)':>14} | module"]
+        for name, (_self, cumulative) in sorted(self.cost.items(), key=lambda x: -x[1][0])[:top]:
+            ret.append(f"{_self * 1000:>10.1f} | {cumulative * 1000:>14.1f} | {name}")
+        for each in ret:
+            Log(each)
+        return ret
+
+
 def int_to_bytes(i) -> bytes:
     return bytes([(i >> 0) & 0xff, (i >> 8) & 0xff, (i >> 16) & 0xff, (i >> 24) & 0xff])
 
@@ -384,6 +384,9 @@ def wsgi_handler(environ, start_response, skip_status: Optional[Iterable[int]] =
         params.update(parse_form_url(cookies, split=';', prefix="c_"))
     params["$_ua"] = user_agent
     params["$_d-token"] = environ.get("HTTP_D_TOKEN", "")
+    if websocket := environ.get("wsgi.websocket"):
+        # 兼容gevent-websocket
+        params["$__websocket"] = websocket
     _ip = environ.get("HTTP_X_FORWARDED_FOR", environ.get("HTTP_X_REAL_IP", environ.get("REMOTE_ADDR", "0.0.0.0")))
     if "," in _ip:
         params["$ip_with_forwarded"] = _ip
@@ -1,35 +1,217 @@
 import json
 import os
-from abc import abstractmethod, ABC
+import time
+import uuid
+from abc import abstractmethod, ABC, ABCMeta
 from collections import OrderedDict, ChainMap
-from typing import Iterable, List, Optional, Type, Generic, Dict, Generator, final, Union
+from copy import deepcopy
+from operator import attrgetter
+from typing import Iterable, List, Optional, Type, Generic, Dict, Generator, final, Union, Set, Callable
 
+import gevent
 import pymongo
 
-from base.style import Fail, Assert, T, Block, Suicide, Log, str_json, is_debug, json_str, Error, clone_generator, \
-    some_list
+from base.cache import TTLCache
+from base.style import Fail, Assert, T, Block, Suicide, Log, str_json, is_debug, json_str, Error, some_list
 from frameworks.redis_mongo import mongo, db_counter, db_get_json, mapping_get, db_del, db_get, mongo_set, db_set, \
-    mapping_add, db_get_json_list, db_keys_iter, db_config
+    mapping_add, db_get_json_list, db_keys_iter, db_config, db_mgr, Subscribe, db_dirty, db_model_ex, \
+    mongo_index, bloom_enable, db_model, tiering_models
 
 DEBUG = os.environ.get("DEBUG", "FALSE") == "TRUE" or os.environ.get("TEST", "FALSE") == "TRUE"
 
 
-def _fetch_id(cls) -> int:
-    _id = db_counter('%s:__counter' % cls.__name__)
+# save时只标记dirty, 由modules.core的write-behind服务写回mongo
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND", "FALSE") == "TRUE"
+# 默认每个进程一次预留的id数量(1就是原来的逐个INCR)
+_ID_BLOCK = int(os.environ.get("MODEL_ID_BLOCK", "1"))
+# 进程内预留的id段 model => [next, end]
+_id_blocks: Dict[str, List[int]] = {}
+# snowflake: 41位毫秒时间戳 + 10位worker + 12位序号
+_SNOWFLAKE_EPOCH = 1577836800000
+_snowflake = {"worker": -1, "last": 0, "seq": 0}
+
+
+def _reset_ids():
+    # fork出来的子进程不能沿用父进程预留的段
+    _id_blocks.clear()
+    _snowflake.update(worker=-1, last=0, seq=0)
+
+
+os.register_at_fork(after_in_child=_reset_ids)
+
+
+def _check_counter(cls, _id: int):
     _orig = db_get(f"{cls.__name__}:{_id}", fail=False, model=cls.__name__)
     if _orig is not None:
         Log("[%s]出现counter倒退的情况了[%s][%s]" % (cls.__name__, _id, _orig))
         raise Fail("[%s]id重复错误[%s]" % (cls.__name__, _id))
-    return _id
+
+
+def _snowflake_ids(count: int) -> List[int]:
+    """
+    不依赖counter的id, 超过2^53了前端需要按字符串处理
+    """
+    if _snowflake["worker"] < 0:
+        _snowflake["worker"] = db_counter("__snowflake:worker") % 1024
+    ret = []
+    while len(ret) < count:
+        # 时钟回拨时沿用上一次的时间戳
+        now = max(int(time.time() * 1000) - _SNOWFLAKE_EPOCH, _snowflake["last"])
+        if now == _snowflake["last"]:
+            if _snowflake["seq"] >= 4095:
+                gevent.sleep(0.001)
+                continue
+            _snowflake["seq"] += 1
+        else:
+            _snowflake["last"], _snowflake["seq"] = now, 0
+        ret.append((now << 22) | (_snowflake["worker"] << 12) | _snowflake["seq"])
+    return ret
+
+
+def _fetch_ids(cls, count: int) -> List[int]:
+    """
+    按`Meta.id_block`一次INCRBY预留一段, 之后进程内分配, counter倒退的检查也只在每段的开头做一次
+    多进程下的id只保证唯一不保证按时间递增
+    `Meta.id_mode = "snowflake"`时不走counter
+    """
+    if cls.__id_mode__ == "snowflake":
+        return _snowflake_ids(count)
+    block = _id_blocks.get(cls.__name__)
+    ret = []
+    while len(ret) < count:
+        if block is None or block[0] > block[1]:
+            # 批量的一次把需要的都预留掉
+            size = max(cls.__id_block__, count - len(ret))
+            end = db_counter('%s:__counter' % cls.__name__, step=size)
+            block = _id_blocks[cls.__name__] = [end - size + 1, end]
+            _check_counter(cls, block[0])
+        take = min(count - len(ret), block[1] - block[0] + 1)
+        ret.extend(range(block[0], block[0] + take))
+        block[0] += take
+    return ret
+
+
+def _fetch_id(cls) -> int:
+    return _fetch_ids(cls, 1)[0]
+
+
+def _unique_key(name: str, field: str) -> str:
+    return f"{name}:__unique:{field}"
+
+
+def _index_op(pipe, name: str, field: str, _id: str, value, add: bool):
+    """
+    非唯一索引: 数值的放在score上, 字符串的按字典序(member是`value\0id`), 其他类型不索引
+    """
+    if isinstance(value, (int, float)):
+        key, member, score = f"{name}:__index:{field}", _id, value
+    elif isinstance(value, str):
+        key, member, score = f"{name}:__lex:{field}", f"{value}\0{_id}", 0
+    else:
+        return
+    if add:
+        pipe.zadd(key, {member: score})
+    else:
+        pipe.zrem(key, member)
+
+
+# L1(进程内)缓存的失效广播
+_l1_channel = "model:l1:invalidate"
+_l1_origin = uuid.uuid4().hex
+_l1_models: Dict[str, Type['BaseSaveModel']] = {}
+# def的重新加载广播
+_def_channel = "model:def:reload"
+_def_models: Dict[str, Type['RedisDef']] = {}
+_def_reload_pending: Set[str] = set()
+_subscribe_pool: Dict[str, Subscribe] = {
+
+}
+
+
+def _listen(channel: str, listener: Callable[[Dict], None]):
+    if (subscribe := _subscribe_pool.get(channel)) is None:
+        subscribe = _subscribe_pool[channel] = Subscribe(channel, redis=db_mgr)
+        subscribe.add_listener(listener)
+    if not subscribe.thread:
+        subscribe.run()
+
+
+def _json_clone(value):
+    """
+    比deepcopy快, 只处理json里会出现的容器
+    """
+    if isinstance(value, dict):
+        return {k: _json_clone(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_json_clone(v) for v in value]
+    return value
+
+
+def _l1_on_invalidate(data: Dict):
+    if data.get("origin") == _l1_origin:
+        # 自己写的已经更新过了
+        return
+    if (cls := _l1_models.get(data.get("model"))) is None:
+        return
+    cls.__l1_gen__ += 1
+    version = data.get("version", -1)
+    cached = cls.__l1__.peek(data["key"])
+    if version < 0 or cached is None or cached.get("version", 0) <= version:
+        cls.__l1__.delete(data["key"])
+
+
+def _l1_get(cls: Type['BaseSaveModel'], key: str) -> Optional[Dict]:
+    """
+    先查L1, 没有再读redis并回填
+    读redis期间有失效广播的话不回填, 避免把旧值放回去
+    """
+    _listen(_l1_channel, _l1_on_invalidate)
+    if (ret := cls.__l1__.get(key)) is None:
+        gen = cls.__l1_gen__
+        if (ret := db_get_json(key, fail=False, model=cls.__name__)) is None:
+            return None
+        if gen == cls.__l1_gen__:
+            cls.__l1__.set(key, ret)
+    return _json_clone(ret)
+
+
+def _l1_publish(cls: Type['BaseSaveModel'], key: str, version: int):
+    db_mgr.publish(_l1_channel, json_str({
+        "model": cls.__name__,
+        "key": key,
+        "version": version,
+        "origin": _l1_origin,
+    }))
+
+
+def _def_on_reload(data: Dict):
+    """
+    合并短时间内的多次推送只加载一次
+    """
+    if (cls := _def_models.get(data.get("model"))) is None or cls.__name__ in _def_reload_pending:
+        return
+    _def_reload_pending.add(cls.__name__)
+
+    def delay():
+        gevent.sleep(0.2)
+        _def_reload_pending.discard(cls.__name__)
+        with Block(f"重新加载def[{cls.__name__}]", fail=False):
+            cls.reload_redis()
+
+    gevent.spawn(delay)
 
 
 class BaseModel(Generic[T]):
     """
     包含一个id字段的对象
     """
+    # 保留__dict__, 没有声明slots的子类照旧
+    __slots__ = ("__dict__", "__name__", "__id", "__key", "__set_id", "__orig", "__version")
     __models = {}
     __fields__ = []
     __len = 0
+    __id_block__ = _ID_BLOCK
+    __id_mode__ = "counter"
 
     def __enter__(self):
         return self
@@ -45,6 +227,9 @@ class BaseModel(Generic[T]):
             if isinstance(v, property):
                 cls.__fields__.append(k)
         cls.__len = len(cls.__fields__)
+        meta = getattr(cls, "Meta", None)
+        cls.__id_block__ = max(1, getattr(meta, "id_block", _ID_BLOCK))
+        cls.__id_mode__ = getattr(meta, "id_mode", "counter")
 
     def __init__(self):
         super().__init__()
@@ -59,14 +244,9 @@ class BaseModel(Generic[T]):
     def _fetch_id(cls) -> int:
         """
         基于redis实现的计数器
-        todo: 现在还是自然数序列后面可以改改发生规则
+        按`Meta.id_block`批量预留或者`Meta.id_mode = "snowflake"`
         """
-        _id = db_counter('%s:__counter' % cls.__name__, get_only=False)
-        _orig = db_get(cls.__name__ + ":" + str(_id), fail=False, model=cls.__name__)
-        if _orig is not None:
-            Log("[%s]出现counter倒退的情况了[%s][%s]" % (cls.__name__, _id, _orig))
-            raise Fail("[%s]id重复错误[%s]" % (cls.__name__, _id))
-        return _id
+        return _fetch_id(cls)
 
     @final
     @property
@@ -106,6 +286,9 @@ class BaseModel(Generic[T]):
     def get_orig(self):
         return self.__orig
 
+    def set_orig(self, orig: Dict):
+        self.__orig = orig
+
     def to_json(self) -> dict:
         ret = {"id": self.__id, "version": self.__version}
         self._to_json(ret)
@@ -157,19 +340,27 @@ class BaseDef(BaseModel, ABC):
     """
     静态配置
     除非触发重加载否则不变
+    pool是不可变的快照, 重加载时在旁边构建好再整体替换(generation+1)
     """
+    __slots__ = ("__inited",)
     __pool__: Dict[str, any] = {}
+    __staging__: Optional[Dict[str, any]] = None
+    __generation__ = 0
 
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
         cls.__pool__ = OrderedDict()
+        cls.__staging__ = None
+        cls.__generation__ = 0
 
     def __init__(self, _id: Union[str, int]):
         super().__init__()
         self.set_id(_id)
         self.__inited = False
-        Assert(_id not in self.__pool__, f"重复的def[{self.__name__}:{_id}]")
-        self.__pool__[str(_id)] = self
+        # 重加载期间写入构建中的pool
+        pool = self.__pool__ if self.__staging__ is None else self.__staging__
+        Assert(_id not in pool, f"重复的def[{self.__name__}:{_id}]")
+        pool[str(_id)] = self
 
     def to_json(self) -> Dict:
         self._to_json(ret := {"id": self.get_id()})
@@ -186,40 +377,96 @@ class BaseDef(BaseModel, ABC):
         if not (auto_new is False and fail is True):
             if DEBUG:
                 raise Fail("Def不支持auto_new以及none返回")
-        if _id not in cls.__pool__:
+        if (ret := cls.__pool__.get(_id)) is None:
             raise Fail(f"找不到def[{cls.__name__}:{_id}]")
-        return cls.__pool__[_id]
+        return ret
 
     @classmethod
     def all(cls: Type[T]) -> Generator[T, None, None]:
         for each in cls.__pool__.values():
             yield each
 
+    @classmethod
+    def generation(cls) -> int:
+        return cls.__generation__
+
     @classmethod
     def by_json(cls: Type[T], json_data: Dict[str, any]) -> T:
         return cls(json_data["id"]).from_json(json_data)
 
     @classmethod
     def reset_pool(cls):
-        cls.__pool__.clear()
+        cls.__pool__ = OrderedDict()
+        cls.__generation__ += 1
 
     @classmethod
-    def reload_def(cls, content: List[Dict], reset=True):
+    def reload_def(cls, content: List[Dict], reset=True, remove: Iterable[str] = ()):
+        """
+        reset=False时只替换content里的以及剔除remove里的, 其他的对象保持不变
+        已经拿到旧对象的请求不受影响
+        """
         header_set = set(["id"] + cls.__fields__)
         for each in content:
             Assert(set(each.keys()) >= header_set, "csv的字段和def不匹配")
-        if reset:
-            cls.reset_pool()
-        for value in content:
-            _id = value["id"]
-            if obj := cls.__pool__.get(_id):  # type: BaseDef
-                obj.__inited = False
-                obj.from_json(value)
-            else:
+        pool = OrderedDict() if reset else OrderedDict(cls.__pool__)
+        for _id in remove:
+            pool.pop(str(_id), None)
+        cls.__staging__ = pool
+        try:
+            for value in content:
+                pool.pop(str(value["id"]), None)
                 cls.by_json(value)
+        finally:
+            cls.__staging__ = None
+        cls.__pool__ = pool
+        cls.__generation__ += 1
 
 
 class BaseSaveModel(BaseModel, ABC):
+    """
+    需要持久化的对象
+    可以通过Meta开启L1(进程内)缓存, 适合读多写少的配置类node
+        class Meta:
+            l1_ttl_ms = 1000
+            l1_max = 1024
+    批量新建的(比如日志类的info)可以每个进程预留一段id
+        class Meta:
+            id_block = 1000
+    二级索引(save时维护, 通过by_index/range查询)
+        class Meta:
+            indexes = ["level", "name"]
+            unique = ["email"]
+            mongo_indexes = [("level", "name")]
+    redis里没有的时候先用bloom确认mongo里可能有再去查(需要定期的BloomRebuildTask)
+        class Meta:
+            bloom = True
+    冷热分层(TieringMgr)默认可以下沉, 不需要的
+        class Meta:
+            tiering = False
+    """
+    __slots__ = ()
+    __l1__: Optional[TTLCache] = None
+    __l1_gen__ = 0
+    __indexes__: Dict[str, bool] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        meta = getattr(cls, "Meta", None)
+        if (l1_ttl_ms := getattr(meta, "l1_ttl_ms", 0)) > 0:
+            cls.__l1__ = TTLCache(l1_ttl_ms / 1000, getattr(meta, "l1_max", 1024), name=f"l1:{cls.__name__}")
+            cls.__l1_gen__ = 0
+            _l1_models[cls.__name__] = cls
+        else:
+            cls.__l1__ = None
+        if getattr(meta, "bloom", False):
+            bloom_enable(cls.__name__, getattr(meta, "bloom_bits", 0))
+        if getattr(meta, "tiering", True):
+            tiering_models.add(cls.__name__)
+        else:
+            tiering_models.discard(cls.__name__)
+        # 字段 => 是否唯一
+        cls.__indexes__ = {k: False for k in getattr(meta, "indexes", ())}
+        cls.__indexes__.update({k: True for k in getattr(meta, "unique", ())})
 
     # noinspection PyMethodMayBeStatic
     def mapping1(self) -> Optional[str]:
@@ -230,19 +477,135 @@ class BaseSaveModel(BaseModel, ABC):
         """
         return None
 
-    # noinspection PyMethodMayBeStatic
     def mapping_list(self) -> List[str]:
         """
-        所有的索引字段
-        主要是针对mongo的
-        毕竟redis无法实现
+        所有的索引字段(Meta里声明的indexes/unique)
         一般的model不建议用因为会加大save的压力
-        对应的索引也不在要求包整唯一了仅仅是索引而已
         """
-        return []
+        return list(self.__indexes__)
 
     def append_mapping(self, raw: Dict):
-        pass
+        """
+        按上一次保存的值维护索引
+        唯一索引先占位, 冲突时回滚已经占的并且Fail(此时还没有写入redis)
+        """
+        orig = self.get_orig() or {}
+        _id = self.get_id()
+        changed = [(k, orig.get(k), raw.get(k), unique) for k, unique in self.__indexes__.items()
+                   if orig.get(k) != raw.get(k)]
+        claimed = []
+        for field, _, new, unique in changed:
+            if not unique or new is None:
+                continue
+            key = _unique_key(self.__name__, field)
+            if not db_model_ex.hsetnx(key, str(new), _id) and db_model_ex.hget(key, str(new)) != _id:
+                for each in claimed:
+                    db_model_ex.hdel(*each)
+                raise Fail(f"唯一索引冲突[{self.__name__}.{field}={new}]")
+            claimed.append((key, str(new)))
+        pipe = db_model_ex.pipeline(transaction=False)
+        for field, old, new, unique in changed:
+            if unique:
+                if old is not None:
+                    pipe.hdel(_unique_key(self.__name__, field), str(old))
+            else:
+                _index_op(pipe, self.__name__, field, _id, old, add=False)
+                _index_op(pipe, self.__name__, field, _id, new, add=True)
+        pipe.execute()
+
+    def remove_mapping(self):
+        orig = self.get_orig() or {}
+        pipe = db_model_ex.pipeline(transaction=False)
+        for field, unique in self.__indexes__.items():
+            if (old := orig.get(field)) is None:
+                continue
+            if unique:
+                pipe.hdel(_unique_key(self.__name__, field), str(old))
+            else:
+                _index_op(pipe, self.__name__, field, self.get_id(), old, add=False)
+        pipe.execute()
+
+    @classmethod
+    def ids_by_index(cls, field: str, value, limit=100, offset=0) -> List[str]:
+        Assert(field in cls.__indexes__, f"[{cls.__name__}.{field}]没有索引")
+        if cls.__indexes__[field]:
+            ret = db_model_ex.hget(_unique_key(cls.__name__, field), str(value))
+            return [ret] if ret is not None and offset == 0 and limit > 0 else []
+        if isinstance(value, (int, float)):
+            return db_model_ex.zrangebyscore(f"{cls.__name__}:__index:{field}", value, value, start=offset, num=limit)
+        return cls.ids_by_range(field, value, value, limit=limit, offset=offset)
+
+    @classmethod
+    def ids_by_range(cls, field: str, lo=None, hi=None, limit=100, offset=0, reverse=False) -> List[str]:
+        """
+        数值的按score, 字符串的按字典序(lo/hi都是闭区间, None表示不限)
+        """
+        Assert(cls.__indexes__.get(field) is False, f"[{cls.__name__}.{field}]没有非唯一索引")
+        if isinstance(lo, str) or isinstance(hi, str):
+            key = f"{cls.__name__}:__lex:{field}"
+            _min = "-" if lo is None else f"[{lo}\0"
+            _max = "+" if hi is None else f"({hi}\1"
+            if reverse:
+                ret = db_model_ex.zrevrangebylex(key, _max, _min, start=offset, num=limit)
+            else:
+                ret = db_model_ex.zrangebylex(key, _min, _max, start=offset, num=limit)
+            return [x.rpartition("\0")[2] for x in ret]
+        key = f"{cls.__name__}:__index:{field}"
+        _min = "-inf" if lo is None else lo
+        _max = "+inf" if hi is None else hi
+        if reverse:
+            return db_model_ex.zrevrangebyscore(key, _max, _min, start=offset, num=limit)
+        return db_model_ex.zrangebyscore(key, _min, _max, start=offset, num=limit)
+
+    @classmethod
+    def __by_ids(cls: Type[T], ids: List[str]) -> List[T]:
+        if not ids:
+            return []
+        tmp = db_get_json_list([f"{cls.__name__}:{x}" for x in ids], model=cls.__name__)
+        return [cls().from_json(each) for each in tmp]
+
+    @classmethod
+    def by_index(cls: Type[T], field: str, value, limit=100, offset=0) -> List[T]:
+        return cls.__by_ids(cls.ids_by_index(field, value, limit=limit, offset=offset))
+
+    @classmethod
+    def range(cls: Type[T], field: str, lo=None, hi=None, limit=100, offset=0, reverse=False) -> List[T]:
+        return cls.__by_ids(cls.ids_by_range(field, lo, hi, limit=limit, offset=offset, reverse=reverse))
+
+    @classmethod
+    def ensure_mongo_index(cls):
+        """
+        声明的索引以及Meta.mongo_indexes(复合索引)同步到mongo
+        """
+        for field, unique in cls.__indexes__.items():
+            mongo_index(cls.__name__, field, unique=unique)
+        for each in getattr(getattr(cls, "Meta", None), "mongo_indexes", ()):
+            mongo_index(cls.__name__, list(each))
+
+    @classmethod
+    def rebuild_index(cls) -> int:
+        """
+        补上声明索引之前保存的数据(redis里的以及mongo里的)
+        """
+        cls.ensure_mongo_index()
+        seen = set()
+        fields = list(cls.__indexes__)
+
+        def update(_json: Dict):
+            if _json["id"] in seen:
+                return
+            seen.add(_json["id"])
+            with Block(f"重建索引[{cls.__name__}:{_json['id']}]", fail=False):
+                (tmp := cls()).set_str_id(_json["id"])
+                tmp.append_mapping({k: _json.get(k) for k in fields})
+
+        for key in db_keys_iter(cls.__name__ + ":*"):
+            if (_json := db_get_json(key, fail=False)) is not None and "id" in _json:
+                update(_json)
+        for each in cls.get_mongo().find({}, ["id"] + fields):
+            if "id" in each:
+                update(each)
+        return len(seen)
 
     @classmethod
     def last_id(cls) -> int:
@@ -272,6 +635,8 @@ class BaseSaveModel(BaseModel, ABC):
                 # 附加一个_key
                 raw["_key"] = mapping1
                 value = json_str(raw)
+        if self.mapping_list():
+            self.append_mapping(raw)
         if save_redis:
             if is_debug():
                 # 调试版本支持更严格的版本限制
@@ -285,11 +650,15 @@ class BaseSaveModel(BaseModel, ABC):
                                 else:
                                     Log(f"orig data [{key}=>{orig}]")
                                     Error(f"node[{self.__class__.__name__}]出现复写问题")
+            # 写入redis以后读取就不会再走到mongo以及不存在的标记了
             db_set(key, value)
-        if self.mapping_list():
-            self.append_mapping(raw)
+            if self.__l1__ is not None:
+                self.__l1__.set(key, str_json(value))
+                _l1_publish(self.__class__, key, raw.get("version", 0))
         if mongo_right_now:
             mongo_set(self.get_key(), raw, model=self.__name__)
+        # 下一次save的索引/mapping1以这次为准
+        self.set_orig(raw)
         self.dirty()
         return self
 
@@ -320,21 +689,32 @@ class BaseSaveModel(BaseModel, ABC):
             else:
                 return None
 
-    # noinspection PyMethodMayBeStatic
     def dirty(self):
+        """
+        开启WRITE_BEHIND时标记, 由write-behind服务批量写回mongo
+        """
+        if WRITE_BEHIND:
+            return db_dirty(self.__name__, self.get_key())
         return False
 
     def remove(self) -> bool:
         # noinspection PyUnresolvedReferences
         if not self.is_set_id():
             raise Fail("没有找到这个数据")
-        return db_del(self.get_key())
+        ret = db_del(self.get_key())
+        if self.__indexes__:
+            self.remove_mapping()
+        if self.__l1__ is not None:
+            self.__l1__.delete(self.get_key())
+            _l1_publish(self.__class__, self.get_key(), -1)
+        return ret
 
 
 class BaseNode(BaseSaveModel, ABC):
     """
     id与具体用户绑定
     """
+    __slots__ = ()
     _auto_new = False
 
     @classmethod
@@ -345,16 +725,62 @@ class BaseNode(BaseSaveModel, ABC):
         适合配置之类的少量node
         :return:
         """
-        return cls.by_str_id_list(
-            list(map(
-                lambda x: x[len(cls.__name__ + ":"):],
-                some_list(db_keys_iter(cls.__name__ + ":*"), limit=limit)
-            ))
-        )
+        return {each.id: each for each in some_list(cls.iter_all(batch=limit), limit=limit)}
+
+    @classmethod
+    def iter_all(cls: Type[T], batch=1000, *, with_mongo=False) -> Generator[T, None, None]:
+        """
+        流式的遍历所有的node, 可以直接作为SimpleGroupBulkTask.group()
+            def group(self):
+                return SomeNode.iter_all(batch=self.step())
+        redis里的: 下一次SCAN与这一批的MGET在同一次往返里, 取出来的时候才解码
+        with_mongo: 再按_id排序的游标补上只在mongo里的(redis里有的跳过)
+        遍历期间新增/删除的遵循SCAN的语义(可能遗漏或者重复)
+        """
+        prefix = cls.__name__ + ":"
+        cursor, keys = db_model.scan(0, match=prefix + "*", count=batch)
+        while True:
+            pipe = db_model.pipeline(transaction=False)
+            if cursor:
+                pipe.scan(cursor, match=prefix + "*", count=batch)
+            if keys:
+                pipe.mget(keys)
+            result = pipe.execute() if len(pipe) else []
+            values = result.pop() if keys else []
+            for value in values:
+                if value is not None:
+                    yield cls().from_json(str_json(value))
+            if not cursor:
+                break
+            cursor, keys = result[0]
+        if not with_mongo:
+            return
+        tmp = []
+
+        def merge():
+            pipe = db_model.pipeline(transaction=False)
+            for each in tmp:
+                pipe.exists(each["_id"])
+            for each, exists in zip(tmp, pipe.execute()):
+                if not exists:
+                    yield cls().from_json(each)
+            tmp.clear()
+
+        for doc in mongo(cls.__name__).find({"_id": {"$gte": prefix, "$lt": cls.__name__ + ";"}},
+                                            sort=[("_id", pymongo.ASCENDING)], batch_size=batch):
+            tmp.append(doc)
+            if len(tmp) >= batch:
+                yield from merge()
+        yield from merge()
 
     @classmethod
     def by_str_id(cls: Type[T], _id: str, auto_new=False, fail=True) -> Optional[T]:
-        if (_json := db_get_json(cls.__name__ + ":" + _id, fail=False, model=cls.__name__)) is None:
+        key = cls.__name__ + ":" + _id
+        if cls.__l1__ is not None:
+            _json = _l1_get(cls, key)
+        else:
+            _json = db_get_json(key, fail=False, model=cls.__name__)
+        if _json is None:
             if auto_new or getattr(cls, "_auto_new", None):
                 (ret := cls()).set_str_id(_id)
                 if auto_new:
@@ -427,6 +853,7 @@ class BaseInfo(BaseSaveModel, ABC):
     """
     id 纯自增无意义的数据
     """
+    __slots__ = ()
 
     def __init__(self):
         super().__init__()
@@ -437,7 +864,11 @@ class BaseInfo(BaseSaveModel, ABC):
 
     @classmethod
     def by_id(cls: Type[T], _id: int, auto_new=False, fail=True) -> Optional[T]:
-        _json = db_get_json(cls.__name__ + ":" + str(_id), fail=False, model=cls.__name__)
+        key = cls.__name__ + ":" + str(_id)
+        if cls.__l1__ is not None:
+            _json = _l1_get(cls, key)
+        else:
+            _json = db_get_json(key, fail=False, model=cls.__name__)
         if _json is None:
             Assert(auto_new is False, "info不支持auto_new")
             if fail:
@@ -458,6 +889,19 @@ class BaseInfo(BaseSaveModel, ABC):
             info.save()
         return info
 
+    @classmethod
+    def new_many(cls: Type[T], count: int, save_right_now=False) -> List[T]:
+        """
+        一次预留count个id
+        """
+        ret = []
+        for _id in _fetch_ids(cls, count):
+            (info := cls()).set_id(_id)
+            ret.append(info)
+            if save_right_now:
+                info.save()
+        return ret
+
 
 class BaseDetail(BaseModel):
     """
@@ -491,40 +935,123 @@ class BaseDetail(BaseModel):
         pass
 
 
-def _getter(orig_getter, fields):
-    def func(self, prop: str):
-        if prop.startswith("__"):
-            return orig_getter(self, prop)
-        elif prop in fields:
-            return orig_getter(self, f"__{prop}")
-        else:
-            return orig_getter(self, prop)
+_IMMUTABLE = {int, str, bool, float, bytes, type(None)}
 
-    return func
 
+def _is_immutable(value) -> bool:
+    if type(value) in _IMMUTABLE:
+        return True
+    return type(value) in {tuple, frozenset} and all(map(_is_immutable, value))
 
-def _setter(orig_setter, fields):
-    def func(self, prop: str, value):
-        if prop.startswith("__"):
-            orig_setter(self, prop, value)
-        elif prop in fields:
-            orig_setter(self, f"__{prop}", value)
-        else:
-            orig_setter(self, prop, value)
+
+def _default_factory(value) -> Optional[Callable]:
+    """
+    字段默认值的复制方式
+    不可变的直接共用(None), 只有一层的容器浅拷贝, 嵌套的才deepcopy
+    """
+    if _is_immutable(value):
+        return None
+    if type(value) in {list, set}:
+        return type(value) if all(map(_is_immutable, value)) else deepcopy
+    if type(value) is dict:
+        return dict if all(map(_is_immutable, value.values())) else deepcopy
+    return deepcopy
+
+
+def _is_simple_field(k, v) -> bool:
+    if not isinstance(k, str) or k.startswith("_") or k in {"Meta", "mapping1"}:
+        return False
+    # 方法不是字段(比如RedisDef的save/reload_redis)
+    return not (callable(v) or isinstance(v, (classmethod, staticmethod, property)))
+
+
+def _missing_field(self, field: str, _json_data: Dict):
+    raise Fail(f"Def[{self.__class__.__name__}::{field}]缺失[{_json_data=}]")
+
+
+def _readonly_setter(title: str):
+    def func(_self, _value):
+        raise Fail(title)
 
     return func
 
 
-def _fail_setter(orig_setter, fields, title: str):
-    def func(self, prop: str, value):
-        if prop.startswith("__"):
-            orig_setter(self, prop, value)
-        elif prop in fields:
-            raise Fail(title % prop)
+def _simple_codegen(name: str, fields: List[str], defaults: Dict[str, any], readonly: bool) -> Dict[str, Callable]:
+    """
+    按字段展开的`__init_fields__`/`_to_json`/`_from_json`
+    """
+    scope = {"_missing_field": _missing_field}
+    init = ["def __init_fields__(self):"]
+    to_json = ["def _to_json(self, _json_data):"]
+    from_json = ["def _from_json(self, _json_data):"]
+    for i, k in enumerate(fields):
+        slot = f"_slot_{k}" if readonly else k
+        scope[f"_d{i}"] = defaults[k]
+        if (factory := _default_factory(defaults[k])) is None:
+            init.append(f"    self.{slot} = _d{i}")
+        else:
+            scope[f"_f{i}"] = factory
+            init.append(f"    self.{slot} = _f{i}(_d{i})")
+        to_json.append(f"    _json_data[{k!r}] = self.{slot}")
+        if readonly:
+            from_json.append(f"    value = _json_data.get({k!r})")
+            from_json.append(f"    if not value and {k!r} not in _json_data:")
+            from_json.append(f"        _missing_field(self, {k!r}, _json_data)")
+            from_json.append(f"    self.{slot} = value")
         else:
-            orig_setter(self, prop, value)
+            from_json.append(f"    if {k!r} in _json_data:")
+            from_json.append(f"        self.{slot} = _json_data[{k!r}]")
+    src = "\n\n".join("\n".join(x + ["    pass"]) for x in [init, to_json, from_json])
+    exec(compile(src, f"<simple:{name}>", "exec"), scope)
+    ret = {}
+    for each in ["__init_fields__", "_to_json", "_from_json"]:
+        ret[each] = scope[each]
+        ret[each].__qualname__ = f"{name}.{each}"
+    return ret
+
+
+class _SimpleMeta(ABCMeta):
+    """
+    Simple*的字段在类创建时就转成真正的`__slots__`(实例不再需要__dict__)
+    每个类按字段生成各自的`__init_fields__`/`_to_json`/`_from_json`
+    `__readonly_fields__`的(def)字段只读, 存放在`_slot_xxx`里
+    """
 
-    return func
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        readonly = namespace.get("__readonly_fields__") or any(
+            getattr(base, "__readonly_fields__", False) for base in bases)
+        fields = []
+        defaults = {}
+        for base in reversed(bases):
+            if isinstance(base, _SimpleMeta):
+                for k in base.__fields__:
+                    if k not in defaults:
+                        fields.append(k)
+                    defaults[k] = base.__field_defaults__[k]
+        inherited = set(fields)
+        own = [k for k, v in namespace.items() if _is_simple_field(k, v)]
+        annotations = set(filter(lambda x: not x.startswith("_"), namespace.get("__annotations__", [])))
+        if diff_set := annotations - set(own):
+            if is_debug():
+                raise Fail(f"检查[{name}][{','.join(diff_set)}]是否写默认值")
+        for k in own:
+            defaults[k] = namespace.pop(k)
+            if k not in inherited:
+                fields.append(k)
+        slots = [k for k in own if k not in inherited]
+        if readonly:
+            namespace["__slots__"] = tuple(f"_slot_{k}" for k in slots)
+            for k in own:
+                namespace[k] = property(attrgetter(f"_slot_{k}"), _readonly_setter(f"[{name}::{k}]不支持setter"))
+        else:
+            namespace["__slots__"] = tuple(slots)
+        for k, v in _simple_codegen(name, fields, defaults, readonly).items():
+            # 手写的优先
+            namespace.setdefault(k, v)
+        cls = super().__new__(mcs, name, bases, namespace, **kwargs)
+        cls.__fields__ = fields
+        cls.__field_defaults__ = defaults
+        return cls
 
 
 class SimpleModel:
@@ -555,137 +1082,41 @@ class SimpleModel:
     }
 
 
-class SimpleDef(BaseDef, ABC):
+class SimpleDef(BaseDef, ABC, metaclass=_SimpleMeta):
     """
     常规def
     不需要啥额外的定制的def
     """
+    __readonly_fields__ = True
 
-    # noinspection DuplicatedCode
-    def __init_subclass__(cls, **kwargs):
-        super().__init_subclass__(**kwargs)
-        fields = []
-        for k, v in cls.__dict__.items():
-            if isinstance(k, str) and not k.startswith("_"):
-                fields.append(k)
-        cls.__orig_setter__ = cls.__setattr__
-        cls.__setattr__ = _fail_setter(cls.__setattr__, fields, f"[{cls.__name__}::%s]不支持setter")
-        cls.__orig_getter__ = cls.__getattribute__
-        cls.__getattribute__ = _getter(cls.__getattribute__, fields)
-        cls.__slots__ = fields
-        for each in fields:
-            setattr(cls, f"__{each}", getattr(cls, each))
-            delattr(cls, each)
-        cls.__fields__ = fields
-
-    # noinspection PyArgumentList
-    def _to_json(self, _json_data: Dict):
-        for each in self.__fields__:
-            _json_data[each] = self.__orig_getter__(f"__{each}")
-
-    # noinspection PyArgumentList
-    def _from_json(self, _json_data: Dict):
-        for each in self.__fields__:
-            value = _json_data.get(each)
-            if not value:
-                if each not in _json_data:
-                    raise Fail(f"Def[{self.__class__.__name__}::{each}]缺失[{_json_data=}]")
-            self.__orig_setter__(f"__{each}", value)
+    def __init__(self, _id: Union[str, int]):
+        super().__init__(_id)
+        self.__init_fields__()
 
 
-# noinspection DuplicatedCode
-class SimpleNode(BaseNode):
-    def __init_subclass__(cls, **kwargs):
-        super().__init_subclass__(**kwargs)
-        fields = []
-        for k, v in cls.__dict__.items():
-            if isinstance(k, str) and not k.startswith("_"):
-                if k == "mapping1":
-                    pass
-                elif callable(v):
-                    print(f"pass field {cls.__name__}:{k}")
-                    continue
-                else:
-                    fields.append(k)
-        # cls.__orig_setter__ = cls.__setattr__
-        # cls.__setattr__ = _setter(cls.__setattr__, fields)
-        # cls.__orig_getter__ = cls.__getattribute__
-        if diff_set := set(getattr(cls, "__annotations__", [])) - set(fields):
-            if is_debug():
-                raise Fail(f"检查[{cls.__name__}][{','.join(diff_set)}]是否写默认值")
-        # cls.__getattribute__ = _getter(cls.__getattribute__, fields)
-        cls.__fields__ = fields
-        cls.__fields_init__ = []
-        for each in fields:
-            orig = getattr(cls, each)
-            cls.__fields_init__.append(clone_generator(orig))
-            setattr(cls, f"__{each}", orig)
-            # 剔除旧的避免不必要的问题
-            delattr(cls, each)
-
+class SimpleNode(BaseNode, metaclass=_SimpleMeta):
     def __init__(self):
         super().__init__()
-        # noinspection PyUnresolvedReferences
-        for k, v in zip(self.__class__.__fields__, self.__class__.__fields_init__):
-            setattr(self, k, v())
-
-    # noinspection PyArgumentList
-    def _to_json(self, _json_data: Dict):
-        for each in self.__fields__:
-            # _json_data[each] = self.__orig_getter__(f"__{each}")
-            _json_data[each] = getattr(self, each)
-
-    # noinspection PyArgumentList
-    def _from_json(self, _json_data: Dict):
-        for each in self.__fields__:
-            if each in _json_data:
-                # self.__orig_setter__(f"__{each}", _json_data[each])
-                setattr(self, each, _json_data[each])
+        self.__init_fields__()
 
 
-# noinspection DuplicatedCode
-class SimpleInfo(BaseInfo):
-    def __init_subclass__(cls, **kwargs):
-        super().__init_subclass__(**kwargs)
-        fields = []
-        for k, v in cls.__dict__.items():
-            if isinstance(k, str) and not k.startswith("_"):
-                if callable(getattr(cls, k)):
-                    continue
-                fields.append(k)
-        if diff_set := set(getattr(cls, "__annotations__", [])) - set(fields):
-            if is_debug():
-                raise Fail(f"检查[{cls.__name__}][{','.join(diff_set)}]是否写默认值")
-        cls.__fields__ = fields
-        cls.__fields_init__ = []
-        for each in fields:
-            orig = getattr(cls, each)
-            cls.__fields_init__.append(clone_generator(orig))
-            setattr(cls, f"__{each}", orig)
-            # 剔除旧的避免不必要的问题
-            delattr(cls, each)
-
+class SimpleInfo(BaseInfo, metaclass=_SimpleMeta):
     def __init__(self):
         super().__init__()
-        # noinspection PyUnresolvedReferences
-        for k, v in zip(self.__class__.__fields__, self.__class__.__fields_init__):
-            setattr(self, k, v())
-
-    # noinspection PyArgumentList
-    def _to_json(self, _json_data: Dict):
-        for each in self.__fields__:
-            # _json_data[each] = self.__orig_getter__(f"__{each}")
-            _json_data[each] = getattr(self, each)
-
-    # noinspection PyArgumentList
-    def _from_json(self, _json_data: Dict):
-        for each in self.__fields__:
-            if each in _json_data:
-                # self.__orig_setter__(f"__{each}", _json_data[each])
-                setattr(self, each, _json_data[each])
+        self.__init_fields__()
 
 
 class RedisDef(SimpleDef):
+    """
+    存放在redis(hash)里的def
+    save/delete会广播, 各个进程合并后增量的重新加载
+    """
+    __raw__: Optional[Dict[str, str]] = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.__raw__ = None
+        _def_models[cls.__name__] = cls
 
     # noinspection PyTypeChecker
     def __init__(self, _id: str):
@@ -694,136 +1125,164 @@ class RedisDef(SimpleDef):
     @classmethod
     def save(cls: Type[T], value: T):
         db_config.hset(cls.__name__, value.get_key(), value.to_json_str())
+        cls.publish_reload()
 
     @classmethod
     def delete(cls: Type[T], value: T):
-        del cls.__pool__[value.id]
+        cls.__pool__ = OrderedDict((k, v) for k, v in cls.__pool__.items() if k != value.id)
+        cls.__generation__ += 1
         db_config.hdel(cls.__name__, value.get_key())
+        cls.publish_reload()
 
     @classmethod
-    def reload_redis(cls):
-        tmp = []
-        for k, v in db_config.hgetall(cls.__name__).items():
-            tmp.append(str_json(v))
-        cls.reload_def(tmp)
+    def publish_reload(cls):
+        db_mgr.publish(_def_channel, json_str({"model": cls.__name__}))
+
+    @classmethod
+    def reload_redis(cls, incremental=True) -> bool:
+        """
+        增量时只解析内容有变化的field
+        没有变化返回False
+        """
+        _listen(_def_channel, _def_on_reload)
+        raw_map: Dict[str, str] = db_config.hgetall(cls.__name__)
+        orig = cls.__raw__
+        if not incremental or orig is None:
+            cls.reload_def(list(map(str_json, raw_map.values())))
+        else:
+            changed = [str_json(v) for k, v in raw_map.items() if orig.get(k) != v]
+            removed = [k.partition(":")[2] for k in orig if k not in raw_map]
+            if not changed and not removed:
+                return False
+            cls.reload_def(changed, reset=False, remove=removed)
+        cls.__raw__ = raw_map
+        return True
 
 
 class AutoNewSimpleNode(SimpleNode):
     _auto_new = True
 
 
-class __SampleSimpleDef(SimpleDef):
-    a: int = SimpleModel.INT
-    b: str = SimpleModel.STR
-    c: int = SimpleModel.BOOL
-    d: float = SimpleModel.FLOAT
-    e: int = []
-    g: str = {}
-
-
-__SampleSimpleDef.reload_def([{
-    "id": "a",
-    "a": 1,
-    "b": "1",
-    "c": 1,
-    "d": 1.0,
-    "e": [],
-    "g": {},
-}])
-__tmp = __SampleSimpleDef.by_str_id("a")
-Assert(__tmp.a == 1)
-__SampleSimpleDef.reload_def([{
-    "id": "a",
-    "a": 2,
-    "b": "1",
-    "c": 1,
-    "d": 1.0,
-    "e": [],
-    "g": {},
-}], reset=False)
-Assert(__tmp.a == 2)
-
-
-class __SampleSimpleNode(SimpleNode):
-    a: int = SimpleModel.INT
-    b: str = SimpleModel.STR
-    c: int = SimpleModel.BOOL
-    d: str = SimpleModel.FLOAT
-    e: int = []
-    g: str = {}
-
-
-class __SampleSimpleInfo(SimpleInfo):
-    a: int = SimpleModel.INT
-    b: str = SimpleModel.STR
-    c: int = SimpleModel.BOOL
-    d: str = SimpleModel.FLOAT
-    e: int = []
-    g: str = {}
-
-
-__json_data = {
-    "id": '1',
-    "a": 1,
-    "b": "b",
-    "c": True,
-    "d": 1.0,
-    "e": [],
-    "g": {
-
-    }
-}
-with Block("Node测试"):
-    __obj = __SampleSimpleNode.by_json({
-        "id": 1,
+def _self_test():
+    """
+    模型的自检(只在DEBUG/TEST时随import执行, 避免每个进程启动都要付出这个开销)
+    """
+    class __SampleSimpleDef(SimpleDef):
+        a: int = SimpleModel.INT
+        b: str = SimpleModel.STR
+        c: int = SimpleModel.BOOL
+        d: float = SimpleModel.FLOAT
+        e: int = []
+        g: str = {}
+
+    __SampleSimpleDef.reload_def([{
+        "id": "a",
         "a": 1,
-        "b": "b",
-        "c": True,
+        "b": "1",
+        "c": 1,
         "d": 1.0,
         "e": [],
-        "g": {
-
-        }
-    })
-    assert len(list(__obj.to_json().items())) >= len(list(__json_data.items()))
-    # 额外的赋值不会被写入
-    __obj.f = 1
-    assert "f" not in __obj.to_json()
-    # todo: 类型检查
-    __obj.a = "1"
-    assert __obj.e == []
-    assert __obj.e is not __SampleSimpleNode().e
-
-with Block("Def测试"):
-    __obj = __SampleSimpleDef.by_json({
-        "id": 1,
+        "g": {},
+    }])
+    __tmp = __SampleSimpleDef.by_str_id("a")
+    Assert(__tmp.a == 1)
+    __generation = __SampleSimpleDef.generation()
+    __SampleSimpleDef.reload_def([{
+        "id": "a",
+        "a": 2,
+        "b": "1",
+        "c": 1,
+        "d": 1.0,
+        "e": [],
+        "g": {},
+    }], reset=False)
+    # 快照替换, 已经拿到的旧对象不变
+    Assert(__tmp.a == 1)
+    Assert(__SampleSimpleDef.by_str_id("a").a == 2)
+    Assert(__SampleSimpleDef.generation() == __generation + 1)
+
+    class __SampleSimpleNode(SimpleNode):
+        a: int = SimpleModel.INT
+        b: str = SimpleModel.STR
+        c: int = SimpleModel.BOOL
+        d: str = SimpleModel.FLOAT
+        e: int = []
+        g: str = {}
+
+    class __SampleSimpleInfo(SimpleInfo):
+        a: int = SimpleModel.INT
+        b: str = SimpleModel.STR
+        c: int = SimpleModel.BOOL
+        d: str = SimpleModel.FLOAT
+        e: int = []
+        g: str = {}
+
+    __json_data = {
+        "id": '1',
         "a": 1,
         "b": "b",
         "c": True,
         "d": 1.0,
         "e": [],
-        "f": {
-            "length": 2,
-            "type": "str",
-            "content": ["1", "2"],
-        },
         "g": {
 
         }
-    })
-    assert __obj.to_json() == __json_data
-    assert __obj.a == 1
-    assert __obj.b == "b"
-    assert __obj.e == []
-    assert __obj.e is not __SampleSimpleDef(1).e
-
-    with Block("检测setter", fail=False, log_fail=False):
-        __obj.a = 1
-        Suicide("不应该到这里")
-
-    with Block("检测setter", fail=False, log_fail=False):
-        __SampleSimpleDef.by_json({
+    }
+    with Block("Node测试"):
+        __obj = __SampleSimpleNode.by_json({
+            "id": 1,
+            "a": 1,
+            "b": "b",
+            "c": True,
+            "d": 1.0,
+            "e": [],
+            "g": {
+
+            }
+        })
+        assert len(list(__obj.to_json().items())) >= len(list(__json_data.items()))
+        # 额外的赋值不会被写入
+        __obj.f = 1
+        assert "f" not in __obj.to_json()
+        # todo: 类型检查
+        __obj.a = "1"
+        assert __obj.e == []
+        assert __obj.e is not __SampleSimpleNode().e
+
+    with Block("Def测试"):
+        __obj = __SampleSimpleDef.by_json({
             "id": 1,
-            "a": "1",
+            "a": 1,
+            "b": "b",
+            "c": True,
+            "d": 1.0,
+            "e": [],
+            "f": {
+                "length": 2,
+                "type": "str",
+                "content": ["1", "2"],
+            },
+            "g": {
+
+            }
         })
-        Suicide("不应该到这里")
+        assert __obj.to_json() == __json_data
+        assert __obj.a == 1
+        assert __obj.b == "b"
+        assert __obj.e == []
+        assert __obj.e is not __SampleSimpleDef(1).e
+
+        with Block("检测setter", fail=False, log_fail=False):
+            __obj.a = 1
+            Suicide("不应该到这里")
+
+        with Block("检测setter", fail=False, log_fail=False):
+            __SampleSimpleDef.by_json({
+                "id": 1,
+                "a": "1",
+            })
+            Suicide("不应该到这里")
+
+
+if DEBUG:
+    _self_test()
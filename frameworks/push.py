@@ -0,0 +1,189 @@
+"""
+基于MessageChannel的推送(SSE/WebSocket)
+每个进程每个channel只有一个订阅线程负责解码
+解码后在内存里扇出给本地所有的连接
+慢的连接按照策略丢弃而不是拖慢订阅线程
+"""
+from typing import Dict, Optional, Set, Generator, Callable, Tuple
+
+from gevent.queue import Queue, Full, Empty
+from redis.client import Redis
+
+from base.style import Log, json_str
+from frameworks.base import ChunkPacket, Request
+from frameworks.redis_mongo import MessageChannel, db_mgr, message_channel, redis_addr
+
+# 队列满了之后的处理策略
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+DISCONNECT = "disconnect"
+
+
+class PushConnection:
+    """
+    单个推送连接
+    先从channel的缓存里补齐历史再接上实时的扇出
+    """
+
+    def __init__(self, hub: 'ChannelHub', cursor: int, *, max_queue=100, drop_policy=DROP_OLDEST):
+        self.hub = hub
+        self.channel = message_channel(hub.channel, cursor=cursor, redis=hub.redis)
+        self.queue = Queue(maxsize=max_queue)
+        self.drop_policy = drop_policy
+        self.dropped = 0
+        self.closed = False
+
+    @property
+    def cursor(self) -> int:
+        return self.channel.cursor
+
+    def offer(self, data: MessageChannel.MessageData):
+        """
+        订阅线程调用的不能阻塞
+        """
+        if self.closed or data["id"] < self.cursor:
+            return
+        try:
+            self.queue.put_nowait(data)
+        except Full:
+            self.dropped += 1
+            if self.drop_policy == DROP_OLDEST:
+                try:
+                    self.queue.get_nowait()
+                except Empty:
+                    pass
+                self.queue.put_nowait(data)
+            elif self.drop_policy == DISCONNECT:
+                Log(f"channel[{self.hub.channel}]连接过慢断开[dropped={self.dropped}]")
+                self.close()
+            else:
+                # DROP_NEWEST 直接丢弃
+                pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.hub.remove(self)
+        try:
+            # 唤醒等待中的消费者
+            self.queue.put_nowait(None)
+        except Full:
+            pass
+
+    def messages(self, timeout_sec=15) -> Generator[Optional[MessageChannel.MessageData], None, None]:
+        """
+        超时会产出None方便上层发心跳
+        """
+        try:
+            # 补齐历史
+            while not self.closed and (data := self.channel.fetch_message_nowait()):
+                yield data
+            while not self.closed:
+                try:
+                    data = self.queue.get(timeout=timeout_sec)
+                except Empty:
+                    yield None
+                    continue
+                if data is None:
+                    break
+                if data["id"] < self.channel.cursor:
+                    # 补齐历史时已经发过了
+                    continue
+                self.channel.cursor = data["id"] + 1
+                yield data
+        finally:
+            self.close()
+
+
+class ChannelHub:
+    """
+    单个channel在进程内的扇出
+    """
+
+    def __init__(self, channel: str, redis: Redis = db_mgr):
+        self.channel = channel
+        self.redis = redis
+        self.connections: Set[PushConnection] = set()
+        self.subscribe = message_channel(channel, redis=redis).subscribe
+
+    def connect(self, cursor: int = -1, *, max_queue=100, drop_policy=DROP_OLDEST) -> PushConnection:
+        # 先挂上监听再补齐历史避免中间漏掉
+        self.subscribe.add_listener(self.dispatch)
+        if not self.subscribe.thread:
+            self.subscribe.run()
+        conn = PushConnection(self, cursor, max_queue=max_queue, drop_policy=drop_policy)
+        self.connections.add(conn)
+        return conn
+
+    def remove(self, conn: PushConnection):
+        self.connections.discard(conn)
+        if not self.connections:
+            self.subscribe.remove_listener(self.dispatch)
+
+    def dispatch(self, data: MessageChannel.MessageData):
+        for conn in list(self.connections):
+            conn.offer(data)
+
+
+_hub_pool: Dict[Tuple[str, str], ChannelHub] = {
+
+}
+
+
+def channel_hub(channel: str, redis: Redis = db_mgr) -> ChannelHub:
+    """
+    按照redis的地址+channel共用(同subscribe_mux)
+    """
+    key = (redis_addr(redis), channel)
+    if (hub := _hub_pool.get(key)) is None:
+        hub = _hub_pool[key] = ChannelHub(channel, redis=redis)
+    return hub
+
+
+def sse_packet(channel: str, cursor: int = -1, *, request: Optional[Request] = None, heartbeat_sec=15,
+               max_queue=100, drop_policy=DROP_OLDEST) -> ChunkPacket:
+    """
+    以SSE的方式推送channel
+    断线重连时客户端带上最后的id+1作为cursor即可补齐
+    """
+    conn = channel_hub(channel).connect(cursor, max_queue=max_queue, drop_policy=drop_policy)
+    if request is not None:
+        request.rsp_header["Cache-Control"] = "no-cache"
+        request.rsp_header["X-Accel-Buffering"] = "no"
+
+    def generator():
+        try:
+            yield f"retry: {heartbeat_sec * 1000}\n\n".encode("utf8")
+            for data in conn.messages(timeout_sec=heartbeat_sec):
+                if data is None:
+                    yield b": ping\n\n"
+                else:
+                    yield f"id: {data['id']}\ndata: {json_str(data)}\n\n".encode("utf8")
+        finally:
+            conn.close()
+
+    return ChunkPacket(generator(), content_type="text/event-stream; charset=UTF-8")
+
+
+def websocket_push(websocket, channel: str, cursor: int = -1, *, heartbeat_sec=15, max_queue=100,
+                   drop_policy=DROP_OLDEST, encoder: Callable[[Dict], str] = json_str):
+    """
+    以WebSocket的方式推送channel
+    websocket只需要支持`send`以及`closed`(兼容gevent-websocket)
+    """
+    conn = channel_hub(channel).connect(cursor, max_queue=max_queue, drop_policy=drop_policy)
+    try:
+        for data in conn.messages(timeout_sec=heartbeat_sec):
+            if getattr(websocket, "closed", False):
+                break
+            if data is None:
+                continue
+            try:
+                websocket.send(encoder(data))
+            except Exception as e:
+                # 发送失败认为断开了
+                Log(f"channel[{channel}]websocket推送失败[{e}]")
+                break
+    finally:
+        conn.close()
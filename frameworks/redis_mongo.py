@@ -3,22 +3,25 @@
 redis作为前端
 mongo作为冷存
 """
+import hashlib
 import json
 import os
 import re
+import socket
 import time
 from collections import ChainMap
-from datetime import timedelta
+from datetime import datetime, timedelta
 from math import ceil
-from typing import Callable, List, Optional, Sequence, Iterable, Dict, Union, TypedDict
+from typing import Callable, List, Optional, Sequence, Iterable, Dict, Union, TypedDict, Set, Tuple
 
 import gevent
 import pymongo
+import redis
 from gevent.event import AsyncResult
 from redis import RedisError
 from redis.client import Redis
 
-from base.style import Fail, ExJSONEncoder, Log, now, json_str, Assert, str_json, SentryBlock, Block
+from base.style import Fail, ExJSONEncoder, Log, now, json_str, Assert, str_json, SentryBlock, Block, Trace
 
 pool_map = {
 
@@ -26,6 +29,9 @@ pool_map = {
 
 db_daily_expire_days = int(os.environ.get("DAILY_REDIS_EXPIRE_DAYS", 7))
 db_daily_expire_mode = os.environ.get("DAILY_REDIS_EXPIRE_MODE", "ttl")
+db_channel_backend = os.environ.get("MESSAGE_CHANNEL_BACKEND", "hash")
+# 确认不存在的key/mapping缓存多少秒(挡住对不存在的id/用户名的反复探测), 0表示关闭
+db_negative_ttl = int(os.environ.get("NEGATIVE_CACHE_TTL", 60))
 
 
 def is_no_redis():
@@ -121,11 +127,16 @@ def _mongo(cate):
     return collection
 
 
-def mongo_index(cate, index, unique=False):
-    collection = _mongo(cate)
-    if ("%s_1" % index) not in collection.index_information():
+def mongo_index(cate, index: Union[str, List[str]], unique=False):
+    """
+    index是list时创建复合索引
+    """
+    collection = mongo(cate)
+    fields = [index] if isinstance(index, str) else list(index)
+    if "_".join("%s_1" % x for x in fields) not in collection.index_information():
         Log("创建mongo索引[%s][%s][unique:%s]" % (cate, index, unique))
-        collection.create_index(index, unique=unique, sparse=True, background=True)
+        collection.create_index([(x, pymongo.ASCENDING) for x in fields], unique=unique, sparse=True,
+                                background=True)
 
 
 __mongo_map = {}
@@ -229,6 +240,10 @@ def mongo_set(key: str, value: dict, model: str, no_sentry=False) -> bool:
     """
     :return: 是否插入
     """
+    # 只写mongo(不写redis)的时候需要清掉不存在的标记
+    negative_clear(key)
+    if (bloom := bloom_filters.get(model)) is not None:
+        bloom.add([key])
     with SentryBlock(op="mongo", description=f"set {key}", no_sentry=no_sentry) as span:
         span.set_tag("model", model)
         if not (db := mongo(model)).find_one_and_update(
@@ -240,7 +255,286 @@ def mongo_set(key: str, value: dict, model: str, no_sentry=False) -> bool:
         return False
 
 
+def mongo_bulk_set(model: str, values: Dict[str, dict], no_sentry=False) -> int:
+    """
+    批量的mongo_set(upsert)
+    :return: 插入的数量
+    """
+    if not values:
+        return 0
+    if (bloom := bloom_filters.get(model)) is not None:
+        bloom.add(values)
+    with SentryBlock(op="mongo", description=f"bulk_set {model}[{len(values)}]", no_sentry=no_sentry) as span:
+        span.set_tag("model", model)
+        ret = mongo(model).bulk_write([
+            pymongo.UpdateOne({"_id": key}, {"$set": value}, upsert=True) for key, value in values.items()
+        ], ordered=False)
+        return ret.upserted_count
+
+
+class BloomFilter:
+    """
+    每个model一个"可能在mongo里"的bloom(redis的bitfield实现), 只加不删
+    写入mongo之前先加, 所以不会漏; 没有完整的从mongo重建过(ready)之前不使用
+    redis里的是权威的, 进程内定期刷新镜像: 镜像里有的一定有, 镜像里没有的才需要查redis
+    """
+
+    def __init__(self, model: str, bits: int, hashes: int):
+        self.model = model
+        self.bits = bits
+        self.hashes = hashes
+        # 参数变了就是一个新的bloom
+        self.key = f"__bloom:{model}:{bits}x{hashes}"
+        self.ready_key = f"__bloom_ready:{model}:{bits}x{hashes}"
+        self.ready = False
+        self.mirror: Optional[bytearray] = None
+        self.__expire = 0
+
+    def offsets(self, key: str) -> List[int]:
+        digest = hashlib.blake2b(key.encode("utf8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def mirror_has(self, offsets: List[int]) -> bool:
+        if (mirror := self.mirror) is None:
+            return False
+        # 与SETBIT一致, 第0位是第一个字节的最高位
+        return all(mirror[x >> 3] & (0x80 >> (x & 7)) for x in offsets)
+
+    def add(self, keys: Iterable[str]):
+        pipe = db_model_ex.pipeline(transaction=False)
+        mirror = self.mirror
+        for key in keys:
+            args = []
+            for x in self.offsets(key):
+                args.extend(("SET", "u1", x, 1))
+                if mirror is not None:
+                    mirror[x >> 3] |= 0x80 >> (x & 7)
+            pipe.execute_command("BITFIELD", self.key, *args)
+        if len(pipe):
+            pipe.execute()
+
+    def refresh(self):
+        raw = _raw_redis(db_model_ex)
+        value, ready = raw.mget(self.key, self.ready_key)
+        mirror = bytearray(self.bits + 7 >> 3)
+        mirror[:len(value or b"")] = value or b""
+        self.mirror = mirror
+        self.ready = ready == b"1"
+
+    def prepare(self, pipe, keys: List[str]) -> List[str]:
+        """
+        把需要在redis里确认的放到pipe里(与其他查询同一次往返)
+        :return: 镜像里没有的key
+        """
+        if (cur := time.time()) > self.__expire:
+            self.__expire = cur + bloom_refresh
+            gevent.spawn(self.refresh)
+        if not self.ready:
+            pipe.get(self.ready_key)
+        unsure = []
+        for key in keys:
+            if self.mirror_has(offsets := self.offsets(key)):
+                continue
+            unsure.append(key)
+            args = []
+            for x in offsets:
+                args.extend(("GET", "u1", x))
+            pipe.execute_command("BITFIELD", self.key, *args)
+        return unsure
+
+    def absent(self, unsure: List[str], result: List) -> List[str]:
+        """
+        按prepare的顺序从result里取结果
+        :return: 确定不在mongo里的key
+        """
+        if not self.ready:
+            self.ready = result.pop(0) == "1"
+        bits = [result.pop(0) for _ in unsure]
+        if not self.ready:
+            return []
+        return [key for key, each in zip(unsure, bits) if not all(each)]
+
+    def rebuild(self, batch=10000) -> int:
+        """
+        把mongo里所有的_id重新加一遍(只加bit, 与同时的写入不冲突), 完整跑完才标记ready
+        """
+        total = 0
+        tmp = []
+        for each in mongo(self.model).find({}, {"_id": 1}, batch_size=batch):
+            tmp.append(each["_id"])
+            if len(tmp) >= batch:
+                self.add(tmp)
+                total += len(tmp)
+                tmp.clear()
+                gevent.sleep(0)
+        self.add(tmp)
+        total += len(tmp)
+        db_model_ex.set(self.ready_key, 1)
+        self.ready = True
+        Log(f"重建bloom[{self.model}][{total}]")
+        return total
+
+
+# model => bloom(由Meta.bloom开启)
+bloom_filters: Dict[str, BloomFilter] = {
+
+}
+bloom_refresh = int(os.environ.get("BLOOM_REFRESH", 60))
+__raw_redis = {}
+
+
+def _raw_redis(db: Redis) -> Redis:
+    """
+    不decode的连接(读取bitmap)
+    """
+    if (ret := __raw_redis.get(id(db))) is None:
+        pool = db.connection_pool
+        ret = __raw_redis[id(db)] = Redis(connection_pool=redis.ConnectionPool(
+            connection_class=pool.connection_class, **dict(pool.connection_kwargs, decode_responses=False)))
+    return ret
+
+
+def bloom_enable(model: str, bits: int = 0, hashes: int = 0) -> BloomFilter:
+    bits = bits or int(os.environ.get("BLOOM_BITS", 1 << 24))
+    hashes = hashes or int(os.environ.get("BLOOM_HASHES", 7))
+    if (ret := bloom_filters.get(model)) is None or (ret.bits, ret.hashes) != (bits, hashes):
+        ret = bloom_filters[model] = BloomFilter(model, bits, hashes)
+    return ret
+
+
+# 从mongo拉回redis的数量 model => count
+mongo_promote_count: Dict[str, int] = {
+
+}
+# 命中不存在标记(没有查mongo)的数量 model => count
+mongo_negative_count: Dict[str, int] = {
+
+}
+# bloom确认不存在(没有查mongo)的数量 model => count
+mongo_bloom_count: Dict[str, int] = {
+
+}
+
+
+def negative_clear(key: str, mapping=False):
+    if db_negative_ttl > 0:
+        db_model_ex.delete(f"__miss_mapping:{key}" if mapping else f"__miss:{key}")
+
+
+def mongo_promote(key_list: Sequence[str], model: Optional[str] = None, no_sentry=False) -> Dict[str, Dict]:
+    """
+    把冷数据批量的从mongo拉回redis(每个model一次find)
+    不再回写mongo的`__active__`, 期间redis里被写过的以redis为准
+    :return: key => 数据
+    """
+    groups: Dict[str, List[str]] = {}
+    for key in key_list:
+        i = key.find(":")
+        if i <= 0 or (model is not None and key[0:i] != model):
+            continue
+        groups.setdefault(key[0:i], []).append(key)
+    ret = {}
+    for cate, keys in groups.items():
+        # 不存在的标记以及bloom在同一次往返里确认
+        pipe = db_model_ex.pipeline(transaction=False)
+        if db_negative_ttl > 0:
+            pipe.mget([f"__miss:{k}" for k in keys])
+        bloom = bloom_filters.get(cate)
+        unsure = bloom.prepare(pipe, keys) if bloom is not None else []
+        result = pipe.execute() if len(pipe) else []
+        if db_negative_ttl > 0:
+            # 短期内确认过不存在的就不查mongo了
+            if skip := {k for k, miss in zip(keys, result.pop(0)) if miss is not None}:
+                mongo_negative_count[cate] = mongo_negative_count.get(cate, 0) + len(skip)
+                keys = [k for k in keys if k not in skip]
+        if bloom is not None:
+            # 从来没有写入过mongo的(比如新的id)
+            if skip := set(bloom.absent(unsure, result)):
+                mongo_bloom_count[cate] = mongo_bloom_count.get(cate, 0) + len(skip)
+                keys = [k for k in keys if k not in skip]
+        if not keys:
+            continue
+        with SentryBlock(op="mongo", description=f"promote {cate}[{len(keys)}]", no_sentry=no_sentry) as span:
+            span.set_tag("model", cate)
+            found = {each["_id"]: each for each in mongo(cate).find({"_id": {"$in": keys}})}
+        if db_negative_ttl > 0 and len(found) < len(keys):
+            pipe = db_model_ex.pipeline(transaction=False)
+            for key in keys:
+                if key not in found:
+                    pipe.set(f"__miss:{key}", 1, ex=db_negative_ttl)
+            pipe.execute()
+        if not found:
+            continue
+        pipe = db_model.pipeline(transaction=False)
+        for key, value in found.items():
+            pipe.set(key, json.dumps(value, separators=(',', ':'), sort_keys=True, ensure_ascii=False), nx=True)
+        if stale := [key for key, ok in zip(found, pipe.execute()) if not ok]:
+            for key, value in zip(stale, db_model.mget(stale)):
+                if value is not None:
+                    found[key] = str_json(value)
+        Log("从mongodb[%s]激活[%s][%s]" % (cate, len(found), ",".join(list(found)[:10])))
+        mongo_promote_count[cate] = mongo_promote_count.get(cate, 0) + len(found)
+        ret.update(found)
+    return ret
+
+
+# 值没有变化才删除(期间被写过的保留在redis里)
+__DEMOTE_LUA = """
+local ret = {}
+for i, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[i] then
+        redis.call('DEL', key)
+        ret[i] = 1
+    else
+        ret[i] = 0
+    end
+end
+return ret
+"""
+__demote_script = {}
+
+
+# 可以下沉到mongo的model(BaseSaveModel的子类登记), 其他`X:Y`的key不动
+tiering_models: Set[str] = set()
+
+
+def mongo_demote(key_list: Sequence[str], no_sentry=False) -> List[str]:
+    """
+    把redis里的数据批量写到mongo后从redis里删掉(冷数据下沉)
+    只处理登记过的model, 不是json的跳过
+    :return: 实际删掉的key
+    """
+    key_list = [k for k in key_list if (i := k.find(":")) > 0 and k[0:i] in tiering_models]
+    if not key_list:
+        return []
+    values = {k: v for k, v in zip(key_list, db_model.mget(key_list)) if v is not None}
+    groups: Dict[str, Dict[str, dict]] = {}
+    for key, value in values.items():
+        try:
+            data = str_json(value)
+        except ValueError:
+            Log(f"下沉跳过不是json的[{key}]")
+            continue
+        if isinstance(data, dict):
+            groups.setdefault(key[0:key.index(":")], {})[key] = data
+    for cate, data in groups.items():
+        mongo_bulk_set(cate, data, no_sentry=no_sentry)
+    if (script := __demote_script.get(id(db_model))) is None:
+        script = __demote_script[id(db_model)] = db_model.register_script(__DEMOTE_LUA)
+    keys = [k for each in groups.values() for k in each]
+    ret = [k for k, ok in zip(keys, script(keys=keys, args=[values[k] for k in keys])) if ok]
+    if db_negative_ttl > 0 and ret:
+        # 以防还有没过期的不存在标记
+        db_model_ex.delete(*[f"__miss:{k}" for k in ret])
+    return ret
+
+
 def mongo_get(key: str, *, model=None, active=True, no_sentry=False) -> Optional[Dict]:
+    """
+    :param active: 找到的同时拉回redis
+    """
     if model is not None:
         if not key.startswith(model + ":"):
             return None
@@ -249,26 +543,11 @@ def mongo_get(key: str, *, model=None, active=True, no_sentry=False) -> Optional
         return None
     model, _id = key[0:i], key[i + 1:]
     if active:
-        if active is True:
-            active = {
-                "ts": now()
-            }
-        with SentryBlock(op="mongo", description=f"get_and_set {key}", no_sentry=no_sentry) as span:
-            span.set_tag("model", model)
-            ret = mongo(model).find_one_and_update({"_id": key}, {"$set": {
-                "__active__": active
-            }})
-            if ret is not None:
-                tmp = json.dumps(ret, separators=(',', ':'), sort_keys=True, ensure_ascii=False)
-                Log("从mongodb[%s]激活[%s][%s]" % (model, key, tmp))
-                db_model.set(key, tmp)
-            else:
-                span.set_tag("none", True)
-        return ret
+        return mongo_promote([key], model=model, no_sentry=no_sentry).get(key)
     else:
         with SentryBlock(op="mongo", description=f"get {key}", no_sentry=no_sentry) as span:
             span.set_tag("model", model)
-            return mongo(model).find_one({"_id": _id})
+            return mongo(model).find_one({"_id": key})
 
 
 # noinspection SpellCheckingInspection
@@ -277,8 +556,12 @@ def mongo_mget(key_list: Sequence[str], model: Optional[str] = None, active=True
     size = len(key_list)
     with SentryBlock(op="mongo", description=f"mget [{size}]") as span:
         span.set_tag("model", model)
+        found = mongo_promote(key_list, model=model, no_sentry=True) if active else None
         for i, each in enumerate(key_list):
-            tmp = mongo_get(each, model=model, active=active, no_sentry=i > 10)
+            if found is not None:
+                tmp = found.get(each)
+            else:
+                tmp = mongo_get(each, model=model, active=active, no_sentry=i > 10)
             if tmp is None:
                 if not allow_not_found:
                     raise Fail("就是找不到指定的对象[%s]" % each)
@@ -288,17 +571,94 @@ def mongo_mget(key_list: Sequence[str], model: Optional[str] = None, active=True
     return ret
 
 
+# 有DailyRedis写入的db, 清理的时候用
+daily_redis_dbs: Dict[int, Redis] = {}
+
+
 # noinspection PyMethodMayBeStatic,SpellCheckingInspection
 class DailyRedis:
+    """
+    按时间分桶(前缀)的key
+    每个进程第一次写入一个key时登记到桶的索引`__bucket:<prefix>`, 桶登记在`__daily:buckets`(按结束时间)
+    清理时只处理已经结束的桶(expire_bucket), 不用全库SCAN
+    """
+    BUCKETS = "__daily:buckets"
+    # 每次处理桶里的一批, ttl模式下没有过期时间的才设置
+    __EXPIRE_LUA = """
+local keys = redis.call('SPOP', KEYS[1], ARGV[3])
+for _, key in ipairs(keys) do
+    if ARGV[1] == 'del' then
+        redis.call('UNLINK', key)
+    elseif redis.call('TTL', key) == -1 then
+        redis.call('EXPIREAT', key, ARGV[2])
+    end
+end
+return {#keys, redis.call('SCARD', KEYS[1])}
+"""
+    __expire_script = {}
+
     def __init__(self, db, expire_days=db_daily_expire_days):
         self.__db: Redis = db
         self.__expire_days = timedelta(days=expire_days)
+        self.__seen_prefix = ""
+        self.__seen: Set[str] = set()
+        daily_redis_dbs[id(db)] = db
 
     def _prefix(self):
         return time.strftime("%Y-%m-%d", time.localtime())
 
+    def _span(self, prefix: str) -> Tuple[datetime, datetime]:
+        """
+        前缀对应的时间段[start, end)
+        """
+        start = datetime.strptime(prefix, "%Y-%m-%d")
+        return start, start + timedelta(days=1)
+
+    def _key(self, name: str) -> str:
+        """
+        写入用的key, 顺便登记到桶的索引
+        """
+        prefix = self._prefix()
+        key = f"{prefix}|{name}"
+        if prefix != self.__seen_prefix or len(self.__seen) > 100000:
+            self.__seen_prefix = prefix
+            self.__seen = set()
+        if key not in self.__seen:
+            start, end = self._span(prefix)
+            expire_at = int((start + self.__expire_days).timestamp())
+            pipe = self.__db.pipeline(transaction=False)
+            pipe.sadd(f"__bucket:{prefix}", key)
+            # 清理没跑的话索引自己也会过期
+            pipe.expireat(f"__bucket:{prefix}", expire_at + 86400)
+            pipe.zadd(DailyRedis.BUCKETS, {f"{prefix}#{expire_at}": int(end.timestamp() * 1000)})
+            pipe.execute()
+            self.__seen.add(key)
+        return key
+
+    @staticmethod
+    def expired_buckets(db: Redis, _now: Optional[int] = None) -> List[str]:
+        return db.zrangebyscore(DailyRedis.BUCKETS, "-inf", _now or now())
+
+    @staticmethod
+    def expire_bucket(db: Redis, bucket: str, mode: str = db_daily_expire_mode, batch: int = 1000) -> int:
+        """
+        整个桶按mode删除或者设置过期(每次Lua处理batch个)
+        :return: 处理的key的数量
+        """
+        if (script := DailyRedis.__expire_script.get(id(db))) is None:
+            script = DailyRedis.__expire_script[id(db)] = db.register_script(DailyRedis.__EXPIRE_LUA)
+        prefix, _, expire_at = bucket.rpartition("#")
+        total = 0
+        while True:
+            count, left = script(keys=[f"__bucket:{prefix}"], args=[mode, expire_at, batch])
+            total += count
+            if not left:
+                break
+        db.zrem(DailyRedis.BUCKETS, bucket)
+        return total
+
     def incr(self, name, *, amount=1):
-        return self.__db.incr(f"{self._prefix()}|{name}", amount=amount)
+        return self.__db.incr(self._key(name), amount=amount)
 
     def exists(self, *names):
         prefix = self._prefix()
@@ -307,7 +667,7 @@ class DailyRedis:
     def set(self, name, value, *, ex=None, px=None, nx=False, xx=False, keep_ttl=False):
         if ex is None and px is None:
             ex = self.__expire_days
-        return self.__db.set(f"{self._prefix()}|{name}", value, ex=ex, px=px, nx=nx, xx=xx, keepttl=keep_ttl)
+        return self.__db.set(self._key(name), value, ex=ex, px=px, nx=nx, xx=xx, keepttl=keep_ttl)
 
     def get(self, name):
         return self.__db.get(f"{self._prefix()}|{name}")
@@ -325,13 +685,13 @@ class DailyRedis:
         return self.__db.hgetall(f"{self._prefix()}|{name}")
 
     def hset(self, name, key=None, value=None, mapping=None):
-        return self.__db.hset(f"{self._prefix()}|{name}", key, value=value, mapping=mapping)
+        return self.__db.hset(self._key(name), key, value=value, mapping=mapping)
 
     def hincrby(self, name, key, amount=1):
-        return self.__db.hincrby(f"{self._prefix()}|{name}", key, amount)
+        return self.__db.hincrby(self._key(name), key, amount)
 
     def hincrbyfloat(self, name, key, amount=1.0):
-        return self.__db.hincrbyfloat(f"{self._prefix()}|{name}", key, amount)
+        return self.__db.hincrbyfloat(self._key(name), key, amount)
 
     def hkeys(self, name):
         return self.__db.hkeys(f"{self._prefix()}|{name}")
@@ -340,10 +700,10 @@ class DailyRedis:
         return self.__db.hlen(f"{self._prefix()}|{name}")
 
     def hsetnx(self, name, key, value):
-        return self.__db.hsetnx(f"{self._prefix()}|{name}", key, value)
+        return self.__db.hsetnx(self._key(name), key, value)
 
     def hmset(self, name, mapping):
-        return self.__db.hset(f"{self._prefix()}|{name}", mapping=mapping)
+        return self.__db.hset(self._key(name), mapping=mapping)
 
     def hmget(self, name, keys, *args):
         return self.__db.hmget(f"{self._prefix()}|{name}", keys, *args)
@@ -355,7 +715,7 @@ class DailyRedis:
         return self.__db.lindex(f"{self._prefix()}|list|{name}", index)
 
     def linsert(self, name, where, refvalue, value):
-        return self.__db.linsert(f"{self._prefix()}|list|{name}", where, refvalue, value)
+        return self.__db.linsert(self._key(f"list|{name}"), where, refvalue, value)
 
     def llen(self, name):
         return self.__db.llen(f"{self._prefix()}|list|{name}")
@@ -364,10 +724,10 @@ class DailyRedis:
         return self.__db.lpop(f"{self._prefix()}|list|{name}")
 
     def lpush(self, name, *values):
-        return self.__db.lpush(f"{self._prefix()}|list|{name}", *values)
+        return self.__db.lpush(self._key(f"list|{name}"), *values)
 
     def lpushx(self, name, value):
-        return self.__db.lpushx(f"{self._prefix()}|list|{name}", value)
+        return self.__db.lpushx(self._key(f"list|{name}"), value)
 
     def lrange(self, name, start, end):
         return self.__db.lrange(f"{self._prefix()}|list|{name}", start, end)
@@ -376,7 +736,7 @@ class DailyRedis:
         return self.__db.lrem(f"{self._prefix()}|list|{name}", count, value)
 
     def lset(self, name, index, value):
-        return self.__db.lset(f"{self._prefix()}|list|{name}", index, value)
+        return self.__db.lset(self._key(f"list|{name}"), index, value)
 
     def ltrim(self, name, start, end):
         return self.__db.ltrim(f"{self._prefix()}|list|{name}", start, end)
@@ -385,13 +745,13 @@ class DailyRedis:
         return self.__db.rpop(f"{self._prefix()}|list|{name}")
 
     def rpoplpush(self, src, dst):
-        return self.__db.rpoplpush(f"{self._prefix()}|list|{src}", f"{self._prefix()}|list|{dst}")
+        return self.__db.rpoplpush(f"{self._prefix()}|list|{src}", self._key(f"list|{dst}"))
 
     def rpush(self, name, *values):
-        return self.__db.rpush(f"{self._prefix()}|list|{name}", *values)
+        return self.__db.rpush(self._key(f"list|{name}"), *values)
 
     def rpushx(self, name, value):
-        return self.__db.rpushx(f"{self._prefix()}|list|{name}", value)
+        return self.__db.rpushx(self._key(f"list|{name}"), value)
 
 
 class WeeklyRedis(DailyRedis):
@@ -401,6 +761,16 @@ class WeeklyRedis(DailyRedis):
     def _prefix(self):
         return time.strftime("%Y-00-00_%U", time.localtime())
 
+    def _span(self, prefix: str) -> Tuple[datetime, datetime]:
+        # %U: 第一个周日开始是第1周, 之前的是第0周
+        year, week = int(prefix[:4]), int(prefix[-2:])
+        first = datetime(year, 1, 1)
+        sunday = first + timedelta(days=(6 - first.weekday()) % 7)
+        if week == 0:
+            return first, sunday
+        start = sunday + timedelta(weeks=week - 1)
+        return start, min(start + timedelta(weeks=1), datetime(year + 1, 1, 1))
+
 
 class MonthRedis(DailyRedis):
     def __init__(self, db):
@@ -409,12 +779,20 @@ class MonthRedis(DailyRedis):
     def _prefix(self):
         return time.strftime("%Y-%m-00", time.localtime())
 
+    def _span(self, prefix: str) -> Tuple[datetime, datetime]:
+        start = datetime.strptime(prefix[:7], "%Y-%m")
+        return start, start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+
 
 # noinspection PyMethodMayBeStatic
 class HourRedis(DailyRedis):
     def _prefix(self):
         return time.strftime("%Y-%m-%d_%H", time.localtime())
 
+    def _span(self, prefix: str) -> Tuple[datetime, datetime]:
+        start = datetime.strptime(prefix, "%Y-%m-%d_%H")
+        return start, start + timedelta(hours=1)
+
 
 # noinspection PyMethodMayBeStatic
 class MinuteRedis(DailyRedis):
@@ -422,8 +800,13 @@ class MinuteRedis(DailyRedis):
     def _prefix(self):
         return time.strftime("%Y-%m-%d_%H:%M", time.localtime())
 
+    def _span(self, prefix: str) -> Tuple[datetime, datetime]:
+        start = datetime.strptime(prefix, "%Y-%m-%d_%H:%M")
+        return start, start + timedelta(minutes=1)
+
 
 Assert(db_daily_expire_mode in {"ttl", "del"}, "DAILY_REDIS_EXPIRE_MODE只支持(ttl|del)")
+Assert(db_channel_backend in {"hash", "stream"}, "MESSAGE_CHANNEL_BACKEND只支持(hash|stream)")
 
 db_model = db_redis(1)
 db_model_ex = db_redis(2)
@@ -441,68 +824,182 @@ db_trash = db_redis(15)
 
 
 # noinspection PyShadowingNames
-class Subscribe:
+class SubscribeMux:
     """
-    负责无条件的接受redis的订阅消息而已
+    同一个redis实例共用一个订阅链接
+    负责无条件的接受redis的订阅消息再分发给各个channel
     """
     sleep_time = [1000, 1000, 1000, 3000, 3000, 3000, 5000, 10000, 30000, 60000]
     sleep_time_len = len(sleep_time) - 1
 
-    def __init__(self, channel: str, redis: Redis):
-        self.channel = channel
+    def __init__(self, redis: Redis):
+        self.redis = redis
         self.thread = None
+        self.topic = None
         self.sleep_expire = 0
         self.fail_count = 0
-        self.redis = redis
-        self.event = AsyncResult()
+        self.channels: Dict[str, 'Subscribe'] = {}
+        self.patterns: Dict[str, 'Subscribe'] = {}
+
+    def add(self, subscribe: 'Subscribe'):
+        pool = self.patterns if subscribe.pattern else self.channels
+        if subscribe.channel in pool:
+            return
+        pool[subscribe.channel] = subscribe
+        if topic := self.topic:
+            # 已经在监听了就追加订阅
+            with Block("追加订阅", fail=False):
+                if subscribe.pattern:
+                    topic.psubscribe(subscribe.channel)
+                else:
+                    topic.subscribe(subscribe.channel)
 
     def run(self):
         if self.thread:
             return
         self.thread = gevent.spawn(self.__run)
 
+    def __dispatch(self, msg):
+        if msg[0] == "message":
+            if subscribe := self.channels.get(msg[1]):
+                subscribe.dispatch(msg[2])
+        elif msg[0] == "pmessage":
+            if subscribe := self.patterns.get(msg[1]):
+                subscribe.dispatch(msg[3])
+
     def __run(self):
-        sleep_time = self.sleep_expire - now()
-        if sleep_time > 0:
-            time.sleep(sleep_time / 1000)
         try:
-            Log(f"开始监听[{self.channel}][{self.fail_count}]")
-            topic = self.redis.pubsub()
-            topic.subscribe(self.channel)
-            self.sleep_expire = 0
-            self.fail_count = 0
-            while True:
-                msg = topic.parse_response(block=True)
-                if msg[0] == "message":
-                    self.event.set(msg[2])
-                    self.event = AsyncResult()
-                    # self.queue.put_nowait({
-                    #     "type": msg[0],
-                    #     "channel": msg[1],
-                    #     "data": msg[2]
-                    # })
-                elif msg[0] == "pmessage":
-                    # self.queue.put_nowait({
-                    #     "type": msg[0],
-                    #     'pattern': msg[1],
-                    #     "channel": msg[2],
-                    #     "data": msg[3]
-                    # })
-                    self.event.set(msg[3])
-                    self.event = AsyncResult()
-                # if self.queue.qsize() > 10000:
-                #     # 自己吞掉开头的
-                #     self.queue.get()
-                pass
-        except RedisError as e:
-            self.fail_count += 1
-            sleep_time = Subscribe.sleep_time[min(Subscribe.sleep_time_len, self.fail_count)]
-            self.sleep_expire = now() + sleep_time
-            Log(f"redis链接错误[{e}]sleep[{sleep_time // 1000}s]")
-        self.thread = None
+            while self.channels or self.patterns:
+                sleep_time = self.sleep_expire - now()
+                if sleep_time > 0:
+                    gevent.sleep(sleep_time / 1000)
+                try:
+                    Log(f"开始监听[channel={len(self.channels)}][pattern={len(self.patterns)}][{self.fail_count}]")
+                    self.topic = topic = self.redis.pubsub()
+                    if self.channels:
+                        topic.subscribe(*list(self.channels.keys()))
+                    if self.patterns:
+                        topic.psubscribe(*list(self.patterns.keys()))
+                    self.sleep_expire = 0
+                    self.fail_count = 0
+                    while True:
+                        msg = topic.parse_response(block=True)
+                        try:
+                            self.__dispatch(msg)
+                        except Exception as e:
+                            # 单条消息的异常不能影响共用链接上的其他channel
+                            Trace(f"订阅分发异常[{msg[1]}]", e)
+                except RedisError as e:
+                    self.topic = None
+                    self.fail_count += 1
+                    sleep_time = SubscribeMux.sleep_time[min(SubscribeMux.sleep_time_len, self.fail_count)]
+                    self.sleep_expire = now() + sleep_time
+                    Log(f"redis链接错误[{e}]sleep[{sleep_time // 1000}s]")
+        finally:
+            # 不管怎么退出的都允许重新run
+            self.topic = None
+            self.thread = None
 
 
-_topic_pool: Dict[str, Subscribe] = {
+_mux_pool: Dict[str, SubscribeMux] = {
+
+}
+
+
+def redis_addr(redis: Redis) -> str:
+    kwargs = redis.connection_pool.connection_kwargs
+    return f"{kwargs.get('host')}:{kwargs.get('port')}"
+
+
+def subscribe_mux(redis: Redis) -> SubscribeMux:
+    """
+    按照redis的地址共用订阅链接(订阅与db无关)
+    """
+    key = redis_addr(redis)
+    if (mux := _mux_pool.get(key)) is None:
+        mux = _mux_pool[key] = SubscribeMux(redis)
+    return mux
+
+
+class Subscribe:
+    """
+    单个channel的等待者
+    实际的订阅由SubscribeMux负责
+    """
+
+    def __init__(self, channel: str, redis: Redis, *, pattern=False):
+        self.channel = channel
+        self.pattern = pattern
+        self.mux = subscribe_mux(redis)
+        self.event = AsyncResult()
+        # 进程内的扇出(只解码一次)
+        self.listeners: List[Callable[[Dict], None]] = []
+
+    @property
+    def thread(self):
+        return self.mux.thread
+
+    def add_listener(self, listener: Callable[[Dict], None]):
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[Dict], None]):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def dispatch(self, raw: str):
+        self.event.set(raw)
+        self.event = AsyncResult()
+        if not self.listeners:
+            return
+        data = None
+        with Block("channel解码", fail=False, params=raw):
+            data = str_json(raw)
+        if data is None:
+            return
+        for listener in list(self.listeners):
+            with Block("channel扇出", fail=False):
+                listener(data)
+
+    def run(self):
+        self.mux.add(self)
+        self.mux.run()
+
+
+def test_subscribe_mux_bad_payload():
+    """
+    一个channel上的非json消息不能让共用的订阅链接停掉
+    """
+    import subprocess
+    import sys
+    code = """
+from gevent import monkey
+monkey.patch_all()
+import gevent
+from frameworks.redis_mongo import db_mgr, Subscribe
+got = []
+a = Subscribe("__test:mux:a", db_mgr)
+b = Subscribe("__test:mux:b", db_mgr)
+a.add_listener(got.append)
+b.add_listener(got.append)
+a.run()
+b.run()
+gevent.sleep(0.2)
+db_mgr.publish("__test:mux:a", "not json")
+db_mgr.publish("__test:mux:b", '{"ok": 1}')
+gevent.sleep(0.2)
+assert got == [{"ok": 1}], got
+assert a.thread and not a.thread.dead
+print("ok")
+"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    ret = subprocess.run([sys.executable, "-c", code], cwd=root, env=dict(os.environ, PYTHONPATH=root),
+                         capture_output=True, text=True, timeout=60)
+    assert ret.stdout.strip().endswith("ok"), ret.stderr
+
+
+# (redis的地址, channel) => Subscribe
+_topic_pool: Dict[Tuple[str, str], Subscribe] = {
 
 }
 
@@ -522,22 +1019,29 @@ class MessageChannel:
         self.counter_start_key = f"channel:counter:start:{channel}"
         # 默认最新的
         if cursor < 0:
-            self.cursor = int(self.redis.get(self.counter_key) or '0')
+            self.cursor = self._current_cursor()
         else:
-            self.min_cursor = int(self.redis.get(self.counter_start_key) or '1')
+            self.min_cursor = self._min_cursor()
             if cursor < self.min_cursor:
                 self.cursor = self.min_cursor
             else:
                 self.cursor = cursor
-        if subscribe := _topic_pool.get(channel):
+        key = (redis_addr(redis), channel)
+        if subscribe := _topic_pool.get(key):
             if not subscribe.thread:
                 subscribe.run()
         else:
             # todo: 确定gevent是否启动
-            _topic_pool[channel] = subscribe = Subscribe(channel, redis=redis)
+            _topic_pool[key] = subscribe = Subscribe(channel, redis=redis)
             subscribe.run()
         self.subscribe = subscribe
 
+    def _current_cursor(self) -> int:
+        return int(self.redis.get(self.counter_key) or '0')
+
+    def _min_cursor(self) -> int:
+        return int(self.redis.get(self.counter_start_key) or '1')
+
     @property
     def event(self):
         return self.subscribe.event
@@ -553,15 +1057,43 @@ class MessageChannel:
             "channel写入错误"
         )
         if counter % 100 == 0:
-            length = self.redis.hlen(self.key)
-            if length > self.buffer_length:
-                with Block("删除掉一部分旧的", fail=False):
-                    key_list = sorted(list(map(int, self.redis.hkeys(self.key))))
-                    new_start = len(key_list) - self.buffer_length
-                    Log(f"[channel={self.channel}]清理[start={new_start}]")
-                    self.redis.hdel(self.key, *key_list[:new_start])
-                    self.redis.set(self.counter_start_key, new_start)
+            self._trim()
         self.redis.publish(self.channel, json_str(data))
+        return data
+
+    def publish_many(self, raws: List[str]) -> List[MessageData]:
+        """
+        批量发布
+        计数一次往返, 写入与广播合并成一次pipeline
+        """
+        if not raws:
+            return []
+        counter = self.redis.incrby(self.counter_key, amount=len(raws))
+        _now = now()
+        data_list = [
+            MessageChannel.MessageData(id=_id, ts=_now, data=raw)
+            for _id, raw in enumerate(raws, start=counter - len(raws) + 1)
+        ]
+        with self.redis.pipeline(transaction=False) as pipeline:
+            for data in data_list:
+                pipeline.hsetnx(self.key, str(data["id"]), json_str(data))
+            for data in data_list:
+                pipeline.publish(self.channel, json_str(data))
+            ret = pipeline.execute()
+        Assert(all(ret[:len(data_list)]), "channel写入错误")
+        if counter // 100 != (counter - len(raws)) // 100:
+            self._trim()
+        return data_list
+
+    def _trim(self):
+        length = self.redis.hlen(self.key)
+        if length > self.buffer_length:
+            with Block("删除掉一部分旧的", fail=False):
+                key_list = sorted(list(map(int, self.redis.hkeys(self.key))))
+                new_start = len(key_list) - self.buffer_length
+                Log(f"[channel={self.channel}]清理[start={key_list[new_start]}]")
+                self.redis.hdel(self.key, *key_list[:new_start])
+                self.redis.set(self.counter_start_key, key_list[new_start])
 
     # noinspection PyBroadException,PyTypeChecker
     def fetch_message(self, timeout_sec=30) -> Optional[MessageData]:
@@ -598,6 +1130,140 @@ class MessageChannel:
         return None
 
 
+class StreamMessageChannel(MessageChannel):
+    """
+    基于redis stream的channel
+    cursor语义与MessageChannel一致(消息id即stream id的毫秒位)
+    发布只需要一次往返, 裁剪由`XADD MAXLEN ~`分摊完成
+    """
+    # 计数/写入/裁剪/广播在同一个脚本里完成
+    __PUBLISH_LUA = """
+    local counter = redis.call('INCR', KEYS[2])
+    local data = '{"data":' .. cjson.encode(ARGV[2]) .. ',"id":' .. counter .. ',"ts":' .. ARGV[1] .. '}'
+    redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[3], counter .. '-0', 'data', data)
+    redis.call('PUBLISH', ARGV[4], data)
+    return data
+    """
+    __publish_script = {}
+
+    def __init__(self, channel: str, cursor: int = -1, redis: Redis = db_mgr, buffer_length=1000):
+        self.stream_key = f"channel:stream:{channel}"
+        super().__init__(channel, cursor=cursor, redis=redis, buffer_length=buffer_length)
+
+    def _min_cursor(self) -> int:
+        if ret := self.redis.xrange(self.stream_key, count=1):
+            return int(ret[0][0].partition("-")[0])
+        return self._current_cursor() + 1
+
+    def __script(self):
+        # 按redis实例缓存注册过的脚本
+        if (script := StreamMessageChannel.__publish_script.get(id(self.redis))) is None:
+            script = StreamMessageChannel.__publish_script[id(self.redis)] = self.redis.register_script(
+                StreamMessageChannel.__PUBLISH_LUA
+            )
+        return script
+
+    def publish_by_channel(self, raw: str):
+        ret = self.__script()(
+            keys=[self.stream_key, self.counter_key],
+            args=[now(), raw, self.buffer_length, self.channel],
+        )
+        data: MessageChannel.MessageData = str_json(ret)
+        return data
+
+    def publish_many(self, raws: List[str]) -> List[MessageChannel.MessageData]:
+        """
+        批量发布(一次pipeline)
+        """
+        if not raws:
+            return []
+        script = self.__script()
+        _now = now()
+        with self.redis.pipeline(transaction=False) as pipeline:
+            for raw in raws:
+                script(
+                    keys=[self.stream_key, self.counter_key],
+                    args=[_now, raw, self.buffer_length, self.channel],
+                    client=pipeline,
+                )
+            return list(map(str_json, pipeline.execute()))
+
+    def __decode(self, entries) -> Optional[MessageChannel.MessageData]:
+        if not entries:
+            return None
+        _, fields = entries[0]
+        data: MessageChannel.MessageData = str_json(fields["data"])
+        self.cursor = data["id"] + 1
+        return data
+
+    def __after(self) -> str:
+        # 独占的起点
+        return f"{self.cursor - 1}-0" if self.cursor > 0 else "0-0"
+
+    # noinspection PyBroadException
+    def fetch_message(self, timeout_sec=30) -> Optional[MessageChannel.MessageData]:
+        """
+        负责获取下一条(XREAD BLOCK)
+        """
+        try:
+            ret = self.redis.xread({self.stream_key: self.__after()}, count=1, block=int(timeout_sec * 1000))
+            if ret:
+                return self.__decode(ret[0][1])
+        except Exception as e:
+            Log(f"channel[{self.channel}:{self.cursor}] no message[{e}]")
+        return None
+
+    def fetch_message_nowait(self) -> Optional[MessageChannel.MessageData]:
+        """
+        负责获取一条最新的
+        """
+        return self.__decode(self.redis.xrange(self.stream_key, min=f"{self.cursor}-0", count=1))
+
+    def ensure_group(self, group: str, cursor: Optional[int] = None):
+        """
+        创建消费组(默认从当前cursor开始)
+        """
+        start = f"{cursor - 1}-0" if cursor and cursor > 0 else self.__after()
+        try:
+            self.redis.xgroup_create(self.stream_key, group, id=start, mkstream=True)
+        except RedisError as e:
+            if "BUSYGROUP" not in str(e):
+                raise e
+
+    def fetch_group_message(self, group: str, consumer: str, timeout_sec=30, *,
+                            pending=False) -> Optional[MessageChannel.MessageData]:
+        """
+        消费组读取(XREADGROUP)
+        pending=True时重放自己未ack的消息
+        """
+        ret = self.redis.xreadgroup(
+            group, consumer, {self.stream_key: "0" if pending else ">"},
+            count=1, block=None if pending else int(timeout_sec * 1000),
+        )
+        if ret and ret[0][1]:
+            return self.__decode(ret[0][1])
+        return None
+
+    def ack(self, group: str, *message_id: int) -> int:
+        return self.redis.xack(self.stream_key, group, *map(lambda x: f"{x}-0", message_id))
+
+
+def message_channel(channel: str, cursor: int = -1, redis: Redis = db_mgr, buffer_length=1000) -> MessageChannel:
+    """
+    根据配置选择channel的实现
+    """
+    if db_channel_backend == "stream":
+        return StreamMessageChannel(channel, cursor=cursor, redis=redis, buffer_length=buffer_length)
+    return MessageChannel(channel, cursor=cursor, redis=redis, buffer_length=buffer_length)
+
+
+def publish_many(channel: str, raws: List[str], redis: Redis = db_mgr) -> List[MessageChannel.MessageData]:
+    """
+    批量发布到指定channel
+    """
+    return message_channel(channel, redis=redis).publish_many(raws)
+
+
 def model_id_list_push(key, model, head=False, max_length=100):
     if head:
         db_model_ex.lpush(key, model.id)
@@ -639,7 +1305,14 @@ def model_id_list(key: str, start=0, length=100):
 
 
 def db_dirty(cate, key) -> bool:
-    return db_mgr.sadd("dirty:%s" % cate, key) > 0
+    """
+    标记需要写回mongo的对象
+    `dirty:__models`记录有哪些model, 写回时不需要扫描
+    """
+    pipe = db_mgr.pipeline(transaction=False)
+    pipe.sadd("dirty:%s" % cate, key)
+    pipe.sadd("dirty:__models", cate)
+    return pipe.execute()[0] > 0
 
 
 def mapping_get(model, mapping, prop="_key") -> Optional[str]:
@@ -647,8 +1320,10 @@ def mapping_get(model, mapping, prop="_key") -> Optional[str]:
     redis里有缓存
     mongo里有实体以及额外的索引
     """
-    ret = db_model_ex.get("%s:%s" % (model, mapping))
-    if ret is None:
+    key = "%s:%s" % (model, mapping)
+    # 同一次往返带上不存在的标记
+    ret, miss = db_model_ex.mget(key, f"__miss_mapping:{key}")
+    if ret is None and miss is None:
         if prop is not None and len(prop):
             with SentryBlock(op="mongo", description=f"mapping_get [{prop}={mapping}]") as span:
                 span.set_tag("model", model)
@@ -656,16 +1331,23 @@ def mapping_get(model, mapping, prop="_key") -> Optional[str]:
                 if tmp is not None:
                     Log("激活索引[%s:%s]=>[%s]" % (model, mapping, tmp["id"]))
                     ret = "%s:%s" % (model, tmp["id"])
-                    db_model_ex.set("%s:%s" % (model, mapping), ret, ex=3 * 24 * 3600)
+                    db_model_ex.set(key, ret, ex=3 * 24 * 3600)
                 else:
                     span.set_tag("none", True)
+                    if db_negative_ttl > 0:
+                        db_model_ex.set(f"__miss_mapping:{key}", 1, ex=db_negative_ttl)
+    elif ret is None:
+        mongo_negative_count[model] = mongo_negative_count.get(model, 0) + 1
     # noinspection PyTypeChecker
     return ret
 
 
 def mapping_add(cate, mapping, model_key):
     key = "%s:%s" % (cate, mapping)
-    if db_model_ex.set(key, model_key, nx=True, ex=3 * 24 * 3600) == 0:
+    pipe = db_model_ex.pipeline(transaction=False)
+    pipe.set(key, model_key, nx=True, ex=3 * 24 * 3600)
+    pipe.delete(f"__miss_mapping:{key}")
+    if pipe.execute()[0] == 0:
         orig = db_model_ex.get(key)
         if orig == model_key:
             return
@@ -734,10 +1416,9 @@ def db_get_list(key_list: Sequence[str], allow_not_found=True, fail=True, model=
         if model is not None:
             tmp = model + ":"
             assert len(list(filter(lambda x: not x.startswith(tmp), key_list))) == 0
+        found = mongo_promote([k for k, v in zip(key_list, orig_ret) if v is None], model=model)
         for i, k_v in enumerate(zip(key_list, orig_ret)):
-            if k_v[1] is not None:
-                continue
-            if value := mongo_get(k_v[0], model=model):
+            if k_v[1] is None and (value := found.get(k_v[0])):
                 orig_ret[i] = json_str(value)
         ret = list(filter(lambda x: x is not None, orig_ret))
 
@@ -843,14 +1524,91 @@ def db_set_json(key, value, fail=True) -> bool:
             return False
 
 
-def db_counter(key, get_only=False) -> int:
+def db_counter(key, get_only=False, step=1) -> int:
     """
     自增用的
+    step>1时是一次预留一段, 返回这一段的最后一个
     """
     if get_only:
         return int(db_model_ex.incr(key, amount=0))
     else:
-        return int(db_model_ex.incr(key, amount=1))
+        return int(db_model_ex.incr(key, amount=step))
+
+
+class Lease:
+    """
+    redis上的租约(`SET NX PX`), 同一时间只有一个owner
+    - 拿到时从`__lease_token:<name>`自增一个fencing token, 后拿到的一定更大
+    - 续约/释放都核对owner, 过期没续上的别人可以接手
+    - 写入结果前用check()确认token还是最新的, 避免过期的owner覆盖
+    """
+    __ACQUIRE_LUA = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return redis.call('INCR', KEYS[2])
+end
+return 0
+"""
+    __RENEW_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+    __RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+    __scripts: Dict[str, Callable] = {}
+
+    def __init__(self, name: str, ttl: int = 60 * 1000, *, owner: Optional[str] = None, redis_db: Redis = None):
+        self.name = name
+        self.ttl = ttl
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{os.urandom(4).hex()}"
+        self.redis = redis_db or db_mgr
+        self.token = 0
+        self.key = f"__lease:{name}"
+        self.token_key = f"__lease_token:{name}"
+
+    def __script(self, lua: str):
+        if (script := Lease.__scripts.get(f"{id(self.redis)}#{lua}")) is None:
+            script = Lease.__scripts[f"{id(self.redis)}#{lua}"] = self.redis.register_script(lua)
+        return script
+
+    def acquire(self) -> bool:
+        self.token = int(self.__script(Lease.__ACQUIRE_LUA)(keys=[self.key, self.token_key],
+                                                              args=[self.owner, self.ttl]))
+        return self.token > 0
+
+    def renew(self) -> bool:
+        if not self.token:
+            return False
+        if self.__script(Lease.__RENEW_LUA)(keys=[self.key], args=[self.owner, self.ttl]):
+            return True
+        self.token = 0
+        return False
+
+    def release(self) -> bool:
+        if not self.token:
+            return False
+        self.token = 0
+        return bool(self.__script(Lease.__RELEASE_LUA)(keys=[self.key], args=[self.owner]))
+
+    def holder(self) -> Optional[str]:
+        return self.redis.get(self.key)
+
+    def check(self) -> bool:
+        """
+        fencing: 自己还持有并且token没有被后来者超过
+        """
+        if not self.token:
+            return False
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self.key)
+        pipe.get(self.token_key)
+        holder, token = pipe.execute()
+        return holder == self.owner and int(token or 0) == self.token
 
 
 def db_incr(key):
@@ -1,14 +1,16 @@
 import abc
 from abc import abstractmethod
+from datetime import datetime, timedelta
 from time import sleep
-from typing import Callable, Optional, Iterable, Generator, Iterator
+from typing import Callable, Optional, Iterable, Generator, Iterator, Set, List
 
 import gevent
 from gevent import Greenlet
 
 from base.interface import ITask
-from base.style import Trace, Log, now, Block, SentryBlock, T
+from base.style import Trace, Log, now, Block, SentryBlock, T, Assert, Fail
 from frameworks.models import SimpleNode
+from frameworks.redis_mongo import Lease
 
 
 class ForeverTask(ITask):
@@ -77,16 +79,108 @@ class TaskNode:
         self.name: str = ""
         self.task: Optional[ITask] = None
         self.thread: Optional[Greenlet] = None
+        # 别的节点在执行时帮忙执行分区的
+        self.helper: Optional[Greenlet] = None
+        self.lease: Optional[Lease] = None
 
     @abc.abstractmethod
-    def next_cycle(self):
+    def next_cycle(self, last: int = 0) -> int:
+        """
+        启动时计算下一次的时间
+        :param last: 上一次计划的时间(0表示没有)
+        """
         pass
 
+    def first_cycle(self) -> int:
+        """
+        第一次执行的时间, 0表示马上
+        """
+        return 0
+
+    def finish_cycle(self) -> int:
+        """
+        执行完之后的下一次时间(fixed-delay), 0表示沿用next_cycle的
+        """
+        return 0
+
+
+class Cron:
+    """
+    5段的cron表达式(分 时 日 月 周), 支持`* , - /`, 周的0和7都是周日
+    日和周都有限制时满足一个就行(和crontab一致)
+    """
+    ALIAS = {
+        "@hourly": "0 * * * *",
+        "@daily": "0 0 * * *",
+        "@weekly": "0 0 * * 0",
+        "@monthly": "0 0 1 * *",
+    }
+    __RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr: str):
+        self.expr = expr
+        parts = Cron.ALIAS.get(expr, expr).split()
+        Assert(len(parts) == 5, f"cron表达式[{expr}]需要5段")
+        fields: List[Set[int]] = [Cron.__parse(expr, part, lo, hi) for part, (lo, hi) in zip(parts, Cron.__RANGES)]
+        self.minutes, self.hours, self.days, self.months, self.weekdays = fields
+        self.weekdays = {x % 7 for x in self.weekdays}
+        self.any_day = parts[2] == "*"
+        self.any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def __parse(expr: str, part: str, lo: int, hi: int) -> Set[int]:
+        ret = set()
+        for each in part.split(","):
+            each, _, step = each.partition("/")
+            step = int(step) if step else 1
+            if each == "*":
+                start, end = lo, hi
+            elif "-" in each:
+                start, end = map(int, each.split("-"))
+            else:
+                start = int(each)
+                end = hi if step > 1 else start
+            Assert(lo <= start <= end <= hi and step > 0, f"cron表达式[{expr}]的[{part}]超出范围")
+            ret.update(range(start, end + 1, step))
+        return ret
+
+    def __match_day(self, t: datetime) -> bool:
+        day = t.day in self.days
+        weekday = (t.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return weekday
+        if self.any_weekday:
+            return day
+        return day or weekday
+
+    def next(self, ts: int) -> int:
+        """
+        ts(ms)之后的下一个时间点(本地时间)
+        """
+        t = datetime.fromtimestamp(ts / 1000).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = t.replace(year=t.year + t.month // 12, month=t.month % 12 + 1, day=1, hour=0, minute=0)
+            elif not self.__match_day(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return int(t.timestamp() * 1000)
+        Fail(f"cron表达式[{self.expr}]没有可以执行的时间")
+
 
 class TaskRuntimeNode(SimpleNode):
     start: int = 0
     heartbeat: int = 0
     expire: int = 0
+    # SimpleGroupBulkTask连续完成的数量, 中断后从这里继续
+    checkpoint: int = 0
+    # done/total/rate(每秒)/eta(秒)
+    progress: dict = {}
 
     def is_running(self) -> bool:
         return now() < self.expire
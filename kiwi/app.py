@@ -20,7 +20,7 @@ from skywalking.trace.span import NoopSpan
 
 from base.style import Block, Log, is_debug, active_console, Trace, is_dev, Assert, Error, \
     has_sentry, json_str, init_sky_walking, has_sky_walking, str_json_ex, hour_zero, today_zero, now, HOUR_TS, DAY_TS
-from base.utils import read_file, flatten, load_module, write_file
+from base.utils import read_file, flatten, load_module, write_file, ImportProfiler
 
 # pretty_errors.configure(
 #     line_length=140,
@@ -371,11 +371,18 @@ application = FlaskWSGIAction(app.wsgi_app)
               type=click.Choice(
                   ['full'] + list(filter(lambda x: os.path.isdir(f"modules/{x}"), os.listdir("modules")))
               ), show_default=True, help="启动的模式", )
+@click.option('--profile-startup', is_flag=True, help="统计加载模块的耗时(类似-X importtime)")
+@click.option('--profile-top', default=20, show_default=True, help="统计时输出耗时最多的模块数")
 def main(**kwargs):
     if kwargs.get("tag"):
         global TAG
         TAG = kwargs["tag"]
-    _main(kwargs["mode"])
+    if kwargs.get("profile_startup"):
+        with ImportProfiler() as profiler:
+            _main(kwargs["mode"])
+        profiler.report(top=kwargs["profile_top"])
+    else:
+        _main(kwargs["mode"])
     from kiwi.main import startup
     startup(app, application)
 
@@ -10,7 +10,8 @@ from frameworks.actions import GetAction, local_request, FastAction, Action, Cod
 from frameworks.base import ChunkPacket, ChunkStream, RedirectResponse
 from frameworks.context import DefaultRouter
 from frameworks.main_server import forward_response, forward
-from frameworks.redis_mongo import db_other, db_config
+from frameworks.push import sse_packet, websocket_push
+from frameworks.redis_mongo import db_other, db_config, message_channel
 from frameworks.server_context import SessionContext
 from frameworks.session import SessionMgr
 from modules.core.injector import JWTPayload
@@ -456,6 +457,21 @@ def chunk5(__stream: ChunkStream, num=10, has_over=True):
         __stream.Log(f"end waiting {num} sec")
 
 
+@GetAction
+def channel_sse(__request, channel: str, cursor: int = -1):
+    return sse_packet(channel, cursor, request=__request)
+
+
+@GetAction
+def channel_ws(__websocket, channel: str, cursor: int = -1):
+    websocket_push(__websocket, channel, cursor)
+
+
+@Action
+def channel_publish(channel: str, raw: str):
+    message_channel(channel).publish_by_channel(raw)
+
+
 @GetAction
 def forward_test():
     return forward(None, "manager.user_by_user_id", param={})
@@ -4,6 +4,9 @@ from base.style import str_json, Log, Trace, date_str, Block, date_str8, now
 from frameworks.actions import Action, GetAction
 from frameworks.base import HTMLPacket
 from frameworks.redis_mongo import db_model, mongo_set, db_model_ex, db_keys_iter, db_stats_ex, mongo_pack_set
+from modules.core.mgr.job import JobMgr
+from modules.core.mgr.tiering import TieringMgr
+from modules.core.mgr.write_behind import WriteBehindMgr
 
 
 def __dump_stats(key: str, delete=False):
@@ -92,6 +95,35 @@ def sync_all_model(delete_ts=0, delete=True):
     Log("sync Success")
 
 
+@Action
+def write_behind_stats(flush=False):
+    """
+    write-behind每个model的积压/延迟(ms)/吞吐
+    """
+    if flush:
+        WriteBehindMgr.flush_all()
+    return WriteBehindMgr.stats()
+
+
+@Action
+def tiering_stats():
+    """
+    冷热分层每个model下沉/拉回的数量以及省下的内存
+    """
+    return TieringMgr.stats()
+
+
+@Action
+def job_stats(dead=False):
+    """
+    延迟队列每个优先级的积压/执行中/失败的数量
+    """
+    ret = JobMgr.stats()
+    if dead:
+        ret["dead_list"] = JobMgr.dead()
+    return ret
+
+
 @GetAction
 def hello(__path):
     return HTMLPacket(f"""\
@@ -1,3 +1,5 @@
+import os
+
 from frameworks.main_server import reg_handler, reg_get_alias, reg_get_not_found
 from modules.core.form import reg_form
 from modules.core.mgr.task import TaskMgr
@@ -5,7 +7,8 @@ from modules.core.mgr.task import TaskMgr
 
 def init_server():
     from .actions import dev, main
-    from .task import DailyPrint, GroupPrint, DailyRedisCleanerTask
+    from .task import DailyPrint, GroupPrint, DailyRedisCleanerTask, DailyRedisScanCleanerTask, \
+        BloomRebuildTask
     reg_handler(path="admin", module=dev)
     reg_handler(path="admin", module=main)
     reg_get_not_found(path_prefix="/echo/", target=main.hello, auto=False)
@@ -15,6 +18,10 @@ def init_server():
     TaskMgr.add_daily_task(name="每日打印", func=DailyPrint)
     TaskMgr.add_daily_task(name="每日打印group", func=GroupPrint)
     TaskMgr.add_daily_task(name="清理DailyRedis", func=DailyRedisCleanerTask)
+    # 迁移期间: 按桶登记之前写入的key只能靠SCAN清理, 上线超过DAILY_REDIS_EXPIRE_DAYS天后可以关掉
+    if os.environ.get("DAILY_REDIS_SCAN_CLEANER", "TRUE") == "TRUE":
+        TaskMgr.add_daily_task(name="清理DailyRedis(SCAN)", func=DailyRedisScanCleanerTask)
+    TaskMgr.add_daily_task(name="重建bloom", func=BloomRebuildTask)
 
 
 def prepare():
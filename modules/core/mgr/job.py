@@ -0,0 +1,294 @@
+import os
+import random
+import uuid
+from functools import partial
+from typing import Dict, Callable, Optional, List
+
+import gevent
+from gevent.pool import Pool
+
+from base.interface import IService
+from base.style import Log, Trace, now, str_json, json_str, Assert, SentryBlock, Fail
+from frameworks.context import Server
+from frameworks.redis_mongo import db_mgr
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class JobStats:
+    def __init__(self):
+        self.done = 0
+        self.failed = 0
+        self.retried = 0
+        self.dead = 0
+        # 执行的总耗时(ms)
+        self.cost = 0
+
+    def to_json(self) -> Dict:
+        return {
+            "done": self.done,
+            "failed": self.failed,
+            "retried": self.retried,
+            "dead": self.dead,
+            "avg": round(self.cost / max(self.done + self.failed, 1), 2),
+        }
+
+
+# noinspection PyMethodMayBeStatic
+class _JobMgr(IService):
+    """
+    redis上的延迟任务队列, 重的操作不在请求里直接gevent.spawn
+    - `__job:delayed:<priority>:<name>`是按到期时间的ZSET, 数据在`__job:data`
+    - 只认领本进程注册过的name, 到期的按优先级用Lua原子的认领到`__job:running`(超时时间)
+    - 执行中定期延长超时时间, 执行的进程没了超时后重新入队(算一次尝试)
+    - 失败的按backoff*2^n退避重试, 超过次数的放到`__job:dead`
+    - 同一个进程同时执行的数量不超过concurrency
+    """
+    DATA = "__job:data"
+    RUNNING = "__job:running"
+    DEAD = "__job:dead"
+    NAMES = "__job:names"
+    __ENQUEUE_LUA = """
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 1 then
+    redis.call('SADD', KEYS[3], ARGV[4])
+    return redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+end
+return 0
+"""
+    __CLAIM_LUA = """
+local ret = {}
+local count = tonumber(ARGV[2])
+for i = 2, #KEYS do
+    if count <= 0 then
+        break
+    end
+    local ids = redis.call('ZRANGEBYSCORE', KEYS[i], '-inf', ARGV[1], 'LIMIT', 0, count)
+    for _, id in ipairs(ids) do
+        redis.call('ZREM', KEYS[i], id)
+        redis.call('ZADD', KEYS[1], tonumber(ARGV[1]) + tonumber(ARGV[3]), id)
+        table.insert(ret, id)
+    end
+    count = count - #ids
+end
+return ret
+"""
+
+    def __init__(self):
+        self.concurrency = int(os.environ.get("JOB_CONCURRENCY", "8"))
+        self.interval = int(os.environ.get("JOB_INTERVAL", "200"))
+        self.timeout = int(os.environ.get("JOB_TIMEOUT", str(5 * 60 * 1000)))
+        self.max_backoff = int(os.environ.get("JOB_MAX_BACKOFF", str(60 * 60 * 1000)))
+        self.__next = 0
+        self.__thread: Optional[gevent.Greenlet] = None
+        self.__pool = Pool(max(1, self.concurrency))
+        self.__handlers: Dict[str, Callable] = {}
+        self.__stats: Dict[str, JobStats] = {}
+        self.__enqueue = db_mgr.register_script(_JobMgr.__ENQUEUE_LUA)
+        self.__claim = db_mgr.register_script(_JobMgr.__CLAIM_LUA)
+
+    @staticmethod
+    def delayed(priority: int, name: str) -> str:
+        return f"__job:delayed:{priority}:{name}"
+
+    def __stat(self, name: str) -> JobStats:
+        if (ret := self.__stats.get(name)) is None:
+            ret = self.__stats[name] = JobStats()
+        return ret
+
+    def register(self, name: str, func: Callable):
+        Assert(name not in self.__handlers, f"job[{name}]重复注册")
+        self.__handlers[name] = func
+
+    def enqueue(self, name: str, params: Optional[Dict] = None, *, delay: int = 0, at: int = 0,
+                priority: int = PRIORITY_NORMAL, retries: int = 3, backoff: int = 1000,
+                job_id: Optional[str] = None) -> str:
+        """
+        :param params: func的参数(需要能json化)
+        :param delay: 延迟(ms), at是绝对时间
+        :param job_id: 指定的话同一个id没执行完之前重复提交会被忽略
+        """
+        Assert(PRIORITY_HIGH <= priority <= PRIORITY_LOW, f"job[{name}]的优先级[{priority}]不对")
+        job_id = job_id or uuid.uuid4().hex
+        job = {
+            "id": job_id,
+            "name": name,
+            "params": params or {},
+            "priority": priority,
+            "retries": retries,
+            "backoff": backoff,
+            "attempts": 0,
+            "created": now(),
+        }
+        self.__enqueue(keys=[_JobMgr.DATA, _JobMgr.delayed(priority, name), _JobMgr.NAMES],
+                       args=[job_id, json_str(job), at or now() + delay, name])
+        return job_id
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        还没开始执行的才能取消
+        """
+        if (raw := db_mgr.hget(_JobMgr.DATA, job_id)) is None:
+            return False
+        job = str_json(raw)
+        if not db_mgr.zrem(_JobMgr.delayed(job["priority"], job["name"]), job_id):
+            return False
+        db_mgr.hdel(_JobMgr.DATA, job_id)
+        return True
+
+    def cycle(self, _now):
+        if _now < self.__next:
+            return
+        if self.__thread is not None and not self.__thread.ready():
+            return
+        self.__next = _now + self.interval
+        self.__thread = gevent.spawn(self.poll)
+
+    def reap(self) -> int:
+        """
+        超时的(执行的进程没了)算一次失败, 重试或者放到dead
+        """
+        ret = 0
+        for job_id in db_mgr.zrangebyscore(_JobMgr.RUNNING, "-inf", now(), start=0, num=100):
+            # 多个进程同时reap只有一个能删掉
+            if not db_mgr.zrem(_JobMgr.RUNNING, job_id):
+                continue
+            if (raw := db_mgr.hget(_JobMgr.DATA, job_id)) is None:
+                continue
+            job = str_json(raw)
+            Log(f"job[{job['name']}][{job_id}]执行超时")
+            self.__stat(job["name"]).failed += 1
+            self.__fail(job, "timeout")
+            ret += 1
+        return ret
+
+    def __fail(self, job: Dict, error: str):
+        """
+        失败的按次数退避重试, 超过的放到dead
+        """
+        stat = self.__stat(job["name"])
+        job_id = job["id"]
+        job["attempts"] += 1
+        job["error"] = error
+        pipe = db_mgr.pipeline(transaction=True)
+        pipe.zrem(_JobMgr.RUNNING, job_id)
+        if job["attempts"] <= job["retries"]:
+            stat.retried += 1
+            pipe.hset(_JobMgr.DATA, job_id, json_str(job))
+            pipe.zadd(_JobMgr.delayed(job["priority"], job["name"]), {
+                job_id: now() + min(job["backoff"] * 2 ** (job["attempts"] - 1), self.max_backoff)
+            })
+        else:
+            stat.dead += 1
+            pipe.hdel(_JobMgr.DATA, job_id)
+            pipe.lpush(_JobMgr.DEAD, json_str(job))
+            pipe.ltrim(_JobMgr.DEAD, 0, 999)
+        pipe.execute()
+
+    def poll(self) -> int:
+        """
+        按空闲的数量认领到期的job
+        """
+        try:
+            self.reap()
+            if (free := self.__pool.free_count()) <= 0 or not self.__handlers:
+                return 0
+            # 同一个优先级里轮换name的顺序, 避免一个name一直占满
+            names = random.sample(list(self.__handlers), len(self.__handlers))
+            keys = [_JobMgr.RUNNING] + [_JobMgr.delayed(x, name) for x in range(PRIORITY_HIGH, PRIORITY_LOW + 1)
+                                        for name in names]
+            ids: List[str] = self.__claim(keys=keys, args=[now(), free, self.timeout])
+            if not ids:
+                return 0
+            for job_id, raw in zip(ids, db_mgr.hmget(_JobMgr.DATA, ids)):
+                if raw is None:
+                    # 被取消了
+                    db_mgr.zrem(_JobMgr.RUNNING, job_id)
+                    continue
+                self.__pool.spawn(self.execute, str_json(raw))
+            return len(ids)
+        except Exception as e:
+            Trace("job认领异常", e)
+            return 0
+
+    def __heartbeat(self, job_id: str):
+        """
+        执行中延长超时时间, 避免长的job被当成进程没了重新执行
+        """
+        while True:
+            gevent.sleep(self.timeout / 3000)
+            # xx: 已经结束或者被reap了的不再加回来
+            db_mgr.zadd(_JobMgr.RUNNING, {job_id: now() + self.timeout}, xx=True)
+
+    def execute(self, job: Dict):
+        name = job["name"]
+        job_id = job["id"]
+        stat = self.__stat(name)
+        start = now()
+        heartbeat = gevent.spawn(self.__heartbeat, job_id)
+        try:
+            if (func := self.__handlers.get(name)) is None:
+                Fail(f"job[{name}]没有注册")
+            with SentryBlock(op="Job", name=name):
+                func(**job["params"])
+        except Exception as e:
+            Trace(f"job[{name}][{job_id}]执行异常", e)
+            stat.failed += 1
+            self.__fail(job, str(e))
+        else:
+            stat.done += 1
+            pipe = db_mgr.pipeline(transaction=True)
+            pipe.zrem(_JobMgr.RUNNING, job_id)
+            pipe.hdel(_JobMgr.DATA, job_id)
+            pipe.execute()
+        finally:
+            heartbeat.kill()
+            stat.cost += now() - start
+
+    def dead(self, count: int = 100) -> List[Dict]:
+        return list(map(str_json, db_mgr.lrange(_JobMgr.DEAD, 0, count - 1)))
+
+    def stats(self) -> Dict:
+        names = sorted(db_mgr.smembers(_JobMgr.NAMES))
+        pipe = db_mgr.pipeline(transaction=False)
+        for priority in range(PRIORITY_HIGH, PRIORITY_LOW + 1):
+            for name in names:
+                pipe.zcard(_JobMgr.delayed(priority, name))
+        pipe.zcard(_JobMgr.RUNNING)
+        pipe.llen(_JobMgr.DEAD)
+        *delayed, running, dead = pipe.execute()
+        return {
+            # 每个优先级的积压
+            "delayed": [sum(delayed[i * len(names):(i + 1) * len(names)]) for i in range(PRIORITY_LOW + 1)],
+            "names": {name: sum(delayed[i * len(names) + j] for i in range(PRIORITY_LOW + 1))
+                      for j, name in enumerate(names)},
+            "running": running,
+            "dead": dead,
+            "local": self.concurrency - self.__pool.free_count(),
+            "jobs": {k: v.to_json() for k, v in self.__stats.items()},
+        }
+
+
+JobMgr = _JobMgr()
+if JobMgr.concurrency > 0:
+    Server.add_service(JobMgr)
+
+
+def job(name: Optional[str] = None):
+    """
+    注册成job, 通过`func.enqueue(params, delay=...)`提交
+        @job()
+        def send_mail(uid: str, title: str):
+            ...
+
+        send_mail.enqueue({"uid": uid, "title": title}, delay=1000)
+    """
+
+    def decorator(func):
+        _name = name or f"{func.__module__}.{func.__qualname__}"
+        JobMgr.register(_name, func)
+        func.enqueue = partial(JobMgr.enqueue, _name)
+        return func
+
+    return decorator
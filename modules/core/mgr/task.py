@@ -1,17 +1,29 @@
+import os
+import random
+import time
 from abc import abstractmethod, ABC
-from typing import List, Type, Tuple
+from itertools import islice
+from math import ceil
+from typing import List, Type, Tuple, Dict, Iterator, Optional, Callable
 
 import gevent
+from gevent.pool import Pool
 
 from base.interface import IMinService, ITask
-from base.style import now, DAY_TS, Log, T, SentryBlock, Trace
+from base.style import now, DAY_TS, Log, T, SentryBlock, Trace, Assert, Fail
 from frameworks.context import Server
-from frameworks.task import TaskNode, TaskRuntimeNode
+from frameworks.redis_mongo import Lease, db_mgr
+from frameworks.task import TaskNode, TaskRuntimeNode, Cron
+
+TASK_LEASE_TTL = int(os.environ.get("TASK_LEASE_TTL", str(3 * 60 * 1000)))
 
 
 class ISimpleTask(ITask, ABC):
     def __init__(self, name: str):
         self.name = name
+        # TaskMgr启动时设置, 本轮的租约和轮次(启动时间)
+        self.lease: Optional[Lease] = None
+        self.round = 0
 
     def over(self):
         Log(f"任务[{self.name}]完毕")
@@ -38,6 +50,16 @@ class SimpleTask(ISimpleTask):
 
 # noinspection PyMethodMayBeStatic
 class SimpleGroupBulkTask(ISimpleTask):
+    """
+    分批执行group的产出
+    - concurrency()个批次同时执行(gevent的pool, io为主的场景; cpu为主的在bulk_main里用进程池, 参考KeywordScreenTask)
+    - target_latency()>0时按每批的耗时在step()的[1/10, 10倍]之间调整批量
+    - checkpoint_interval()>0时连续完成的进度定期写到TaskRuntimeNode.checkpoint, 中断后再启动从那里继续(group_from)
+      需要group()每次按同样的顺序产出(SCAN/没有排序的mongo查询都不行), 所以默认关闭
+    - partitions()>0时按group_partition分区, 各个节点用租约抢占分区并行执行(work-stealing)
+      必须覆盖group_partition按key的范围(或者稳定的hash)直接取, 按位置切分每个分区都要遍历整个group()且顺序不定时会重叠
+    """
+
     def total(self):
         return -1
 
@@ -45,6 +67,22 @@ class SimpleGroupBulkTask(ISimpleTask):
     def group(self) -> T:
         pass
 
+    def group_from(self, offset: int) -> Iterator[T]:
+        """
+        跳过前offset个, 能直接定位的(比如按游标/id)可以覆盖
+        默认的实现要求group()的顺序是确定的
+        """
+        return islice(self.group(), offset, None)
+
+    def partitions(self):
+        return 0
+
+    def group_partition(self, index: int, count: int) -> Iterator[T]:
+        """
+        第index个分区, partitions()>0时必须覆盖成按key的范围(或者稳定的hash)直接取
+        """
+        Fail(f"任务[{self.name}]没有实现group_partition")
+
     @abstractmethod
     def bulk_main(self, data: List[T]):
         pass
@@ -59,56 +97,197 @@ class SimpleGroupBulkTask(ISimpleTask):
     def step(self):
         return 100
 
+    def concurrency(self):
+        return 1
+
+    def target_latency(self):
+        """
+        每批期望的耗时(ms), 0表示固定step
+        """
+        return 0
+
+    def checkpoint_interval(self):
+        """
+        保存进度的间隔(ms), 0表示不保存(默认)
+        开启的话group()/group_partition()的顺序必须是确定的, 否则继续的时候会漏掉
+        """
+        return 0
+
+    def __bulk(self, data_list: List[Tuple[int, T]], total: int):
+        try:
+            with SentryBlock(
+                    op="Task",
+                    name=f"{self.name}#{'[%s~%s]/%s' % (data_list[0][0], data_list[-1][0], total)}",
+            ):
+                self.bulk_main(list(map(lambda x: x[1], data_list)))
+        except Exception as ee:
+            Trace(f"任务[{self.name}]批量执行{'[%s~%s]/%s' % (data_list[0][0], data_list[-1][0], total)}异常", ee)
+            if self.__class__.bulk_main_error == SimpleGroupBulkTask.bulk_main_error:
+                # 没有实现
+                return
+            for ii, data in data_list:
+                human = ""
+                try:
+                    # noinspection PyNoneFunctionAssignment
+                    human = self.human(data)
+                    with SentryBlock(op="Task", name=f"{self.name}修复性执行#{'%s/%s' % (ii, total)}"):
+                        self.bulk_main_error(data)
+                except Exception as eee:
+                    Trace(f"任务[{self.name}]批量执行细化[{human or ii}]异常", eee)
+
+    def __save(self, runtime_id: str, lease: Optional[Lease], checkpoint: int, progress: Dict) -> bool:
+        """
+        :return: False表示租约已经被别人接手了
+        """
+        try:
+            if lease is not None and not lease.check():
+                return False
+            # 和TaskMgr共用一个node, 每次重新取避免覆盖
+            node = TaskRuntimeNode.by_str_id(runtime_id, auto_new=True)
+            node.checkpoint = checkpoint
+            node.progress = progress
+            node.save()
+        except Exception as e:
+            Trace(f"任务[{runtime_id}]保存进度异常", e)
+        return True
+
     def run(self):
-        step = self.step()
-        total = self.total()
-        tmp: List[Tuple[int, T]] = []
+        try:
+            if self.partitions() > 0:
+                self.run_partitions(self.round or now(), wait=True)
+            else:
+                self.__execute(self.name, self.group_from, self.total(), self.lease)
+        finally:
+            self.over()
 
-        def func():
-            if total <= 0:
-                Log(f"任务进度[{tmp[0][0]}~{tmp[-1][0]}/...]")
+    def __keep(self, lease: Lease):
+        while lease.renew():
+            gevent.sleep(lease.ttl / 3000)
+
+    def run_partitions(self, round_id: int, wait: bool):
+        """
+        抢占本轮还没完成的分区执行
+        :param wait: 等所有分区都完成(启动的节点), 否则没有可抢的就退出(帮忙的节点)
+        """
+        count = self.partitions()
+        Assert(self.__class__.group_partition != SimpleGroupBulkTask.group_partition,
+               f"任务[{self.name}]分区执行需要实现group_partition")
+        done_key = f"__task_done:{self.name}:{round_id}"
+        total = self.total()
+        part_total = ceil(total / count) if total > 0 else -1
+        while True:
+            rest = set(range(count)) - set(map(int, db_mgr.smembers(done_key)))
+            if not rest:
+                break
+            claimed = False
+            # 打乱一下, 各个节点从不同的分区开始
+            for i in random.sample(sorted(rest), len(rest)):
+                lease = Lease(f"task:{self.name}#{i}", TASK_LEASE_TTL)
+                if not lease.acquire():
+                    continue
+                claimed = True
+                keeper = gevent.spawn(self.__keep, lease)
+                try:
+                    if db_mgr.sismember(done_key, i):
+                        continue
+                    Log(f"任务[{self.name}]执行分区[{i}/{count}]")
+                    if self.__execute(f"{self.name}#{i}",
+                                      lambda offset, index=i: islice(self.group_partition(index, count), offset, None),
+                                      part_total, lease):
+                        # 出错的也算本轮结束, 进度留给下一轮
+                        pipe = db_mgr.pipeline(transaction=False)
+                        pipe.sadd(done_key, i)
+                        pipe.pexpire(done_key, 2 * DAY_TS)
+                        pipe.execute()
+                finally:
+                    keeper.kill()
+                    lease.release()
+            if not wait:
+                break
+            if not claimed:
+                # 剩下的在别的节点执行中, 租约过期没续上的会被这里接手
+                gevent.sleep(5)
+
+    def __execute(self, runtime_id: str, source: Callable[[int], Iterator[T]], total: int,
+                  lease: Optional[Lease]) -> bool:
+        """
+        :return: False表示租约丢了(别人接手), 没有执行完
+        """
+        step = self.step()
+        min_step, max_step = max(1, step // 10), step * 10
+        target = self.target_latency()
+        interval = self.checkpoint_interval()
+        offset = TaskRuntimeNode.by_str_id(runtime_id, auto_new=True).checkpoint if interval > 0 else 0
+        if offset:
+            Log(f"任务[{runtime_id}]从[{offset}]继续")
+        pool = Pool(max(1, self.concurrency()))
+        # 执行中的批次 起始位置 => 数量
+        pending: Dict[int, int] = {}
+        dispatched = offset
+        done = offset
+        start = time.time()
+        last_save = now()
+        fenced = False
+
+        def progress() -> Dict:
+            rate = (done - offset) / max(time.time() - start, 0.001)
+            eta = int((total - done) / rate) if total > 0 and rate > 0 else -1
+            return {"done": done, "total": total, "rate": round(rate, 2), "eta": eta}
+
+        def func(first: int, data_list: List[Tuple[int, T]]):
+            nonlocal step, done, last_save, fenced
+            begin = time.time()
+            self.__bulk(data_list, total)
+            cost = (time.time() - begin) * 1000
+            del pending[first]
+            done += len(data_list)
+            if target > 0:
+                # 平滑一下避免抖动
+                step = min(max(int(step * (0.5 + 0.5 * target / max(cost, 1))), min_step), max_step)
+            cur = progress()
+            if cur["eta"] >= 0:
+                Log(f"任务进度[{done}/{total}][{cur['rate']}/s][剩余{cur['eta']}s]")
             else:
-                Log(f"任务进度[{tmp[0][0]}~{tmp[-1][0]}/{total}]")
-            data_list = list(tmp)
-            tmp.clear()
-            try:
-                with SentryBlock(
-                        op="Task",
-                        name=f"{self.name}#{'[%s~%s]/%s' % (data_list[0][0], data_list[-1][0], total)}",
-                ):
-                    self.bulk_main(list(map(lambda x: x[1], data_list)))
-            except Exception as ee:
-                Trace(f"任务[{self.name}]批量执行{'[%s~%s]/%s' % (data_list[0][0], data_list[-1][0], total)}异常", ee)
-                if self.__class__.bulk_main_error == SimpleGroupBulkTask.bulk_main_error:
-                    # 没有实现
-                    return
-                for ii, data in data_list:
-                    human = ""
-                    try:
-                        # noinspection PyNoneFunctionAssignment
-                        human = self.human(data)
-                        with SentryBlock(op="Task", name=f"{self.name}修复性执行#{'%s/%s' % (ii, total)}"):
-                            self.bulk_main_error(data)
-                    except Exception as eee:
-                        Trace(f"任务[{self.name}]批量执行细化[{human or ii}]异常", eee)
+                Log(f"任务进度[{done}/...][{cur['rate']}/s]")
+            if interval > 0 and (_now := now()) - last_save >= interval:
+                last_save = _now
+                # 只记录前面都完成了的位置
+                if not self.__save(runtime_id, lease, min(pending) if pending else dispatched, cur):
+                    fenced = True
+
+        def dispatch(data_list: List[Tuple[int, T]]):
+            nonlocal dispatched
+            pending[dispatched] = len(data_list)
+            dispatched += len(data_list)
+            # 满了会在这里等
+            pool.spawn(func, dispatched - len(data_list), data_list)
+            gevent.sleep(0)
 
         try:
-            i = 0
-            for i, each in enumerate(self.group(), start=1):
+            tmp: List[Tuple[int, T]] = []
+            for i, each in enumerate(source(offset), start=offset + 1):
                 tmp.append((i, each))
-                gevent.sleep(0)
-                if len(tmp) == step:
-                    func()
-            total = i
-            if len(tmp):
-                func()
-                gevent.sleep(0)
+                if len(tmp) >= step:
+                    if fenced:
+                        break
+                    dispatch(tmp)
+                    tmp = []
+            else:
+                if tmp:
+                    dispatch(tmp)
+            pool.join()
+            if fenced:
+                Log(f"任务[{runtime_id}]租约已经被接手, 停止")
+                return False
+            if interval > 0:
+                # 完整的执行完了下次从头开始
+                return self.__save(runtime_id, lease, 0, progress())
         except Exception as e:
-            Trace(f"任务[{self.name}]构造器异常", e)
-        else:
-            pass
-        finally:
-            self.over()
+            Trace(f"任务[{runtime_id}]构造器异常", e)
+            pool.join()
+            if interval > 0:
+                return self.__save(runtime_id, lease, min(pending) if pending else dispatched, progress())
+        return True
 
 
 # noinspection PyMethodMayBeStatic
@@ -156,10 +335,59 @@ class SimpleGroupTask(ISimpleTask):
             self.over()
 
 
-class DailyTaskNode(TaskNode):
+class RateTaskNode(TaskNode):
+    """
+    固定频率, 按上一次计划的时间累加(不会因为启动的延迟漂移), 错过的不补
+    """
+
+    def __init__(self, interval: int):
+        super().__init__()
+        self.interval = interval
+
+    def next_cycle(self, last: int = 0) -> int:
+        _now = now()
+        if last <= 0:
+            return _now + self.interval
+        ret = last + self.interval
+        if ret <= _now:
+            # 对齐到原来的节拍上
+            ret += ((_now - ret) // self.interval + 1) * self.interval
+        return ret
+
+
+class DailyTaskNode(RateTaskNode):
+
+    def __init__(self):
+        super().__init__(DAY_TS)
+
+
+class DelayTaskNode(TaskNode):
+    """
+    固定间隔, 从上一次执行完开始计算
+    """
+
+    def __init__(self, delay: int):
+        super().__init__()
+        self.delay = delay
+
+    def next_cycle(self, last: int = 0) -> int:
+        # 执行完之前不会重新开始(租约)
+        return now() + self.delay
+
+    def finish_cycle(self) -> int:
+        return now() + self.delay
+
 
-    def next_cycle(self):
-        return now() + DAY_TS
+class CronTaskNode(TaskNode):
+    def __init__(self, cron: str):
+        super().__init__()
+        self.cron = Cron(cron)
+
+    def next_cycle(self, last: int = 0) -> int:
+        return self.cron.next(now())
+
+    def first_cycle(self) -> int:
+        return self.cron.next(now())
 
 
 # noinspection PyMethodMayBeStatic
@@ -168,36 +396,85 @@ class _TaskMgr(IMinService):
     def __init__(self):
         self.task: List[TaskNode] = []
 
-    def add_daily_task(self, *, name: str, func: Type[ISimpleTask]):
-        task = DailyTaskNode()
+    def add_task(self, task: TaskNode, *, name: str, func: Type[ISimpleTask]):
         task.name = name
         task.task = func(name)
         self.task.append(task)
 
+    def add_daily_task(self, *, name: str, func: Type[ISimpleTask]):
+        self.add_task(DailyTaskNode(), name=name, func=func)
+
+    def add_cron_task(self, *, name: str, func: Type[ISimpleTask], cron: str):
+        """
+        cron: `分 时 日 月 周`, 比如每天4点半`30 4 * * *`
+        """
+        self.add_task(CronTaskNode(cron), name=name, func=func)
+
+    def add_rate_task(self, *, name: str, func: Type[ISimpleTask], interval: int):
+        self.add_task(RateTaskNode(interval), name=name, func=func)
+
+    def add_delay_task(self, *, name: str, func: Type[ISimpleTask], delay: int):
+        self.add_task(DelayTaskNode(delay), name=name, func=func)
+
     def cycle_min(self):
         for each in self.task:
-            node = TaskRuntimeNode.by_str_id(each.name, auto_new=True)
             if each.thread is not None:
                 if each.thread.ready():
-                    Log(f"任务[{node.id}]结束")
                     each.thread = None
+                    if not each.lease.check():
+                        # 已经被别的节点接手了, 由那边结束
+                        Log(f"任务[{each.name}]中止")
+                        continue
+                    Log(f"任务[{each.name}]结束")
+                    node = TaskRuntimeNode.by_str_id(each.name, auto_new=True)
                     node.start = 0
                     node.heartbeat = 0
+                    if expire := each.finish_cycle():
+                        node.expire = expire
                     node.save()
+                    each.lease.release()
+                elif each.lease.renew():
+                    Log(f"任务[{each.name}]继续")
                 else:
-                    Log(f"任务[{node.id}]继续")
-                    node.heartbeat = now()
-                    node.save()
-            else:
-                if node.is_running():
+                    # 别的节点会接手, 这边的checkpoint写入会被fencing挡掉
+                    Log(f"任务[{each.name}]租约丢失")
+                continue
+            if each.helper is not None and not each.helper.ready():
+                continue
+            node = TaskRuntimeNode.by_str_id(each.name, auto_new=True)
+            if not node.expire and (first := each.first_cycle()) > now():
+                # 第一次等到计划的时间
+                node.expire = first
+                node.save()
+                continue
+            if node.is_running() and not node.start:
+                # 本轮已经执行完了
+                continue
+            lease = Lease(f"task:{each.name}", TASK_LEASE_TTL)
+            if lease.acquire():
+                # 拿到租约后重新确认, 可能别的节点刚执行完
+                node = TaskRuntimeNode.by_str_id(each.name, auto_new=True)
+                if node.is_running() and not node.start:
+                    lease.release()
                     continue
-                self.start_task(each, node)
-
-    def start_task(self, config: TaskNode, runtime: TaskRuntimeNode):
-        Log(f"任务[{config.name}]启动")
-        runtime.start = now()
-        runtime.expire = config.next_cycle()
+                self.start_task(each, node, lease)
+            elif node.start and isinstance(each.task, SimpleGroupBulkTask) and each.task.partitions() > 0:
+                # 别的节点在执行, 帮忙抢分区
+                each.helper = gevent.spawn(each.task.run_partitions, node.start, False)
+
+    def start_task(self, config: TaskNode, runtime: TaskRuntimeNode, lease: Lease):
+        if runtime.is_running() and runtime.start:
+            # 中断的(租约过期)沿用原来的轮次, 从checkpoint继续
+            Log(f"任务[{config.name}]接手[{lease.token}]")
+        else:
+            Log(f"任务[{config.name}]启动[{lease.token}]")
+            runtime.start = now()
+            runtime.expire = config.next_cycle(runtime.expire)
+        runtime.heartbeat = now()
         runtime.save()
+        config.lease = lease
+        config.task.lease = lease
+        config.task.round = runtime.start
         config.thread = gevent.spawn(config.task.run)
 
 
@@ -0,0 +1,140 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+import gevent
+from redis import ResponseError
+
+from base.interface import IService
+from base.style import Log, Trace
+from frameworks.context import Server
+from frameworks.redis_mongo import db_model, mongo_demote, mongo_promote_count, tiering_models
+
+
+class TieringStats:
+    def __init__(self):
+        self.sampled = 0
+        self.demoted = 0
+        # 下沉后redis里省下的字节(MEMORY USAGE)
+        self.freed = 0
+
+    def to_json(self, model: str) -> Dict:
+        return {
+            "sampled": self.sampled,
+            "demoted": self.demoted,
+            "freed": self.freed,
+            "promoted": mongo_promote_count.get(model, 0),
+        }
+
+
+# noinspection PyMethodMayBeStatic
+class _TieringMgr(IService):
+    """
+    redis(热) => mongo(冷)的分层
+    - 每轮用SCAN游标取一部分key, 用`OBJECT IDLETIME`采样访问时间(读写路径上没有额外开销)
+    - 只处理登记过的model(BaseSaveModel的子类, Meta.tiering=False的除外), 有过期时间的不动
+    - 采样的结果放在候选池里(近似LRU), 只在超过内存预算时把最久没访问的一批下沉到mongo
+    - 下沉时值没有变化才删除, 读的时候db_get_list/mongo_get会批量的拉回redis
+    """
+
+    def __init__(self):
+        self.max_memory = int(os.environ.get("TIERING_MAX_MEMORY", "0"))
+        self.min_idle = int(os.environ.get("TIERING_MIN_IDLE", "3600"))
+        self.interval = int(os.environ.get("TIERING_INTERVAL", "1000"))
+        self.sample = int(os.environ.get("TIERING_SAMPLE", "200"))
+        self.batch = int(os.environ.get("TIERING_BATCH", "100"))
+        self.used_memory = 0
+        self.__next = 0
+        self.__cursor = 0
+        # key => (idle, size)
+        self.__pool: Dict[str, Tuple[int, int]] = {}
+        self.__thread: Optional[gevent.Greenlet] = None
+        self.__stats: Dict[str, TieringStats] = {}
+
+    def cycle(self, _now):
+        if _now < self.__next:
+            return
+        if self.__thread is not None and not self.__thread.ready():
+            return
+        self.__next = _now + self.interval
+        self.__thread = gevent.spawn(self.run)
+
+    def __stat(self, model: str) -> TieringStats:
+        if (ret := self.__stats.get(model)) is None:
+            ret = self.__stats[model] = TieringStats()
+        return ret
+
+    def __probe(self, keys: List[str]) -> List[Tuple[str, int, int]]:
+        pipe = db_model.pipeline(transaction=False)
+        for key in keys:
+            pipe.object("idletime", key)
+            pipe.memory_usage(key)
+            pipe.ttl(key)
+        result = pipe.execute(raise_on_error=False)
+        ret = []
+        for key, idle, size, ttl in zip(keys, result[0::3], result[1::3], result[2::3]):
+            if isinstance(idle, ResponseError):
+                # LFU的淘汰策略下没有idletime
+                raise idle
+            if ttl != -1:
+                # 有过期时间的(或者已经没了)下沉后会丢掉过期
+                continue
+            if idle is not None and size is not None:
+                ret.append((key, idle, size))
+        return ret
+
+    def sampling(self) -> int:
+        """
+        沿着SCAN游标采样一批, 只保留最久没访问的放到候选池
+        """
+        self.__cursor, keys = db_model.scan(self.__cursor, count=self.sample)
+        keys = [k for k in keys if (i := k.find(":")) > 0 and k[0:i] in tiering_models
+                and not k.startswith("__", i + 1)]
+        for key, idle, size in self.__probe(keys):
+            self.__stat(key[0:key.index(":")]).sampled += 1
+            if idle >= self.min_idle:
+                self.__pool[key] = (idle, size)
+        if len(self.__pool) > self.batch * 4:
+            self.__pool = dict(sorted(self.__pool.items(), key=lambda kv: kv[1][0], reverse=True)[:self.batch * 4])
+        return len(keys)
+
+    def demote(self, count: int) -> int:
+        """
+        下沉候选池里最久没访问的count个(重新确认idletime)
+        """
+        candidates = sorted(self.__pool, key=lambda k: self.__pool[k][0], reverse=True)[:count]
+        for key in candidates:
+            del self.__pool[key]
+        probe = [(key, size) for key, idle, size in self.__probe(candidates) if idle >= self.min_idle]
+        sizes = dict(probe)
+        demoted = mongo_demote([key for key, _ in probe], no_sentry=True)
+        for key in demoted:
+            stat = self.__stat(key[0:key.index(":")])
+            stat.demoted += 1
+            stat.freed += sizes[key]
+        return len(demoted)
+
+    def run(self):
+        try:
+            self.used_memory = db_model.info("memory")["used_memory"]
+            if self.used_memory < self.max_memory * 0.9:
+                # 离预算还远就不采样了
+                return
+            self.sampling()
+            if self.used_memory > self.max_memory and self.__pool:
+                if demoted := self.demote(self.batch):
+                    Log(f"redis超过内存预算[{self.used_memory}/{self.max_memory}]下沉[{demoted}]")
+        except Exception as e:
+            Trace("冷热分层执行异常", e)
+
+    def stats(self) -> Dict:
+        return {
+            "used_memory": self.used_memory,
+            "max_memory": self.max_memory,
+            "candidates": len(self.__pool),
+            "models": {k: v.to_json(k) for k, v in self.__stats.items()},
+        }
+
+
+TieringMgr = _TieringMgr()
+if TieringMgr.max_memory > 0:
+    Server.add_service(TieringMgr)
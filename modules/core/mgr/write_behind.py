@@ -0,0 +1,159 @@
+import os
+from typing import Dict, List, Optional
+
+import gevent
+
+from base.interface import IService
+from base.style import Log, Trace, now, str_json
+from frameworks.context import Server
+from frameworks.models import WRITE_BEHIND
+from frameworks.redis_mongo import db_mgr, db_model, mongo_bulk_set
+
+
+class WriteBehindStats:
+    def __init__(self, _now: int):
+        # 上一次清空dirty的时间, 有积压时lag就是距离这个时间
+        self.drain = _now
+        self.last = _now
+        self.backlog = 0
+        self.lag = 0
+        self.flushed = 0
+        self.inserted = 0
+        self.missing = 0
+        self.batches = 0
+        self.errors = 0
+        # 每秒写回的数量(EWMA)
+        self.rate = 0.0
+
+    def to_json(self) -> Dict:
+        return {
+            "backlog": self.backlog,
+            "lag": self.lag,
+            "flushed": self.flushed,
+            "inserted": self.inserted,
+            "missing": self.missing,
+            "batches": self.batches,
+            "errors": self.errors,
+            "rate": round(self.rate, 2),
+        }
+
+
+# noinspection PyMethodMayBeStatic
+class _WriteBehindMgr(IService):
+    """
+    redis => mongo的写回
+    save时`db_dirty`标记, 这里按interval用`SPOP count`取出来`MGET`后`bulk_write`
+    - 每个model每轮最多max_batches批, 避免一个热点model拖住其他的
+    - 上一轮没写完不会叠加, mongo异常时把key放回去并且退避
+    - 积压超过high_water时不等interval连续写回
+    """
+    MODELS = "dirty:__models"
+
+    def __init__(self):
+        self.interval = int(os.environ.get("WRITE_BEHIND_INTERVAL", "1000"))
+        self.batch = int(os.environ.get("WRITE_BEHIND_BATCH", "500"))
+        self.max_batches = int(os.environ.get("WRITE_BEHIND_MAX_BATCHES", "20"))
+        self.high_water = int(os.environ.get("WRITE_BEHIND_HIGH_WATER", "10000"))
+        self.__next = 0
+        self.__backoff = 0
+        self.__thread: Optional[gevent.Greenlet] = None
+        self.__stats: Dict[str, WriteBehindStats] = {}
+
+    def cycle(self, _now):
+        if _now < self.__next:
+            return
+        if self.__thread is not None and not self.__thread.ready():
+            return
+        self.__next = _now + self.interval + self.__backoff
+        self.__thread = gevent.spawn(self.flush)
+
+    def __stat(self, model: str) -> WriteBehindStats:
+        if (ret := self.__stats.get(model)) is None:
+            ret = self.__stats[model] = WriteBehindStats(now())
+        return ret
+
+    def models(self) -> List[str]:
+        return sorted(db_mgr.smembers(_WriteBehindMgr.MODELS))
+
+    def backlog(self, model: Optional[str] = None) -> int:
+        if model is not None:
+            return db_mgr.scard(f"dirty:{model}")
+        return sum(map(self.backlog, self.models()))
+
+    def flush(self) -> int:
+        """
+        所有model写回一轮
+        """
+        total = 0
+        backlog = 0
+        failed = False
+        for model in self.models():
+            try:
+                total += self.flush_model(model)
+            except Exception as e:
+                failed = True
+                Trace(f"写回mongo[{model}]异常", e)
+            backlog += self.__stat(model).backlog
+        if failed:
+            self.__backoff = min(max(self.__backoff * 2, self.interval), 60 * 1000)
+        else:
+            self.__backoff = 0
+        if backlog > self.high_water and not failed:
+            Log(f"写回mongo积压[{backlog}]")
+            self.__next = 0
+        return total
+
+    def flush_model(self, model: str, max_batches: Optional[int] = None) -> int:
+        key = f"dirty:{model}"
+        stat = self.__stat(model)
+        total = 0
+        try:
+            for _ in range(max_batches or self.max_batches):
+                if not (keys := db_mgr.spop(key, self.batch)):
+                    break
+                values = {k: str_json(v) for k, v in zip(keys, db_model.mget(keys)) if v is not None}
+                try:
+                    inserted = mongo_bulk_set(model, values, no_sentry=True)
+                except Exception:
+                    # 放回去下一轮再写
+                    db_mgr.sadd(key, *keys)
+                    stat.errors += 1
+                    raise
+                total += len(values)
+                stat.batches += 1
+                stat.flushed += len(values)
+                stat.inserted += inserted
+                # redis里已经删掉了的就不用写了
+                stat.missing += len(keys) - len(values)
+                if len(keys) < self.batch:
+                    break
+                gevent.sleep(0)
+        finally:
+            _now = now()
+            stat.backlog = db_mgr.scard(key)
+            if stat.backlog == 0:
+                stat.drain = _now
+                stat.lag = 0
+            else:
+                stat.lag = _now - stat.drain
+            stat.rate = stat.rate * 0.8 + total * 1000 / max(_now - stat.last, 1) * 0.2
+            stat.last = _now
+        return total
+
+    def flush_all(self) -> int:
+        """
+        清空所有的积压(比如停服前)
+        """
+        total = 0
+        while self.backlog():
+            for model in self.models():
+                total += self.flush_model(model, max_batches=1 << 30)
+        return total
+
+    def stats(self) -> Dict[str, Dict]:
+        return {k: v.to_json() for k, v in self.__stats.items()}
+
+
+WriteBehindMgr = _WriteBehindMgr()
+if WRITE_BEHIND:
+    Server.add_service(WriteBehindMgr)
@@ -1,9 +1,15 @@
+import os
 import re
+from abc import abstractmethod
 from datetime import datetime, timedelta
-from typing import List
+from typing import List, Tuple
 
+from redis import Redis
+
+from base.plugins.filter_keywords import ScreenResult, filter_many
 from base.style import Log, T, today_zero
-from frameworks.redis_mongo import db_ex, db_daily_expire_days, db_daily_expire_mode
+from frameworks.redis_mongo import db_ex, db_daily_expire_days, db_daily_expire_mode, bloom_filters, DailyRedis, \
+    daily_redis_dbs
 from modules.core.mgr.task import SimpleTask, SimpleGroupTask, SimpleGroupBulkTask
 
 
@@ -12,6 +18,16 @@ class DailyPrint(SimpleTask):
         Log("new day")
 
 
+class BloomRebuildTask(SimpleTask):
+    """
+    用mongo里的_id重建各个model的bloom
+    """
+
+    def main(self, *args, **kwargs):
+        for bloom in list(bloom_filters.values()):
+            bloom.rebuild()
+
+
 class GroupPrint(SimpleGroupTask):
     def main(self, data: T):
         Log(f"print({data})")
@@ -22,6 +38,30 @@ class GroupPrint(SimpleGroupTask):
 
 
 class DailyRedisCleanerTask(SimpleGroupBulkTask):
+    """
+    清理DailyRedis已经结束的桶, 只处理写入时登记过的key(不用全库SCAN)
+    del模式删除, ttl模式给没有过期时间的设置到期
+    """
+
+    def step(self):
+        return 1
+
+    def bulk_main(self, data: List[Tuple[Redis, str]]):
+        for db, bucket in data:
+            count = DailyRedis.expire_bucket(db, bucket, db_daily_expire_mode)
+            Log(f"清理DailyRedis[{bucket}][{count}]")
+
+    def group(self) -> Tuple[Redis, str]:
+        for db in list(daily_redis_dbs.values()):
+            for bucket in DailyRedis.expired_buckets(db):
+                yield db, bucket
+
+
+class DailyRedisScanCleanerTask(SimpleGroupBulkTask):
+    """
+    全库SCAN的清理, 只用于清理按桶登记之前写入的key(迁移期间注册, DAILY_REDIS_SCAN_CLEANER=FALSE关掉)
+    """
+
     def bulk_main(self, data: List[T]):
         with db_ex.pipeline() as pipeline:
             if db_daily_expire_mode == "ttl":
@@ -64,3 +104,30 @@ class DailyRedisCleanerTask(SimpleGroupBulkTask):
                     else:
                         date, _, _ = lh.partition("_")
                         yield datetime.strptime(date, "%Y-%m-%d") + expire_days, each
+
+
+class KeywordScreenTask(SimpleGroupBulkTask):
+    """
+    批量的敏感词筛查
+    group产出(key, text), 命中的会回调on_hit
+    """
+
+    def workers(self):
+        return int(os.environ.get("KEYWORD_SCREEN_WORKERS", "1"))
+
+    def step(self):
+        return 10000
+
+    @abstractmethod
+    def group(self) -> Tuple[T, str]:
+        pass
+
+    @abstractmethod
+    def on_hit(self, key: T, result: ScreenResult):
+        pass
+
+    def bulk_main(self, data: List[Tuple[T, str]]):
+        results = filter_many(list(map(lambda x: x[1], data)), workers=self.workers())
+        for (key, _), result in zip(data, results):
+            if result["hits"]:
+                self.on_hit(key, result)